@@ -0,0 +1,62 @@
+"""
+Compares the per-row cost of the identity maps used while prefetching.
+
+Each run adds *rows* new model instances to an empty identity map and
+then looks up another copy of each of them, which is what happens when
+the rows for a relation are fetched and then shared between instances.
+
+Usage::
+
+    python benchmarks/identity_maps.py [rows ...]
+"""
+import sys
+import timeit
+
+import django
+from django.conf import settings
+
+settings.configure(INSTALLED_APPS=["django.contrib.contenttypes", "django.contrib.auth"])
+django.setup()
+
+from django.contrib.auth.models import Permission  # noqa: E402
+
+from django_prefetch_utils.identity_map.maps import LRUPrefetchIdentityMap  # noqa: E402
+from django_prefetch_utils.identity_map.maps import PrefetchIdentityMap  # noqa: E402
+from django_prefetch_utils.identity_map.maps import StrongPrefetchIdentityMap  # noqa: E402
+
+DEFAULT_ROWS = [10000, 100000]
+
+REPEAT = 5
+
+IDENTITY_MAPS = [
+    ("PrefetchIdentityMap", PrefetchIdentityMap),
+    ("StrongPrefetchIdentityMap", StrongPrefetchIdentityMap),
+    ("LRUPrefetchIdentityMap", lambda: LRUPrefetchIdentityMap(maxsize=None)),
+]
+
+
+def make_instances(rows):
+    return [Permission(pk=i, name=str(i), codename=str(i)) for i in range(rows)]
+
+
+def run(identity_map_class, instances, copies):
+    identity_map = identity_map_class()
+    for obj in instances:
+        identity_map[obj]
+    for obj in copies:
+        identity_map[obj]
+    return identity_map
+
+
+def main(rows_list):
+    for rows in rows_list:
+        instances = make_instances(rows)
+        copies = make_instances(rows)
+        print("%d rows" % rows)
+        for name, identity_map_class in IDENTITY_MAPS:
+            best = min(timeit.repeat(lambda: run(identity_map_class, instances, copies), number=1, repeat=REPEAT))
+            print("  %-28s %8.1f ms  %6.0f ns/row" % (name, best * 1000, best / (2 * rows) * 1e9))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_ROWS)
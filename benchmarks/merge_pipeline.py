@@ -0,0 +1,206 @@
+"""
+Compares the per-row cost of merging the rows of a queryset into an
+identity map with :class:`~django_prefetch_utils.identity_map.maps.QuerySetIdentityMap`
+against the stack of ``wrapt`` proxies which was used before it.
+
+Each run looks up *rows* copies of instances which are already in the
+identity map, along with a ``select_related`` object, an annotation and
+an ``extra`` column, which is what happens when the rows for a relation
+are fetched again with a persistent identity map.  It can be run on
+both CPython and PyPy.
+
+Usage::
+
+    python benchmarks/merge_pipeline.py [rows ...]
+"""
+import sys
+import timeit
+
+import django
+import wrapt
+from django.conf import settings
+
+settings.configure(INSTALLED_APPS=["django.contrib.contenttypes", "django.contrib.auth"])
+django.setup()
+
+from django.contrib.auth.models import Permission  # noqa: E402
+from django.contrib.contenttypes.models import ContentType  # noqa: E402
+from django.db.models import Value  # noqa: E402
+
+from django_prefetch_utils.identity_map.maps import PrefetchIdentityMap  # noqa: E402
+from django_prefetch_utils.identity_map.maps import QuerySetIdentityMap  # noqa: E402
+
+DEFAULT_ROWS = [10000, 100000]
+
+REPEAT = 5
+
+QUERYSET = (
+    Permission.objects.select_related("content_type").annotate(rank=Value(1)).extra(select={"double_id": "id * 2"})
+)
+
+
+# The proxies below are the identity map wrappers which were used to
+# merge rows before QuerySetIdentityMap.
+class RelObjAttrMemoizingIdentityMap(wrapt.ObjectProxy):
+    """
+    A wrapper for an identity map which provides a :meth:`rel_obj_attr`
+    to be returned from a ``get_prefetch_queryset`` method.
+
+    This is useful for cases when there is identifying information
+    on the related object returned from the prefetcher which is not present
+    on the equivalent object in the identity map.
+    """
+
+    __slots__ = ("_self_rel_obj_attr", "_self_memo")
+
+    def __init__(self, rel_obj_attr, wrapped):
+        super().__init__(wrapped)
+        self._self_rel_obj_attr = rel_obj_attr
+        self._self_memo = {}
+
+    def __getitem__(self, obj):
+        new_obj = self.__wrapped__[obj]
+
+        # Compute the rel_obj_attr on the original object and associate
+        # it with the new object
+        self._self_memo[new_obj] = self._self_rel_obj_attr(obj)
+
+        return new_obj
+
+    def rel_obj_attr(self, rel_obj):
+        return self._self_memo[rel_obj]
+
+
+class AnnotatingIdentityMap(wrapt.ObjectProxy):
+    """
+    A wrapper for an identity map which copies the annotations of each
+    object onto the instance in the identity map.
+    """
+
+    __slots__ = ("_self_annotation_keys",)
+
+    def __init__(self, annotation_keys, wrapped):
+        super().__init__(wrapped)
+        self._self_annotation_keys = annotation_keys
+
+    def __getitem__(self, obj):
+        new_obj = self.__wrapped__[obj]
+        if new_obj is not obj:
+            for key in self._self_annotation_keys:
+                setattr(new_obj, key, getattr(obj, key))
+        return new_obj
+
+
+class SelectRelatedIdentityMap(wrapt.ObjectProxy):
+    """
+    A wrapper for an identity map which applies it to the
+    ``select_related`` objects of each object as well.
+    """
+
+    __slots__ = ("_self_select_related",)
+    MISSING = object()
+
+    def __init__(self, select_related, wrapped):
+        super().__init__(wrapped)
+        self._self_select_related = select_related
+
+    def get_cached_value(self, field, instance):
+        if not field.is_cached(instance):
+            return self.MISSING
+        return field.get_cached_value(instance)
+
+    def set_cached_value(self, field, instance, value):
+        field.set_cached_value(instance, value)
+
+    def transfer_select_related(self, select_related, source, target):
+        for key, sub_select_related in select_related.items():
+            field = source._meta.get_field(key)
+
+            source_obj = self.get_cached_value(field, source)
+            if source_obj is self.MISSING:
+                source_obj = getattr(source, key)
+
+            target_obj = self.__wrapped__[source_obj]
+            self.set_cached_value(field, target, target_obj)
+            self.transfer_select_related(sub_select_related, source=source_obj, target=target_obj)
+
+    def __getitem__(self, obj):
+        new_obj = self.__wrapped__[obj]
+        self.transfer_select_related(self._self_select_related, source=obj, target=new_obj)
+        return new_obj
+
+
+class ExtraIdentityMap(wrapt.ObjectProxy):
+    """
+    A wrapper for an identity map which copies the ``extra`` columns of
+    each object onto the instance in the identity map.
+    """
+
+    __slots__ = ("_self_extra",)
+
+    def __init__(self, extra, wrapped):
+        super().__init__(wrapped)
+        self._self_extra = extra
+
+    def __getitem__(self, obj):
+        new_obj = self.__wrapped__[obj]
+        if new_obj is obj:
+            return new_obj
+
+        for key in self._self_extra:
+            setattr(new_obj, key, getattr(obj, key))
+
+        return new_obj
+
+
+def rel_obj_attr(obj):
+    return (obj.content_type_id,)
+
+
+def proxy_stack(identity_map):
+    query = QUERYSET.query
+    identity_map = SelectRelatedIdentityMap(dict(query.select_related), identity_map)
+    identity_map = AnnotatingIdentityMap(set(query.annotations), identity_map)
+    identity_map = ExtraIdentityMap(dict(query.extra), identity_map)
+    return RelObjAttrMemoizingIdentityMap(rel_obj_attr, identity_map)
+
+
+def compiled(identity_map):
+    return QuerySetIdentityMap.for_queryset(identity_map, QUERYSET, rel_obj_attr=rel_obj_attr)
+
+
+PIPELINES = [("wrapt proxy stack", proxy_stack), ("QuerySetIdentityMap", compiled)]
+
+
+def make_instances(rows):
+    content_type = ContentType(pk=1, app_label="auth", model="permission")
+    instances = []
+    for i in range(rows):
+        obj = Permission(pk=i, name=str(i), codename=str(i), content_type=content_type)
+        obj.rank = 1
+        obj.double_id = i * 2
+        instances.append(obj)
+    return instances
+
+
+def run(make_pipeline, identity_map, copies):
+    identity_map = make_pipeline(identity_map)
+    for obj in copies:
+        identity_map[obj]
+
+
+def main(rows_list):
+    print(sys.implementation.name)
+    for rows in rows_list:
+        identity_map = PrefetchIdentityMap()
+        instances = [identity_map[obj] for obj in make_instances(rows)]
+        copies = make_instances(rows)
+        print("%d rows" % rows)
+        for name, make_pipeline in PIPELINES:
+            best = min(timeit.repeat(lambda: run(make_pipeline, identity_map, copies), number=1, repeat=REPEAT))
+            print("  %-28s %8.1f ms  %6.0f ns/row" % (name, best * 1000, best / rows * 1e9))
+        del instances
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_ROWS)
@@ -7,9 +7,11 @@ class DjangoPrefetchUtilsAppConfig(AppConfig):
     name = "django_prefetch_utils"
 
     def ready(self):
+        from django_prefetch_utils.deferred import enable_batched_deferred_fields
         from django_prefetch_utils.selector import enable_prefetch_related_objects_selector
 
         enable_prefetch_related_objects_selector()
+        enable_batched_deferred_fields()
         self.set_default_prefetch_related_objects_implementation()
 
     def set_default_prefetch_related_objects_implementation(self):
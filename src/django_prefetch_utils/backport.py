@@ -5,6 +5,11 @@ from django.db.models.constants import LOOKUP_SEP
 from django.db.models.query import normalize_prefetch_lookups
 from django.utils.functional import cached_property
 
+from django_prefetch_utils.chunked import get_chunked_prefetcher
+from django_prefetch_utils.concurrent import aprefetch_concurrently
+from django_prefetch_utils.deferred import register_deferred_siblings
+from django_prefetch_utils.values import get_values_prefetcher
+
 
 def prefetch_related_objects(model_instances, *related_lookups):
     """
@@ -100,7 +105,12 @@ def prefetch_related_objects(model_instances, *related_lookups):
                 obj_to_fetch = [obj for obj in obj_list if not is_fetched(obj)]
 
             if obj_to_fetch:
+                values_prefetcher = get_values_prefetcher(prefetcher, lookup, level)
+                if values_prefetcher is not None:
+                    prefetcher = values_prefetcher
+                prefetcher = get_chunked_prefetcher(prefetcher, lookup, obj_to_fetch)
                 obj_list, additional_lookups = prefetch_one_level(obj_to_fetch, prefetcher, lookup, level)
+                register_deferred_siblings(obj_list)
                 # We need to ensure we don't keep adding lookups from the
                 # same relationships to stop infinite recursion. So, if we
                 # are already on an automatically added lookup, don't add
@@ -142,6 +152,15 @@ def prefetch_related_objects(model_instances, *related_lookups):
                 obj_list = new_obj_list
 
 
+async def aprefetch_related_objects(model_instances, *related_lookups):
+    """
+    An asynchronous version of prefetch_related_objects() which runs the
+    queries in executor threads so that the event loop is not blocked.
+    Independent top-level lookups are prefetched at the same time.
+    """
+    await aprefetch_concurrently(prefetch_related_objects, model_instances, related_lookups)
+
+
 def get_prefetcher(instance, through_attr, to_attr):
     """
     For the attribute 'through_attr' on the given instance, find
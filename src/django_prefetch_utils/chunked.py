@@ -0,0 +1,227 @@
+"""
+This module provides support for splitting the instances passed to a
+prefetcher's ``get_prefetch_queryset`` into several smaller batches.
+This keeps the ``IN`` lists sent to the database within the backend's
+parameter limits (999 for SQLite) and avoids very large query plans
+when prefetching for tens of thousands of instances.
+
+Chunking is opt-in.  It can be enabled globally with the
+``PREFETCH_UTILS_PREFETCH_CHUNK_SIZE`` setting::
+
+    PREFETCH_UTILS_PREFETCH_CHUNK_SIZE = "auto"
+
+or for an individual lookup with :class:`ChunkedPrefetch`::
+
+    dogs = Dog.objects.prefetch_related(ChunkedPrefetch("toys", chunk_size=500))
+
+A chunk size of ``"auto"`` starts with batches sized by the database
+backend's ``max_query_params`` and then adjusts the size of each
+subsequent batch based on how long the previous ones took to run.  The
+target duration of a batch can be set with the
+``PREFETCH_UTILS_PREFETCH_CHUNK_DURATION`` setting (in seconds).
+"""
+import time
+
+import wrapt
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.db.models import Prefetch
+
+AUTO = "auto"
+
+# The chunk size used for backends which do not have a limit on the
+# number of query parameters.
+DEFAULT_MAX_CHUNK_SIZE = 5000
+
+# The smallest chunk size that adaptive chunking will shrink to.
+MIN_CHUNK_SIZE = 100
+
+# The number of query parameters left free for any filters on the
+# prefetch queryset itself.
+QUERY_PARAMS_HEADROOM = 100
+
+# The default target duration (in seconds) of each batch when using
+# adaptive chunking.
+DEFAULT_TARGET_DURATION = 0.25
+
+
+class ChunkedPrefetch(Prefetch):
+    """
+    A :class:`django.db.models.Prefetch` which splits the instances being
+    prefetched for into batches of at most *chunk_size* instances::
+
+        Dog.objects.prefetch_related(ChunkedPrefetch("toys", chunk_size=500))
+
+    If *chunk_size* is ``"auto"``, then the size of the batches will be
+    determined from the database backend and adjusted based on the
+    latency of each batch.
+    """
+
+    def __init__(self, lookup, queryset=None, to_attr=None, chunk_size=AUTO):
+        super().__init__(lookup, queryset=queryset, to_attr=to_attr)
+        self.chunk_size = chunk_size
+
+
+class ChunkSizer(object):
+    """
+    Keeps track of the number of instances to include in each batch.
+    """
+
+    def __init__(self, size):
+        self.size = size
+
+    def record(self, size, duration):
+        """
+        Records that a batch of *size* instances took *duration* seconds
+        to fetch.
+        """
+
+
+class AdaptiveChunkSizer(ChunkSizer):
+    """
+    A :class:`ChunkSizer` which adjusts the size of the batches so that
+    each one takes roughly *target_duration* seconds to fetch.  The size
+    is kept between *minimum* and *maximum*, and is at most doubled
+    between batches.
+    """
+
+    def __init__(self, maximum, minimum=MIN_CHUNK_SIZE, target_duration=DEFAULT_TARGET_DURATION):
+        super().__init__(maximum)
+        self.maximum = maximum
+        self.minimum = min(minimum, maximum)
+        self.target_duration = target_duration
+
+    def record(self, size, duration):
+        if size <= 0 or duration <= 0:
+            return
+        ideal = int(self.target_duration * size / duration)
+        self.size = max(self.minimum, min(ideal, 2 * self.size, self.maximum))
+
+
+def get_max_chunk_size(using):
+    """
+    Returns the largest chunk size which can be used with the database
+    *using*.
+
+    :rtype: int
+    """
+    max_query_params = connections[using].features.max_query_params
+    if max_query_params is None:
+        return DEFAULT_MAX_CHUNK_SIZE
+    return max(1, max_query_params - QUERY_PARAMS_HEADROOM)
+
+
+def get_chunk_size_setting(lookup):
+    """
+    Returns the chunk size configured for *lookup*, falling back to the
+    ``PREFETCH_UTILS_PREFETCH_CHUNK_SIZE`` setting.
+    """
+    chunk_size = getattr(lookup, "chunk_size", None)
+    if chunk_size is None:
+        chunk_size = getattr(settings, "PREFETCH_UTILS_PREFETCH_CHUNK_SIZE", None)
+    return chunk_size
+
+
+def get_chunk_sizer(lookup, instances):
+    """
+    Returns a :class:`ChunkSizer` for prefetching *lookup* for *instances*,
+    or ``None`` if chunking is not enabled.
+    """
+    chunk_size = get_chunk_size_setting(lookup)
+    if not chunk_size:
+        return None
+
+    maximum = get_max_chunk_size(instances[0]._state.db or DEFAULT_DB_ALIAS)
+    if chunk_size == AUTO:
+        target_duration = getattr(settings, "PREFETCH_UTILS_PREFETCH_CHUNK_DURATION", DEFAULT_TARGET_DURATION)
+        return AdaptiveChunkSizer(maximum, target_duration=target_duration)
+    return ChunkSizer(min(int(chunk_size), maximum))
+
+
+def get_chunked_prefetcher(prefetcher, lookup, instances):
+    """
+    Returns *prefetcher* wrapped in a :class:`ChunkedPrefetcher` if
+    chunking is enabled for *lookup* and there are more *instances*
+    than fit in a single batch.  Otherwise, *prefetcher* is returned
+    unchanged.
+    """
+    chunk_sizer = get_chunk_sizer(lookup, instances)
+    if chunk_sizer is None or len(instances) <= chunk_sizer.size:
+        return prefetcher
+    return ChunkedPrefetcher(chunk_sizer, prefetcher)
+
+
+class ChunkedPrefetcher(wrapt.ObjectProxy):
+    """
+    A wrapper for any object which has a ``get_prefetch_queryset`` method
+    which calls that method once for each batch of instances.
+    """
+
+    __slots__ = ("_self_chunk_sizer",)
+
+    def __init__(self, chunk_sizer, wrapped):
+        super().__init__(wrapped)
+        self._self_chunk_sizer = chunk_sizer
+
+    def get_prefetch_queryset(self, instances, queryset=None):
+        rel_qs = ChunkedPrefetchQuerySet(self.__wrapped__, self._self_chunk_sizer, instances, queryset)
+        return (rel_qs, rel_qs.rel_obj_attr) + rel_qs.prefetch_data[2:]
+
+
+class ChunkedPrefetchQuerySet(object):
+    """
+    An iterable which yields the related objects for each batch of
+    instances in turn.
+
+    The first batch is set up eagerly so that the values returned from
+    ``get_prefetch_queryset`` are available.  The remaining batches are
+    set up as the previous ones are consumed so that the size of each
+    one can take into account how long the earlier ones took.
+    """
+
+    def __init__(self, prefetcher, chunk_sizer, instances, queryset):
+        self.prefetcher = prefetcher
+        self.chunk_sizer = chunk_sizer
+        self.queryset = queryset
+
+        size = chunk_sizer.size
+        self.first_chunk_size = len(instances[:size])
+        self.remaining = instances[size:]
+        self.prefetch_data = prefetcher.get_prefetch_queryset(instances[:size], queryset)
+        self._prefetch_related_lookups = getattr(self.prefetch_data[0], "_prefetch_related_lookups", ())
+
+        # The rel_obj_attr returned for each batch may depend on state
+        # which is only valid for that batch, so we compute the value
+        # as each object is yielded.
+        self._memo = {}
+
+    def __iter__(self):
+        prefetch_data = self.prefetch_data
+        size = self.first_chunk_size
+        remaining = self.remaining
+        while True:
+            rel_qs, rel_obj_attr = prefetch_data[:2]
+
+            # prefetch_one_level clears the lookups on the queryset it is
+            # given once it has taken them over, so we need to do the same
+            # for the querysets of each batch.
+            if not self._prefetch_related_lookups and getattr(rel_qs, "_prefetch_related_lookups", None):
+                rel_qs._prefetch_related_lookups = ()
+
+            start = time.perf_counter()
+            rel_objs = list(rel_qs)
+            self.chunk_sizer.record(size, time.perf_counter() - start)
+
+            for rel_obj in rel_objs:
+                self._memo.setdefault(id(rel_obj), []).append(rel_obj_attr(rel_obj))
+                yield rel_obj
+
+            if not remaining:
+                return
+            size = self.chunk_sizer.size
+            chunk, remaining = remaining[:size], remaining[size:]
+            prefetch_data = self.prefetcher.get_prefetch_queryset(chunk, self.queryset)
+
+    def rel_obj_attr(self, rel_obj):
+        return self._memo[id(rel_obj)].pop()
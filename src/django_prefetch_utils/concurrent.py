@@ -0,0 +1,233 @@
+"""
+This module provides utilities for prefetching independent lookups at
+the same time in separate threads.  Since Django's database connections
+are per-thread, each group of lookups is run on its own connection.
+
+Two top-level lookups are independent if they start with different
+relations on the model, so that
+``prefetch_related("toys", "owner", "vet_visits")`` can be performed
+with three concurrent queries.  Lookups which go through the same
+first relation (``"toys"`` and ``"toys__maker"``) are kept together and
+run in order.  Lookups whose first level is not a relation descriptor
+on the model (for example, a property or a ``to_attr`` of another
+lookup) are run after all of the concurrent lookups have finished.
+
+The maximum number of threads used can be set with the
+``PREFETCH_UTILS_CONCURRENT_MAX_WORKERS`` setting.
+
+For async code, :func:`aprefetch_concurrently` runs the groups in
+worker threads in the same way and awaits them together, so that the
+event loop is not blocked while the queries run.
+"""
+
+import asyncio
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db import connections
+from django.db.models import Prefetch
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.fields.related_descriptors import ReverseManyToOneDescriptor
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:  # Django < 3.0
+    sync_to_async = None
+
+DEFAULT_MAX_WORKERS = 4
+
+
+def get_max_workers():
+    """
+    Returns the maximum number of threads to use when prefetching
+    concurrently.
+
+    :rtype: int
+    """
+    return getattr(settings, "PREFETCH_UTILS_CONCURRENT_MAX_WORKERS", DEFAULT_MAX_WORKERS)
+
+
+def is_prefetchable_descriptor(descriptor):
+    """
+    Returns ``True`` if *descriptor* is a class-level descriptor for a
+    relation which can be prefetched without accessing any other
+    attributes of the instance.
+
+    :rtype: bool
+    """
+    return hasattr(descriptor, "get_prefetch_queryset") or isinstance(descriptor, ReverseManyToOneDescriptor)
+
+
+def get_independent_lookup_groups(model, related_lookups):
+    """
+    Splits *related_lookups* for instances of *model* into groups which
+    can be prefetched independently of each other.
+
+    Returns a 2-tuple containing the list of independent groups (each of
+    which is a list of lookups) and a list of the remaining lookups
+    which need to be prefetched after all of the groups have been.
+
+    :rtype: tuple
+    """
+    groups = {}
+    remaining = []
+    for lookup in related_lookups:
+        if isinstance(lookup, Prefetch):
+            through, to = lookup.prefetch_through, lookup.prefetch_to
+        else:
+            through = to = lookup
+        through_attr = through.split(LOOKUP_SEP, 1)[0]
+        to_attr = to.split(LOOKUP_SEP, 1)[0]
+
+        if through_attr != to_attr or not is_prefetchable_descriptor(getattr(model, through_attr, None)):
+            remaining.append(lookup)
+        else:
+            groups.setdefault(through_attr, []).append(lookup)
+    return list(groups.values()), remaining
+
+
+def can_prefetch_concurrently(model_instances):
+    """
+    Returns ``True`` if related objects for *model_instances* can be
+    fetched using connections in other threads.  This is not the case
+    inside of a transaction since other connections would not be able
+    to see its uncommitted changes.
+
+    :rtype: bool
+    """
+    using = getattr(getattr(model_instances[0], "_state", None), "db", None) or DEFAULT_DB_ALIAS
+    return not connections[using].in_atomic_block
+
+
+def prepare_instances(model_instances):
+    """
+    Sets up ``_prefetched_objects_cache`` on each of *model_instances* so
+    that threads prefetching different lookups do not replace each
+    other's caches.
+
+    Returns ``False`` if the instances do not support prefetching.
+
+    :rtype: bool
+    """
+    for obj in model_instances:
+        if not hasattr(obj, "_prefetched_objects_cache"):
+            try:
+                obj._prefetched_objects_cache = {}
+            except (AttributeError, TypeError):
+                return False
+    return True
+
+
+def _run_tasks(tasks, results):
+    try:
+        while True:
+            try:
+                index, context, func = tasks.popleft()
+            except IndexError:
+                return
+            try:
+                results[index] = (context.run(func), None)
+            except Exception as exc:
+                results[index] = (None, exc)
+    finally:
+        # Each of the threads created by run_concurrently and
+        # arun_concurrently has its own database connections, which would
+        # otherwise be left open once it finishes.
+        connections.close_all()
+
+
+def run_concurrently(funcs, max_workers=None):
+    """
+    Calls each of the functions in *funcs* in a separate thread and
+    returns a list of their results.  Each function is run in a copy
+    of the caller's :mod:`contextvars` context.
+
+    If any of the functions raises an exception, then it is re-raised
+    once all of the functions have finished.
+
+    :rtype: list
+    """
+    if len(funcs) <= 1:
+        return [func() for func in funcs]
+
+    max_workers = min(len(funcs), max_workers or get_max_workers())
+    tasks = deque((index, contextvars.copy_context(), func) for index, func in enumerate(funcs))
+    results = [None] * len(funcs)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for _ in range(max_workers):
+            executor.submit(_run_tasks, tasks, results)
+    return _get_results(results)
+
+
+async def arun_concurrently(funcs, max_workers=None):
+    """
+    An asynchronous version of :func:`run_concurrently` which calls each
+    of the functions in *funcs* in a separate thread so that the event
+    loop is not blocked while they run.  As with :func:`run_concurrently`,
+    each thread closes its database connections once it has finished.
+
+    :rtype: list
+    """
+    if not funcs:
+        return []
+
+    max_workers = min(len(funcs), max_workers or get_max_workers())
+    tasks = deque((index, contextvars.copy_context(), func) for index, func in enumerate(funcs))
+    results = [None] * len(funcs)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [asyncio.wrap_future(executor.submit(_run_tasks, tasks, results)) for _ in range(max_workers)]
+    finally:
+        # The threads exit once they run out of tasks, so there's no need
+        # to block the event loop waiting for them.
+        executor.shutdown(wait=False)
+    await asyncio.gather(*futures)
+    return _get_results(results)
+
+
+def _get_results(results):
+    for result, exc in results:
+        if exc is not None:
+            raise exc
+    return [result for result, exc in results]
+
+
+async def aprefetch_concurrently(prefetch_related_objects, model_instances, related_lookups):
+    """
+    Calls the synchronous *prefetch_related_objects* function with
+    *model_instances* in executor threads, once for each independent
+    group of *related_lookups*.  The groups are run at the same time,
+    followed by any remaining lookups which depend on them.
+
+    A transaction started from async code is on the connection of the
+    thread which ``sync_to_async`` uses for thread sensitive functions.
+    If one is active on the instances' database there, then the lookups
+    need to be prefetched using that connection, so they are all
+    prefetched with a single call in that thread.
+    """
+    if not model_instances:
+        return  # nothing to do
+
+    if sync_to_async is None:
+        # Without asgiref, a transaction can only be on the connection of
+        # the event loop's thread.
+        if not can_prefetch_concurrently(model_instances):
+            prefetch_related_objects(model_instances, *related_lookups)
+            return
+    else:
+        run_thread_sensitive = partial(sync_to_async, thread_sensitive=True)
+        if not await run_thread_sensitive(can_prefetch_concurrently)(model_instances):
+            await run_thread_sensitive(prefetch_related_objects)(model_instances, *related_lookups)
+            return
+
+    groups, remaining = get_independent_lookup_groups(type(model_instances[0]), related_lookups)
+    if len(groups) > 1 and prepare_instances(model_instances):
+        await arun_concurrently([partial(prefetch_related_objects, model_instances, *group) for group in groups])
+        related_lookups = remaining
+
+    if related_lookups:
+        await arun_concurrently([partial(prefetch_related_objects, model_instances, *related_lookups)])
@@ -0,0 +1,172 @@
+"""
+This module provides batched loading of deferred fields for the objects
+fetched by ``prefetch_related``, which can be enabled with the
+``PREFETCH_UTILS_BATCH_DEFERRED_FIELDS`` setting::
+
+    PREFETCH_UTILS_BATCH_DEFERRED_FIELDS = True
+
+    books = Book.objects.prefetch_related(Prefetch("reviews", queryset=Review.objects.defer("body")))
+    for book in books:
+        for review in book.reviews.all():
+            print(review.body)  # only one query for all of the bodies
+
+Normally, the first access of a deferred field on an object runs a query
+to load it for just that object.  While the setting is enabled, the
+objects with deferred fields which are fetched together for a level of
+a lookup keep a reference to a
+:class:`~django_prefetch_utils.siblings.SiblingSet` of each other.  The
+first access of a deferred field on any of them loads it for all of
+them which are still alive, with a query for each chunk of their
+primary keys.  This allows large fields to be deferred and only fetched
+when they are needed.
+
+Loading the siblings requires patching ``DeferredAttribute.__get__``,
+which is only done while the setting is enabled.  This will be done in
+``AppConfig.ready`` if ``django_prefetch_utils`` is added to
+``INSTALLED_APPS``, and is kept up to date when the setting is changed
+with ``override_settings``.
+
+It also provides hooks which are called before a deferred field is
+loaded, which are used by
+:mod:`django_prefetch_utils.identity_map.deferred`.
+"""
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models.query_utils import DeferredAttribute
+
+from django_prefetch_utils.chunked import get_max_chunk_size
+from django_prefetch_utils.siblings import SiblingSet
+
+SIBLING_SET_ATTR = "_prefetch_deferred_sibling_set"
+
+_hooks = []
+
+original_deferred_attribute_get = DeferredAttribute.__get__
+
+
+def add_deferred_field_hook(hook):
+    """
+    Adds *hook* to the functions called with a model instance and the
+    attribute name of a field before that deferred field is loaded for
+    it.  The hooks are called in order until one of them loads the
+    field.
+    """
+    if hook not in _hooks:
+        _hooks.append(hook)
+    DeferredAttribute.__get__ = _deferred_attribute_get
+
+
+def remove_deferred_field_hook(hook):
+    """
+    Removes *hook* from the functions called before a deferred field is
+    loaded.
+    """
+    if hook in _hooks:
+        _hooks.remove(hook)
+    if not _hooks:
+        DeferredAttribute.__get__ = original_deferred_attribute_get
+
+
+def _deferred_attribute_get(self, instance, cls=None):
+    if instance is not None and _hooks:
+        # Django 2.2 stores the attribute name rather than the field.
+        field = getattr(self, "field", None)
+        attname = self.field_name if field is None else field.attname
+        if attname not in instance.__dict__ and not getattr(field, "primary_key", False):
+            for hook in list(_hooks):
+                hook(instance, attname)
+                if attname in instance.__dict__:
+                    break
+    return original_deferred_attribute_get(self, instance, cls)
+
+
+def load_deferred_field(instances, attname, instance):
+    """
+    Loads the field *attname* for all of *instances* which have it
+    deferred and are of the same concrete model and from the same
+    database as *instance*, which is the instance it is being accessed
+    on.  Nothing is loaded if that is only *instance*, in which case the
+    field is loaded by Django as usual.
+    """
+    db = instance._state.db
+    concrete_model = instance._meta.concrete_model
+    by_pk = {
+        obj.pk: obj
+        for obj in instances
+        if obj._meta.concrete_model is concrete_model and attname not in obj.__dict__ and obj._state.db == db
+    }
+    if len(by_pk) <= 1:
+        return
+
+    model = type(instance)
+    queryset = model._base_manager.db_manager(db, hints={"instance": instance}).values_list(
+        model._meta.pk.attname, attname
+    )
+    pks = list(by_pk)
+    chunk_size = get_max_chunk_size(db)
+    for start in range(0, len(pks), chunk_size):
+        end = start + chunk_size
+        chunk = pks[start:end]
+        for pk, value in queryset.filter(pk__in=chunk):
+            by_pk[pk].__dict__[attname] = value
+
+
+def register_deferred_siblings(instances):
+    """
+    Records that *instances*, the objects fetched for a level of a
+    lookup, were fetched together if the
+    ``PREFETCH_UTILS_BATCH_DEFERRED_FIELDS`` setting is enabled and they
+    have deferred fields.
+    """
+    if len(instances) <= 1 or not getattr(settings, "PREFETCH_UTILS_BATCH_DEFERRED_FIELDS", False):
+        return
+
+    get_deferred_fields = getattr(instances[0], "get_deferred_fields", None)
+    if get_deferred_fields is None or not get_deferred_fields():
+        return
+
+    sibling_set = SiblingSet(instances)
+    for obj in instances:
+        obj.__dict__[SIBLING_SET_ATTR] = sibling_set
+
+
+def load_deferred_siblings(instance, attname):
+    """
+    A deferred field hook which loads *attname* for all of the siblings
+    of *instance* recorded by :func:`register_deferred_siblings`.
+    """
+    sibling_set = instance.__dict__.get(SIBLING_SET_ATTR)
+    if sibling_set is not None:
+        load_deferred_field(sibling_set.get_instances(), attname, instance)
+
+
+def update_batched_deferred_fields():
+    """
+    Adds :func:`load_deferred_siblings` to the deferred field hooks if
+    the ``PREFETCH_UTILS_BATCH_DEFERRED_FIELDS`` setting is enabled, and
+    removes it otherwise.
+    """
+    if getattr(settings, "PREFETCH_UTILS_BATCH_DEFERRED_FIELDS", False):
+        add_deferred_field_hook(load_deferred_siblings)
+    else:
+        remove_deferred_field_hook(load_deferred_siblings)
+
+
+def batched_deferred_fields_setting_changed(setting, **kwargs):
+    """
+    A ``setting_changed`` receiver which calls
+    :func:`update_batched_deferred_fields` when the
+    ``PREFETCH_UTILS_BATCH_DEFERRED_FIELDS`` setting is changed.
+    """
+    if setting == "PREFETCH_UTILS_BATCH_DEFERRED_FIELDS":
+        update_batched_deferred_fields()
+
+
+def enable_batched_deferred_fields():
+    """
+    Installs the deferred field hook according to the
+    ``PREFETCH_UTILS_BATCH_DEFERRED_FIELDS`` setting, and keeps it up to
+    date when the setting is changed.
+    """
+    update_batched_deferred_fields()
+    setting_changed.connect(batched_deferred_fields_setting_changed, dispatch_uid=__name__)
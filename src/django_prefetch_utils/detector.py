@@ -0,0 +1,307 @@
+"""
+This module provides :class:`NPlusOneDetector`, a context decorator
+which reports relations that are loaded one instance at a time for the
+instances of the same queryset::
+
+    with NPlusOneDetector() as detector:
+        for dog in Dog.objects.all():
+            print(dog.owner.address)
+
+    detector.counter
+    # Counter({(Dog, 'owner', ('views.py', 12, 'dog_list')): 10,
+    #          (Dog, 'owner__address', ('views.py', 12, 'dog_list')): 10})
+
+While a detector is active, each fetched instance is tagged with the
+result set it came from and the path of relations followed from the
+instances of the original queryset.  When a relation has been loaded
+*threshold* times from the same call site for instances of the same
+result set, a warning is logged to the ``django_prefetch_utils.detector``
+logger with the lookup to add to ``prefetch_related`` on the original
+queryset.  The call site is the innermost frame outside of Django and
+this library.
+
+The detector can be run on a sample of requests by passing a
+*sample_rate* between 0 and 1.  The defaults for *threshold* and
+*sample_rate* can be set with the ``PREFETCH_UTILS_NPLUSONE_THRESHOLD``
+and ``PREFETCH_UTILS_NPLUSONE_SAMPLE_RATE`` settings.
+"""
+import copy
+import logging
+import os
+import random
+import sys
+import threading
+from collections import Counter
+from collections import namedtuple
+from contextlib import ContextDecorator
+from contextvars import ContextVar
+
+import django
+from django.conf import settings
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query import ModelIterable
+
+import django_prefetch_utils
+from django_prefetch_utils.identity_map.iterables import IdentityMapModelIterable
+from django_prefetch_utils.relation_access import add_relation_access_hook
+from django_prefetch_utils.relation_access import remove_relation_access_hook
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 2
+
+DEFAULT_SAMPLE_RATE = 1.0
+
+# Frames from files in these directories are skipped when finding the
+# call site of a relation access.
+IGNORED_DIRECTORIES = tuple(os.path.dirname(module.__file__) + os.sep for module in (django, django_prefetch_utils))
+
+CallSite = namedtuple("CallSite", ["filename", "lineno", "function"])
+
+NPlusOneReport = namedtuple("NPlusOneReport", ["model", "lookup", "call_site", "count"])
+
+# The name of the attribute which holds the result set, the model of its
+# queryset and the relation path of an instance fetched while a detector
+# is active.
+RESULT_SET_ATTR = "_nplusone_result_set"
+
+# The iterables whose instances are tagged with their result set.
+TAGGED_ITERABLES = (ModelIterable, IdentityMapModelIterable)
+
+_active = ContextVar("nplusone_detector", default=None)
+
+# The result set, model, relation path and related model of the last
+# relation access, which are used to tag the instances it loads.
+_pending = ContextVar("nplusone_pending_relation", default=None)
+
+_installed_lock = threading.Lock()
+_installed_count = 0
+_original_iters = {}
+
+
+class ResultSet(object):
+    """
+    A token shared by the instances fetched by a single queryset, which
+    holds the number of relation accesses recorded for them.
+    """
+
+    __slots__ = ("counts",)
+
+    def __init__(self):
+        self.counts = {}
+
+
+def get_call_site():
+    """
+    Returns the :class:`CallSite` of the innermost frame which is not
+    in Django or this library.
+
+    :rtype: :class:`CallSite`
+    """
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_code.co_filename.startswith(IGNORED_DIRECTORIES):
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return CallSite(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+
+def get_related_model(model, attname):
+    """
+    Returns the model of the instances loaded by the relation *attname*
+    of *model*, or ``None`` if it can't be determined, as for generic
+    foreign keys.
+    """
+    descriptor = getattr(model, attname, None)
+    if hasattr(descriptor, "field") and not hasattr(descriptor, "rel"):
+        # Forward many-to-one and one-to-one relations.
+        return descriptor.field.related_model
+    if hasattr(descriptor, "related"):
+        # Reverse one-to-one relations.
+        return descriptor.related.related_model
+    rel = getattr(descriptor, "rel", None)
+    if rel is None:
+        return None
+    if getattr(descriptor, "reverse", True) and not rel.field.one_to_many:
+        # Reverse many-to-one and many-to-many relations.
+        return rel.related_model
+    # Forward many-to-many and generic relations.
+    return rel.model
+
+
+def record_relation_access(instance, attname):
+    """
+    A relation access hook which records the access with the active
+    :class:`NPlusOneDetector`, if there is one.
+
+    The access is recorded against the queryset and relation path that
+    *instance* was fetched with, and the instances loaded for *attname*
+    are tagged with the extended path.
+    """
+    detector = _active.get()
+    if detector is None:
+        return
+    result_set, model, path = instance.__dict__.get(RESULT_SET_ATTR, (None, type(instance), ()))
+    path += (attname,)
+    _pending.set((result_set, model, path, get_related_model(type(instance), attname)))
+    detector.record(model, LOOKUP_SEP.join(path), get_call_site(), result_set)
+
+
+def get_result_set_tag(queryset):
+    """
+    Returns the value of :data:`RESULT_SET_ATTR` for the instances
+    fetched by *queryset*.
+
+    These are tagged with the path of the last relation access when
+    they are the instances it loads, and otherwise start a new result
+    set.
+    """
+    pending = _pending.get()
+    if pending is not None:
+        result_set, model, path, related_model = pending
+        if related_model is None or related_model._meta.concrete_model is queryset.model._meta.concrete_model:
+            _pending.set(None)
+            return (result_set, model, path)
+    return (ResultSet(), queryset.model, ())
+
+
+def tag_instances(tag, objs):
+    """
+    Yields each of *objs* after setting :data:`RESULT_SET_ATTR` to *tag*
+    on it.
+    """
+    for obj in objs:
+        obj.__dict__[RESULT_SET_ATTR] = tag
+        yield obj
+
+
+def make_tagging_iter(original_iter):
+    """
+    Returns a version of the ``__iter__`` method *original_iter* of a
+    model iterable which tags the instances it yields with their result
+    set while a detector is active.
+    """
+
+    def __iter__(self):
+        if _active.get() is None:
+            return original_iter(self)
+        return tag_instances(get_result_set_tag(self.queryset), original_iter(self))
+
+    return __iter__
+
+
+class NPlusOneDetector(ContextDecorator):
+    """
+    A context decorator which counts the relations loaded one instance
+    at a time while it is active, keyed by the model of the original
+    queryset, the lookup for the relation and the call site.
+    """
+
+    def __init__(self, threshold=None, sample_rate=None, logger=logger):
+        if threshold is None:
+            threshold = getattr(settings, "PREFETCH_UTILS_NPLUSONE_THRESHOLD", DEFAULT_THRESHOLD)
+        if sample_rate is None:
+            sample_rate = getattr(settings, "PREFETCH_UTILS_NPLUSONE_SAMPLE_RATE", DEFAULT_SAMPLE_RATE)
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.logger = logger
+        self.counter = Counter()
+        self._reported = set()
+        self._counter_lock = threading.Lock()
+        self._entered = []
+
+    def _recreate_cm(self):
+        # Each use as a decorator shares the counter (and the lock which
+        # guards it) and the reported keys but gets its own tokens so that calls in different
+        # threads or tasks don't reset each other's values.
+        cm = copy.copy(self)
+        cm._entered = []
+        return cm
+
+    def __enter__(self):
+        sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        if sampled:
+            _install_hook()
+        self._entered.append((_active.set(self if sampled else None), sampled))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        token, sampled = self._entered.pop()
+        _active.reset(token)
+        if sampled:
+            _uninstall_hook()
+
+    def record(self, model, lookup, call_site, result_set=None):
+        """
+        Records that the relation *lookup* was loaded from *call_site*
+        for an instance in *result_set* of a queryset for *model*,
+        logging a warning when this reaches the threshold for the same
+        result set.
+
+        If *result_set* is ``None``, the loads for all instances are
+        counted together.
+        """
+        key = (model, lookup, call_site)
+        with self._counter_lock:
+            self.counter[key] += 1
+            if result_set is None:
+                count = self.counter[key]
+            else:
+                count = result_set.counts[key] = result_set.counts.get(key, 0) + 1
+            reached = count == self.threshold and key not in self._reported
+            if reached:
+                self._reported.add(key)
+        if reached:
+            self.logger.warning(
+                "Potential N+1 query: %s loaded %d times for %s instances from %s:%d in %s(). "
+                "Consider adding prefetch_related(%r) to the %s queryset.",
+                lookup,
+                self.threshold,
+                model.__name__,
+                call_site.filename if call_site else "<unknown>",
+                call_site.lineno if call_site else 0,
+                call_site.function if call_site else "<unknown>",
+                lookup,
+                model.__name__,
+            )
+
+    def get_reports(self):
+        """
+        Returns a list of :class:`NPlusOneReport` for each relation
+        which was loaded at least *threshold* times from the same call
+        site for the instances of a result set, with the most frequent
+        first.  The count is the total number of times it was loaded.
+
+        :rtype: list
+        """
+        with self._counter_lock:
+            most_common = self.counter.most_common()
+            reported = set(self._reported)
+        return [
+            NPlusOneReport(model, lookup, call_site, count)
+            for (model, lookup, call_site), count in most_common
+            if (model, lookup, call_site) in reported
+        ]
+
+
+def _install_hook():
+    global _installed_count
+    with _installed_lock:
+        if not _installed_count:
+            add_relation_access_hook(record_relation_access)
+            for iterable_class in TAGGED_ITERABLES:
+                original_iter = iterable_class.__dict__["__iter__"]
+                _original_iters[iterable_class] = original_iter
+                iterable_class.__iter__ = make_tagging_iter(original_iter)
+        _installed_count += 1
+
+
+def _uninstall_hook():
+    global _installed_count
+    with _installed_lock:
+        _installed_count -= 1
+        if not _installed_count:
+            remove_relation_access_hook(record_relation_access)
+            for iterable_class, original_iter in _original_iters.items():
+                iterable_class.__iter__ = original_iter
+            _original_iters.clear()
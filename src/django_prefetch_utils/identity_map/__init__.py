@@ -1,49 +1,47 @@
 import copy
+from functools import partial
 
-from django.contrib.contenttypes.fields import GenericForeignKey
 from django.core import exceptions
 from django.db.models import Manager
-from django.db.models.constants import LOOKUP_SEP
-from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
-from django.db.models.fields.related_descriptors import ForwardOneToOneDescriptor
-from django.db.models.fields.related_descriptors import ManyToManyDescriptor
-from django.db.models.fields.related_descriptors import ReverseManyToOneDescriptor
-from django.db.models.fields.related_descriptors import ReverseOneToOneDescriptor
 from django.db.models.query import normalize_prefetch_lookups
 from django.db.models.query import prefetch_one_level
-from django.utils.functional import cached_property
 
+from django_prefetch_utils.chunked import get_chunked_prefetcher
+from django_prefetch_utils.concurrent import aprefetch_concurrently
+from django_prefetch_utils.concurrent import can_prefetch_concurrently
+from django_prefetch_utils.concurrent import get_independent_lookup_groups
+from django_prefetch_utils.concurrent import prepare_instances
+from django_prefetch_utils.concurrent import run_concurrently
+from django_prefetch_utils.deferred import register_deferred_siblings
 from django_prefetch_utils.selector import override_prefetch_related_objects
+from django_prefetch_utils.values import get_values_prefetcher
 
+from .cache import get_caching_prefetcher
+from .maps import LockingIdentityMap
 from .maps import PrefetchIdentityMap
-from .wrappers import ForwardDescriptorPrefetchWrapper
-from .wrappers import GenericForeignKeyPrefetchWrapper
-from .wrappers import IdentityMapPrefetcher
-from .wrappers import ManyToManyRelatedManagerWrapper
-from .wrappers import ReverseManyToOneDescriptorPrefetchWrapper
-from .wrappers import ReverseOneToOneDescriptorPrefetchWrapper
+from .maps import StrongPrefetchIdentityMap
+from .plans import get_level_plan
+from .plans import get_prefetcher_wrapper_class
+from .plans import get_through_attrs
+from .plans import prefetch_plan_cache
+from .two_phase import get_two_phase_prefetcher
 
 
-def get_identity_map_prefetcher(identity_map, descriptor, prefetcher):
+def get_identity_map_prefetcher(identity_map, descriptor, prefetcher, wrapper_cls=None):
     if prefetcher is None:
         return None
 
-    wrappers = {
-        ForwardManyToOneDescriptor: ForwardDescriptorPrefetchWrapper,
-        ForwardOneToOneDescriptor: ForwardDescriptorPrefetchWrapper,
-        ReverseOneToOneDescriptor: ReverseOneToOneDescriptorPrefetchWrapper,
-        ReverseManyToOneDescriptor: ReverseManyToOneDescriptorPrefetchWrapper,
-        ManyToManyDescriptor: ManyToManyRelatedManagerWrapper,
-        GenericForeignKey: GenericForeignKeyPrefetchWrapper,
-    }
-    wrapper_cls = wrappers.get(type(descriptor), IdentityMapPrefetcher)
+    if wrapper_cls is None:
+        wrapper_cls = get_prefetcher_wrapper_class(descriptor)
     return wrapper_cls(identity_map, prefetcher)
 
 
-def get_prefetcher(obj_list, through_attr, to_attr):
+def get_prefetcher(obj_list, through_attr, to_attr, plan=None):
     """
     For the attribute *through_attr* on the given instance, finds
-    an object that has a ``get_prefetch_queryset()``.
+    an object that has a ``get_prefetch_queryset()``.  *plan* is the
+    :class:`~django_prefetch_utils.identity_map.plans.LevelPlan` for the
+    attribute, which is looked up if it isn't given.
 
     Returns a 4 tuple containing:
 
@@ -56,17 +54,16 @@ def get_prefetcher(obj_list, through_attr, to_attr):
     prefetcher = None
     needs_fetching = obj_list
 
-    # For singly related objects, we have to avoid getting the attribute
-    # from the object, as this will trigger the query. So we first try
-    # on the class, in order to get the descriptor object.
-    rel_obj_descriptor = getattr(instance.__class__, through_attr, None)
+    # The class-level information about the attribute is cached; see
+    # :class:`django_prefetch_utils.identity_map.plans.LevelPlan`.
+    if plan is None:
+        plan = get_level_plan(instance.__class__, through_attr, to_attr)
+    rel_obj_descriptor = plan.descriptor
     if rel_obj_descriptor is None:
         attr_found = hasattr(instance, through_attr)
     else:
         attr_found = True
-        # singly related object, descriptor object has the
-        # get_prefetch_queryset() method.
-        if hasattr(rel_obj_descriptor, "get_prefetch_queryset"):
+        if plan.is_prefetcher:
             prefetcher = rel_obj_descriptor
             needs_fetching = [obj for obj in obj_list if not rel_obj_descriptor.is_cached(obj)]
         else:
@@ -79,7 +76,7 @@ def get_prefetcher(obj_list, through_attr, to_attr):
             if through_attr != to_attr:
                 # Special case cached_property instances because hasattr
                 # triggers attribute computation and assignment.
-                if isinstance(getattr(instance.__class__, to_attr, None), cached_property):
+                if plan.to_attr_is_cached_property:
                     needs_fetching = [obj for obj in obj_list if to_attr not in obj.__dict__]
                 else:
                     needs_fetching = [obj for obj in obj_list if not hasattr(obj, to_attr)]
@@ -134,10 +131,23 @@ def get_default_prefetch_identity_map():
     return PrefetchIdentityMap()
 
 
+def get_transient_prefetch_identity_map():
+    """
+    Returns an empty identity map for use during a single call to
+    ``prefetch_related_objects``.  Since the identity map is discarded
+    afterwards, it holds strong references to the instances, which
+    is faster than the weak references used by
+    :func:`get_default_prefetch_identity_map`.
+
+    :rtype: :class:`django_prefetch_utils.identity_map.maps.StrongPrefetchIdentityMap`
+    """
+    return StrongPrefetchIdentityMap()
+
+
 def prefetch_related_objects(*args, **kwargs):
     """
     Calls :func:`prefetch_related_objects_impl` with a new identity map
-    from :func:`get_default_prefetch_identity_map`::
+    from :func:`get_transient_prefetch_identity_map`::
 
         >>> from django_prefetch_utils.identity_map import prefetch_related_objects
         >>> dogs = list(Dogs.objectss.all())
@@ -151,7 +161,7 @@ def prefetch_related_objects(*args, **kwargs):
        :func:`django_prefetch_utils.identity_map.persistent.use_persistent_prefetch_identity_map`
 
     """
-    return prefetch_related_objects_impl(get_default_prefetch_identity_map(), *args, **kwargs)
+    return prefetch_related_objects_impl(get_transient_prefetch_identity_map(), *args, **kwargs)
 
 
 def use_prefetch_identity_map():
@@ -170,6 +180,90 @@ def use_prefetch_identity_map():
     return override_prefetch_related_objects(prefetch_related_objects)
 
 
+def concurrent_prefetch_related_objects(*args, **kwargs):
+    """
+    Calls :func:`concurrent_prefetch_related_objects_impl` with a new
+    identity map from :func:`get_transient_prefetch_identity_map`::
+
+        >>> from django_prefetch_utils.identity_map import concurrent_prefetch_related_objects
+        >>> dogs = list(Dogs.objects.all())
+        >>> concurrent_prefetch_related_objects(dogs, 'toys', 'owner', 'vet_visits')
+    """
+    return concurrent_prefetch_related_objects_impl(get_transient_prefetch_identity_map(), *args, **kwargs)
+
+
+def use_concurrent_prefetch_identity_map():
+    """
+    A context decorator which enables the concurrent identity map version
+    of ``prefetch_related_objects``::
+
+        with use_concurrent_prefetch_identity_map():
+            dogs = list(Dogs.objects.prefetch_related('toys', 'owner'))
+
+    .. note::
+
+       A new identity map is created and used for each call of
+       ``prefetched_related_objects``.
+    """
+    return override_prefetch_related_objects(concurrent_prefetch_related_objects)
+
+
+def concurrent_prefetch_related_objects_impl(identity_map, model_instances, *related_lookups):
+    """
+    A version of :func:`prefetch_related_objects_impl` which prefetches
+    independent top-level lookups at the same time in separate threads,
+    each using its own database connection.  The threads share
+    *identity_map*.
+
+    See :mod:`django_prefetch_utils.concurrent` for how the lookups are
+    split up.  If there is only one independent group of lookups, or if
+    a transaction is active on the instances' database, then all of the
+    lookups are prefetched in the current thread.
+    """
+    if not model_instances:
+        return  # nothing to do
+
+    identity_map = LockingIdentityMap(identity_map)
+    model_instances = [identity_map[instance] for instance in model_instances]
+
+    groups, remaining = get_independent_lookup_groups(type(model_instances[0]), related_lookups)
+    if len(groups) > 1 and can_prefetch_concurrently(model_instances) and prepare_instances(model_instances):
+        run_concurrently(
+            [partial(prefetch_related_objects_impl, identity_map, model_instances, *group) for group in groups]
+        )
+        related_lookups = remaining
+
+    prefetch_related_objects_impl(identity_map, model_instances, *related_lookups)
+
+
+async def aprefetch_related_objects(*args, **kwargs):
+    """
+    Awaits :func:`aprefetch_related_objects_impl` with a new identity map
+    from :func:`get_transient_prefetch_identity_map`::
+
+        >>> from django_prefetch_utils.identity_map import aprefetch_related_objects
+        >>> await aprefetch_related_objects(dogs, 'toys', 'owner', 'vet_visits')
+    """
+    return await aprefetch_related_objects_impl(get_transient_prefetch_identity_map(), *args, **kwargs)
+
+
+async def aprefetch_related_objects_impl(identity_map, model_instances, *related_lookups):
+    """
+    An asynchronous version of :func:`prefetch_related_objects_impl`.
+
+    The queries are run in worker threads rather than in the event
+    loop's thread, with independent top-level lookups being
+    prefetched at the same time as in
+    :func:`concurrent_prefetch_related_objects_impl`.
+    """
+    if not model_instances:
+        return  # nothing to do
+
+    identity_map = LockingIdentityMap(identity_map)
+    model_instances = [identity_map[instance] for instance in model_instances]
+    await aprefetch_concurrently(partial(prefetch_related_objects_impl, identity_map), model_instances, related_lookups)
+
+
 def prefetch_related_objects_impl(identity_map, model_instances, *related_lookups):
     """
     An implementation of ``prefetch_related_objects`` which makes use
@@ -189,7 +283,7 @@ def prefetch_related_objects_impl(identity_map, model_instances, *related_lookup
 
     auto_lookups = set()  # we add to this as we go through.
 
-    all_lookups = normalize_prefetch_lookups(reversed(related_lookups))
+    all_lookups = prefetch_plan_cache.get_lookups(type(model_instances[0]), related_lookups)
 
     def add_additional_lookups_from_queryset(prefix, queryset_or_lookups):
         if isinstance(queryset_or_lookups, (list, tuple)):
@@ -222,7 +316,7 @@ def prefetch_related_objects_impl(identity_map, model_instances, *related_lookup
         # from the primary QuerySet. It won't be for deeper levels.
         obj_list = model_instances
 
-        through_attrs = lookup.prefetch_through.split(LOOKUP_SEP)
+        through_attrs = get_through_attrs(lookup)
         for level, through_attr in enumerate(through_attrs):
             # Prepare main instances
             if not obj_list:
@@ -260,8 +354,17 @@ def prefetch_related_objects_impl(identity_map, model_instances, *related_lookup
             # of prefetch_related), so what applies to first object applies to all.
             first_obj = obj_list[0]
             to_attr = lookup.get_current_to_attr(level)[0]
-            prefetcher, descriptor, attr_found, needs_fetching = get_prefetcher(obj_list, through_attr, to_attr)
-            prefetcher = get_identity_map_prefetcher(identity_map, descriptor, prefetcher)
+            plan = get_level_plan(type(first_obj), through_attr, to_attr)
+            prefetcher, descriptor, attr_found, needs_fetching = get_prefetcher(obj_list, through_attr, to_attr, plan)
+            # Values are not model instances, so the identity map is not used
+            # for them.
+            values_prefetcher = get_values_prefetcher(prefetcher, lookup, level)
+            if values_prefetcher is not None:
+                prefetcher = values_prefetcher
+            else:
+                prefetcher = get_identity_map_prefetcher(identity_map, descriptor, prefetcher, plan.wrapper_class)
+                prefetcher = get_two_phase_prefetcher(identity_map, prefetcher, lookup, level)
+                prefetcher = get_caching_prefetcher(identity_map, prefetcher, type(first_obj), through_attr)
 
             if not attr_found:
                 raise AttributeError(
@@ -282,7 +385,9 @@ def prefetch_related_objects_impl(identity_map, model_instances, *related_lookup
                 )
 
             if prefetcher is not None and needs_fetching:
+                prefetcher = get_chunked_prefetcher(prefetcher, lookup, needs_fetching)
                 new_obj_list, additional_lookups = prefetch_one_level(needs_fetching, prefetcher, lookup, level)
+                register_deferred_siblings(new_obj_list)
                 obj_list = get_prefetched_objects_from_list(obj_list, to_attr)
                 done_queries[prefetch_to] = obj_list
                 add_additional_lookups_from_queryset(prefetch_to, additional_lookups)
@@ -0,0 +1,291 @@
+"""
+This module provides a shared cache of the related rows fetched by the
+identity map version of ``prefetch_related_objects`` for relations
+which change slowly, such as a product's tags or a plan's features::
+
+    from django_prefetch_utils.identity_map.cache import cache_prefetched_relation
+
+    cache_prefetched_relation(Product, "tags", timeout=600)
+
+Once a relation is registered, the related rows for each instance are
+stored in a Django cache, keyed by the value that the related rows are
+joined on (for example, the product's primary key).  Later prefetches
+of the relation only query the database for the instances whose rows
+are not in the cache.  The rows are stored as field values and model
+instances are rebuilt from them with ``Model.from_db``, so the cache
+must not be shared with code running a different version of the model.
+
+Rows are only cached when no custom queryset is given for the
+relation, and when the relation's default queryset does not use
+``select_related``, annotations, deferred fields or
+``prefetch_related``.
+
+A cached relation takes precedence over fetching in two phases (see
+:mod:`django_prefetch_utils.identity_map.two_phase`): the rows are
+served from the cache where possible, and two phases are only used to
+fetch the rows for the instances which are not in it.
+
+By default, all of the cached rows for a relation are invalidated when
+an instance of the related model (or the relation's ``through`` model)
+is saved or deleted, or when the many-to-many relation is changed.
+This can be changed for each relation by passing the models to watch
+as *invalidate_on*; passing an empty list means rows are only expired
+by their timeout.  Changes made with ``QuerySet.update()`` or
+``QuerySet.delete()`` do not send these signals, so
+:meth:`CachedRelation.invalidate` should be called after them.
+
+The cache used can be set with the ``PREFETCH_UTILS_PREFETCH_CACHE``
+setting, which defaults to ``"default"``.
+"""
+import hashlib
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+from django.db.models.fields.related_descriptors import ManyToManyDescriptor
+from django.db.models.fields.related_descriptors import ReverseManyToOneDescriptor
+from django.db.models.fields.related_descriptors import ReverseOneToOneDescriptor
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+from .wrappers import IdentityMapObjectProxy
+
+DEFAULT_CACHE_ALIAS = "default"
+
+KEY_PREFIX = "prefetch_utils"
+
+_registry = {}
+
+_registry_lock = threading.Lock()
+
+
+def get_related_models(model, attname):
+    """
+    Returns the models whose changes can affect the rows prefetched for
+    *attname* on *model*: the related model, and the ``through`` model
+    for many-to-many relations.
+
+    :rtype: list
+    """
+    descriptor = getattr(model, attname, None)
+    if isinstance(descriptor, ForwardManyToOneDescriptor):
+        return [descriptor.field.related_model]
+    if isinstance(descriptor, ReverseOneToOneDescriptor):
+        return [descriptor.related.related_model]
+    if isinstance(descriptor, ManyToManyDescriptor):
+        related_model = descriptor.rel.related_model if descriptor.reverse else descriptor.rel.model
+        return [related_model, descriptor.rel.through]
+    if isinstance(descriptor, ReverseManyToOneDescriptor):
+        return [descriptor.rel.related_model]
+    raise ValueError(
+        "Cannot determine the related models for '%s' on %s; pass invalidate_on explicitly." % (attname, model.__name__)
+    )
+
+
+class CachedRelation(object):
+    """
+    The cache configuration for prefetching *attname* on instances of
+    *model*.
+    """
+
+    def __init__(self, model, attname, timeout=DEFAULT_TIMEOUT, invalidate_on=None, cache_alias=None):
+        self.model = model
+        self.attname = attname
+        self.timeout = timeout
+        if invalidate_on is None:
+            invalidate_on = get_related_models(model, attname)
+        self.invalidate_on = list(invalidate_on)
+        self._cache_alias = cache_alias
+        self.label = "%s.%s" % (model._meta.label_lower, attname)
+
+    @property
+    def cache(self):
+        alias = self._cache_alias or getattr(settings, "PREFETCH_UTILS_PREFETCH_CACHE", DEFAULT_CACHE_ALIAS)
+        return caches[alias]
+
+    @property
+    def version_key(self):
+        return "%s:%s:version" % (KEY_PREFIX, self.label)
+
+    def get_version(self):
+        """
+        Returns the current version of the rows cached for this relation.
+        """
+        cache = self.cache
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, 1, None)
+            version = cache.get(self.version_key, 1)
+        return version
+
+    def invalidate(self):
+        """
+        Invalidates all of the rows cached for this relation.
+        """
+        cache = self.cache
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.add(self.version_key, 2, None)
+
+    def make_key(self, version, db, join_key):
+        digest = hashlib.md5(repr(join_key).encode("utf-8")).hexdigest()
+        return "%s:%s:%s:%s:%s" % (KEY_PREFIX, self.label, version, db, digest)
+
+    def get_many(self, db, join_keys):
+        """
+        Returns a dictionary mapping the join keys in *join_keys* which
+        are in the cache to the list of field values for their rows, along
+        with the version of the cache used.
+        """
+        version = self.get_version()
+        cache_keys = {self.make_key(version, db, join_key): join_key for join_key in join_keys}
+        found = self.cache.get_many(list(cache_keys))
+        return {cache_keys[cache_key]: rows for cache_key, rows in found.items()}, version
+
+    def set_many(self, version, db, rows_by_join_key):
+        self.cache.set_many(
+            {self.make_key(version, db, join_key): rows for join_key, rows in rows_by_join_key.items()},
+            timeout=self.timeout,
+        )
+
+
+def cache_prefetched_relation(model, attname, timeout=DEFAULT_TIMEOUT, invalidate_on=None, cache_alias=None):
+    """
+    Registers *attname* on *model* so that the rows prefetched for it are
+    cached for *timeout* seconds.  If *invalidate_on* is given, it is the
+    list of models whose changes invalidate the cached rows; otherwise,
+    the related model (and ``through`` model) are used.
+
+    :rtype: :class:`CachedRelation`
+    """
+    relation = CachedRelation(model, attname, timeout=timeout, invalidate_on=invalidate_on, cache_alias=cache_alias)
+    with _registry_lock:
+        _registry[(model, attname)] = relation
+    for sender in relation.invalidate_on:
+        post_save.connect(invalidate_cached_relations, sender=sender, weak=False, dispatch_uid=__name__)
+        post_delete.connect(invalidate_cached_relations, sender=sender, weak=False, dispatch_uid=__name__)
+        m2m_changed.connect(invalidate_cached_relations, sender=sender, weak=False, dispatch_uid=__name__)
+    return relation
+
+
+def uncache_prefetched_relation(model, attname):
+    """
+    Stops caching the rows prefetched for *attname* on *model*.
+    """
+    with _registry_lock:
+        _registry.pop((model, attname), None)
+
+
+def get_cached_relation(model, attname):
+    """
+    Returns the :class:`CachedRelation` for *attname* on *model* if it
+    has been registered with :func:`cache_prefetched_relation`.
+    Otherwise, ``None`` is returned.
+    """
+    if not _registry:
+        return None
+    return _registry.get((model, attname))
+
+
+def invalidate_cached_relations(sender, action=None, **kwargs):
+    """
+    A signal receiver which invalidates the cached rows for all of the
+    relations which are invalidated by changes to *sender*.
+    """
+    if action is not None and not action.startswith("post_"):
+        return
+    for relation in list(_registry.values()):
+        if sender in relation.invalidate_on:
+            relation.invalidate()
+
+
+def is_cacheable_queryset(queryset):
+    """
+    Returns ``True`` if model instances fetched by *queryset* can be
+    rebuilt from the values of their concrete fields.
+    """
+    query = getattr(queryset, "query", None)
+    if query is None or getattr(queryset, "_prefetch_related_lookups", ()):
+        return False
+    if query.select_related or query.annotations:
+        return False
+    return query.deferred_loading == (frozenset(), True)
+
+
+def get_caching_prefetcher(identity_map, prefetcher, model, attname):
+    """
+    Returns *prefetcher* wrapped in a :class:`CachingPrefetcher` if
+    *attname* on *model* has been registered with
+    :func:`cache_prefetched_relation`.  Otherwise, *prefetcher* is
+    returned unchanged.
+    """
+    if prefetcher is None:
+        return None
+    relation = get_cached_relation(model, attname)
+    if relation is None:
+        return prefetcher
+    return CachingPrefetcher(identity_map, relation, prefetcher)
+
+
+class CachingPrefetcher(IdentityMapObjectProxy):
+    """
+    A wrapper for an identity map prefetcher which serves the related
+    rows for a :class:`CachedRelation` from its cache where possible.
+    """
+
+    __slots__ = ("_self_relation",)
+
+    def __init__(self, identity_map, relation, wrapped):
+        super().__init__(identity_map, wrapped)
+        self._self_relation = relation
+
+    def get_prefetch_queryset(self, instances, queryset=None):
+        # When the wrapped prefetcher is a TwoPhasePrefetcher, its related
+        # objects are only fetched when they are iterated over, so the
+        # cached rows still take precedence and two phases are only used
+        # for the instances whose rows aren't cached.
+        prefetch_data = self.__wrapped__.get_prefetch_queryset(instances, queryset)
+        rel_qs, rel_obj_attr, instance_attr = prefetch_data[:3]
+        if queryset is not None or not is_cacheable_queryset(rel_qs):
+            return prefetch_data
+
+        relation = self._self_relation
+        db = instances[0]._state.db
+        join_keys = {instance_attr(instance) for instance in instances}
+        join_keys = {join_key for join_key in join_keys if None not in join_key}
+        cached, version = relation.get_many(db, join_keys)
+
+        model = rel_qs.model
+        attnames = [field.attname for field in model._meta.concrete_fields]
+        related_objects = []
+        memo = {}
+
+        def add(rel_obj, join_key):
+            related_objects.append(rel_obj)
+            memo.setdefault(rel_obj, deque()).append(join_key)
+
+        for join_key, rows in cached.items():
+            for values in rows:
+                add(self._self_identity_map[model.from_db(db, attnames, values)], join_key)
+
+        missing_keys = join_keys - cached.keys()
+        missing = [instance for instance in instances if instance_attr(instance) in missing_keys]
+        if missing:
+            if len(missing) != len(instances):
+                rel_qs, rel_obj_attr = self.__wrapped__.get_prefetch_queryset(missing)[:2]
+            fetched = {instance_attr(instance): [] for instance in missing}
+            for rel_obj in rel_qs:
+                join_key = rel_obj_attr(rel_obj)
+                add(rel_obj, join_key)
+                fetched.setdefault(join_key, []).append(tuple(getattr(rel_obj, name) for name in attnames))
+            relation.set_many(version, db, fetched)
+
+        def cached_rel_obj_attr(rel_obj):
+            return memo[rel_obj].popleft()
+
+        return (related_objects, cached_rel_obj_attr) + prefetch_data[2:]
@@ -0,0 +1,74 @@
+"""
+This module provides batched loading of deferred fields for the
+instances in a persistent identity map, which can be enabled with the
+*batch_deferred_fields* argument to
+:class:`django_prefetch_utils.identity_map.persistent.use_persistent_prefetch_identity_map`::
+
+    with use_persistent_prefetch_identity_map(batch_deferred_fields=True):
+        for dog in Dog.objects.only("id"):
+            print(dog.name)  # only one query for all of the names
+
+Normally, the first access of a deferred field on an instance runs a
+query to load it for just that instance.  While batching is enabled,
+the first access of a deferred field on an instance in the identity map
+instead loads that field for all of the instances of the same model in
+the identity map which have it deferred, with a query for each chunk of
+their primary keys.
+"""
+import threading
+from contextvars import ContextVar
+
+from django_prefetch_utils.deferred import add_deferred_field_hook
+from django_prefetch_utils.deferred import load_deferred_field
+from django_prefetch_utils.deferred import remove_deferred_field_hook
+
+_identity_map = ContextVar("prefetch_batched_deferred_identity_map", default=None)
+
+# The deferred field hook is only installed while batching is enabled in
+# at least one context.
+_enabled_lock = threading.Lock()
+_enabled_count = 0
+
+
+def enable_batched_deferred_loading(identity_map):
+    """
+    Enables batched loading of deferred fields for the instances in
+    *identity_map* in the current context, returning a token which can
+    be passed to :func:`reset_batched_deferred_loading`.
+    """
+    global _enabled_count
+    with _enabled_lock:
+        if not _enabled_count:
+            add_deferred_field_hook(load_identity_map_siblings)
+        _enabled_count += 1
+    return _identity_map.set(identity_map)
+
+
+def reset_batched_deferred_loading(token):
+    """
+    Restores the batched loading of deferred fields to what it was
+    before the call to :func:`enable_batched_deferred_loading` which
+    returned *token*.
+    """
+    global _enabled_count
+    _identity_map.reset(token)
+    with _enabled_lock:
+        _enabled_count -= 1
+        if not _enabled_count:
+            remove_deferred_field_hook(load_identity_map_siblings)
+
+
+def load_identity_map_siblings(instance, attname):
+    """
+    A deferred field hook which loads *attname* for all of the instances
+    of the same model as *instance* in the identity map for the current
+    context, if *instance* is in it.
+    """
+    identity_map = _identity_map.get()
+    if identity_map is None:
+        return
+
+    sub_identity_map = identity_map.get_map_for_model(type(instance))
+    mapped = sub_identity_map.get(instance.pk)
+    if mapped is not None and mapped.__dict__ is instance.__dict__:
+        load_deferred_field(list(sub_identity_map.values()), attname, instance)
@@ -0,0 +1,77 @@
+"""
+This module provides :class:`GenericPrefetch`, a backport of the lookup
+added in Django 5.0 which allows a different queryset to be used for
+each of the models that a ``GenericForeignKey`` can point to::
+
+    from django_prefetch_utils.identity_map.generic import GenericPrefetch
+
+    TaggedItem.objects.prefetch_related(
+        GenericPrefetch(
+            "content_object",
+            [
+                Bookmark.objects.prefetch_related("tags"),
+                Person.objects.select_related("house"),
+            ],
+        )
+    )
+
+The querysets can also be given as a dictionary mapping each model to
+its queryset.  Related objects of models without a queryset are fetched
+as usual.  The related objects for models with a queryset are always
+fetched with it, even if they are already in the identity map, so that
+its filters, ``select_related`` and ``prefetch_related`` lookups are
+applied to them.
+
+:class:`GenericPrefetch` is only supported by the identity map
+implementation of ``prefetch_related_objects``.
+"""
+from django.db.models import Prefetch
+from django.db.models.query import ModelIterable
+from django.db.models.query import RawQuerySet
+
+
+class GenericQuerySets(dict):
+    """
+    A dictionary mapping models to the querysets used to fetch their
+    instances for a :class:`GenericPrefetch`.  It is what is passed as
+    the *queryset* to the ``get_prefetch_queryset`` method of the
+    ``GenericForeignKey``.
+    """
+
+    @classmethod
+    def from_querysets(cls, querysets):
+        """
+        Returns a :class:`GenericQuerySets` for *querysets*, which is
+        either a list of querysets or a dictionary mapping models to
+        querysets.
+
+        :rtype: :class:`GenericQuerySets`
+        """
+        if not hasattr(querysets, "items"):
+            querysets = {queryset.model: queryset for queryset in querysets}
+
+        for model, queryset in querysets.items():
+            if isinstance(queryset, RawQuerySet) or (
+                hasattr(queryset, "_iterable_class") and not issubclass(queryset._iterable_class, ModelIterable)
+            ):
+                raise ValueError("Prefetch querysets cannot use raw(), values(), and values_list().")
+            if queryset.model is not model:
+                raise ValueError("The queryset for %s is for %s." % (model.__name__, queryset.model.__name__))
+        return cls(querysets)
+
+
+class GenericPrefetch(Prefetch):
+    """
+    A :class:`django.db.models.Prefetch` for a ``GenericForeignKey``
+    which fetches the instances of each model in *querysets* with the
+    queryset given for it.
+    """
+
+    def __init__(self, lookup, querysets, to_attr=None):
+        super().__init__(lookup, to_attr=to_attr)
+        self.querysets = GenericQuerySets.from_querysets(querysets)
+
+    def get_current_queryset(self, level):
+        if self.get_current_prefetch_to(level) == self.prefetch_to:
+            return self.querysets
+        return None
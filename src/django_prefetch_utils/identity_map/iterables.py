@@ -0,0 +1,128 @@
+"""
+This module provides :class:`IdentityMapModelIterable`, a version of
+Django's ``ModelIterable`` which looks up the primary key of each row in
+an identity map before creating a model instance for it.  When the row
+is already in the identity map, the existing instance is used and only
+the annotation and ``extra`` columns from the row are set on it, along
+with any of its deferred fields which the row has loaded.  This avoids
+the cost of ``Model.from_db`` for rows which are fetched many times.
+
+Rows for querysets which use ``select_related`` are always turned into
+model instances, since the related objects are merged from them.
+"""
+import operator
+
+from django.db.models.query import ModelIterable
+from django.db.models.query import get_related_populators
+from django.db.models.sql.constants import GET_ITERATOR_CHUNK_SIZE
+
+
+def can_use_identity_map_iterable(queryset):
+    """
+    Returns ``True`` if the rows of *queryset* can be fetched with
+    :class:`IdentityMapModelIterable`.
+    """
+    return getattr(queryset, "_iterable_class", None) is ModelIterable and queryset._result_cache is None
+
+
+def iter_identity_mapped(identity_map, queryset):
+    """
+    Returns an iterable of the objects in *queryset* with *identity_map*
+    applied to them, using :class:`IdentityMapModelIterable` when
+    possible.
+    """
+    if can_use_identity_map_iterable(queryset):
+        return IdentityMapModelIterable(identity_map, queryset)
+    return (identity_map[obj] for obj in queryset)
+
+
+def fill_deferred_values(obj, attnames, values):
+    """
+    Sets the values for the fields in *attnames* which are deferred on
+    *obj* from *values*.
+    """
+    obj_dict = obj.__dict__
+    for attname, value in zip(attnames, values):
+        if attname not in obj_dict:
+            obj_dict[attname] = value
+
+
+class IdentityMapModelIterable(ModelIterable):
+    """
+    An iterable which yields a model instance for each row of a queryset
+    with *identity_map* applied to it.
+    """
+
+    def __init__(self, identity_map, queryset, chunked_fetch=False, chunk_size=GET_ITERATOR_CHUNK_SIZE):
+        super().__init__(queryset, chunked_fetch=chunked_fetch, chunk_size=chunk_size)
+        self.identity_map = identity_map
+
+    def __iter__(self):
+        identity_map = self.identity_map
+        queryset = self.queryset
+        db = queryset.db
+        compiler = queryset.query.get_compiler(using=db)
+        results = compiler.execute_sql(chunked_fetch=self.chunked_fetch, chunk_size=self.chunk_size)
+        select, klass_info, annotation_col_map = (
+            compiler.select,
+            compiler.klass_info,
+            compiler.annotation_col_map,
+        )
+        model_cls = klass_info["model"]
+        select_fields = klass_info["select_fields"]
+        model_fields_start, model_fields_end = select_fields[0], select_fields[-1] + 1
+        init_list = [f[0].target.attname for f in select[model_fields_start:model_fields_end]]
+        related_populators = get_related_populators(klass_info, select, db)
+        known_related_objects = [
+            (
+                field,
+                related_objs,
+                operator.attrgetter(
+                    *[
+                        field.attname if from_field == "self" else queryset.model._meta.get_field(from_field).attname
+                        for from_field in field.from_fields
+                    ]
+                ),
+            )
+            for field, related_objs in queryset._known_related_objects.items()
+        ]
+
+        # The instances for rows which are already in the identity map are
+        # only reused when there are no related objects to merge from them.
+        pk_attname = model_cls._meta.pk.attname
+        if related_populators or pk_attname not in init_list:
+            sub_identity_map = {}
+        else:
+            sub_identity_map = identity_map.get_map_for_model(model_cls)
+        pk_index = model_fields_start + init_list.index(pk_attname) if pk_attname in init_list else None
+        init_attnames = frozenset(init_list)
+
+        for row in compiler.results_iter(results):
+            obj = sub_identity_map.get(row[pk_index]) if sub_identity_map else None
+            if obj is not None:
+                if type(obj) is not model_cls:
+                    obj = identity_map.cast(obj, model_cls)
+                if not obj.__dict__.keys() >= init_attnames:
+                    fill_deferred_values(obj, init_list, row[model_fields_start:model_fields_end])
+            else:
+                obj = model_cls.from_db(db, init_list, row[model_fields_start:model_fields_end])
+                for rel_populator in related_populators:
+                    rel_populator.populate(row, obj)
+            if annotation_col_map:
+                for attr_name, col_pos in annotation_col_map.items():
+                    setattr(obj, attr_name, row[col_pos])
+
+            # Add the known related objects to the model.
+            for field, rel_objs, rel_getter in known_related_objects:
+                # Avoid overwriting objects loaded by, e.g., select_related().
+                if field.is_cached(obj):
+                    continue
+                rel_obj_id = rel_getter(obj)
+                try:
+                    rel_obj = rel_objs[rel_obj_id]
+                except KeyError:
+                    pass  # May happen in qs1 | qs2 scenarios.
+                else:
+                    setattr(obj, field.name, rel_obj)
+
+            yield identity_map[obj]
@@ -0,0 +1,115 @@
+"""
+This module provides lazy loading of relations for all of the
+instances fetched by a queryset at the same time, which can be enabled
+with the *lazy_loading* argument to
+:class:`django_prefetch_utils.identity_map.persistent.use_persistent_prefetch_identity_map`::
+
+    with use_persistent_prefetch_identity_map(lazy_loading=True):
+        for dog in Dog.objects.all():
+            print(dog.owner.name)  # only one query for all of the owners
+
+Each instance fetched by a queryset while lazy loading is enabled keeps
+a reference to a :class:`~django_prefetch_utils.siblings.SiblingSet` of
+the other instances from the same results.  The first time a relation
+is loaded for one of those instances, it is prefetched for all of the
+instances in the set which are still alive.
+"""
+import threading
+from contextvars import ContextVar
+
+from django_prefetch_utils.concurrent import is_prefetchable_descriptor
+from django_prefetch_utils.relation_access import add_relation_access_hook
+from django_prefetch_utils.relation_access import remove_relation_access_hook
+from django_prefetch_utils.selector import get_prefetch_related_objects
+from django_prefetch_utils.siblings import SiblingSet
+
+SIBLING_SET_ATTR = "_prefetch_sibling_set"
+
+_enabled = ContextVar("prefetch_lazy_loading", default=False)
+_loading = ContextVar("prefetch_lazy_loading_in_progress", default=False)
+
+# The relation access hook is only installed while lazy loading is
+# enabled in at least one context.
+_enabled_lock = threading.Lock()
+_enabled_count = 0
+
+
+def is_lazy_loading_enabled():
+    """
+    Returns ``True`` if lazy loading is enabled in the current context.
+
+    :rtype: bool
+    """
+    return _enabled.get()
+
+
+def enable_lazy_loading():
+    """
+    Enables lazy loading in the current context, returning a token
+    which can be passed to :func:`reset_lazy_loading`.
+    """
+    global _enabled_count
+    with _enabled_lock:
+        if not _enabled_count:
+            add_relation_access_hook(load_siblings)
+        _enabled_count += 1
+    return _enabled.set(True)
+
+
+def reset_lazy_loading(token):
+    """
+    Restores whether lazy loading was enabled before the call to
+    :func:`enable_lazy_loading` which returned *token*.
+    """
+    global _enabled_count
+    _enabled.reset(token)
+    with _enabled_lock:
+        _enabled_count -= 1
+        if not _enabled_count:
+            remove_relation_access_hook(load_siblings)
+
+
+def register_siblings(instances):
+    """
+    Records that *instances* were fetched together so that relations
+    accessed on any of them are loaded for all of them.
+    """
+    if len(instances) <= 1:
+        return
+
+    try:
+        sibling_set = SiblingSet(instances)
+        for obj in instances:
+            obj.__dict__[SIBLING_SET_ATTR] = sibling_set
+    except (AttributeError, TypeError):
+        # The results are not model instances; for example, from
+        # values() or values_list().
+        return
+
+
+def load_siblings(instance, attname):
+    """
+    A relation access hook which prefetches *attname* for all of the
+    siblings of *instance* when lazy loading is enabled.
+    """
+    if not _enabled.get() or _loading.get():
+        return
+
+    sibling_set = getattr(instance, "__dict__", {}).get(SIBLING_SET_ATTR)
+    if sibling_set is None:
+        return
+
+    # If the relation can't be prefetched, then it will just be loaded
+    # for this instance as usual.
+    if not is_prefetchable_descriptor(getattr(type(instance), attname, None)):
+        return
+
+    siblings = sibling_set.get_instances()
+    if len(siblings) <= 1:
+        return
+
+    token = _loading.set(True)
+    try:
+        get_prefetch_related_objects()(siblings, attname)
+    finally:
+        _loading.reset(token)
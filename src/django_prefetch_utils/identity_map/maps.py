@@ -1,7 +1,202 @@
+import threading
+from collections import OrderedDict
 from collections import defaultdict
+from collections import namedtuple
+from weakref import WeakSet
 from weakref import WeakValueDictionary
 
 import wrapt
+from django.conf import settings
+from django.db.models.signals import post_save
+
+DEFAULT = object()
+
+DEFAULT_IDENTITY_MAP_MAXSIZE = 100000
+
+_all_missing_keys = WeakSet()
+
+_concrete_attnames = {}
+
+
+def get_concrete_model(model):
+    """
+    Returns the model which instances of *model* are keyed on in an
+    identity map.  Proxy models share the map of their concrete model,
+    while the children in multi-table inheritance have their own.  Any
+    other type is returned unchanged.
+    """
+    meta = getattr(model, "_meta", None)
+    if meta is None:
+        return model
+    return meta.concrete_model
+
+
+def get_concrete_attnames(model):
+    """
+    Returns a :class:`frozenset` of the attribute names of the concrete
+    fields of *model*.
+    """
+    attnames = _concrete_attnames.get(model)
+    if attnames is None:
+        attnames = _concrete_attnames[model] = frozenset(field.attname for field in model._meta.concrete_fields)
+    return attnames
+
+
+def fill_deferred_fields(target, source):
+    """
+    Copies the values of the fields which are deferred on *target* but
+    were loaded on *source*, an instance fetched for the same row.
+    Returns ``True`` if any values were copied.
+
+    :rtype: bool
+    """
+    target_dict = target.__dict__
+    attnames = get_concrete_attnames(type(target))
+    if target_dict.keys() >= attnames:
+        return False
+
+    source_dict = source.__dict__
+    filled = False
+    for attname in attnames - target_dict.keys():
+        if attname in source_dict:
+            target_dict[attname] = source_dict[attname]
+            filled = True
+    return filled
+
+
+def cast_instance(views, obj, model):
+    """
+    Returns *obj* as an instance of *model*, which has the same concrete
+    model as it.  When *obj* is an instance of another proxy of that
+    model, a new instance of *model* which shares its ``__dict__`` with
+    *obj* is created, so that the field values and caches set on either
+    are seen by both.  It is kept in *views* so that the same instance
+    is returned as long as *obj* is.
+    """
+    if type(obj) is model:
+        return obj
+    key = (model, obj.pk)
+    view = views.get(key)
+    if view is None or view.__dict__ is not obj.__dict__:
+        view = model.__new__(model)
+        view.__dict__ = obj.__dict__
+        views[key] = view
+    return view
+
+
+class RelationSets(object):
+    """
+    A record of the instances in *identity_map* whose related objects
+    for a relation have all been fetched, along with the primary keys of
+    those related objects.
+
+    The related objects are looked up in *identity_map* when they are
+    needed, so a record is ignored once any of them are no longer in it.
+    """
+
+    def __init__(self, identity_map):
+        self._identity_map = identity_map
+        self._sets = {}
+
+    def __len__(self):
+        return sum(len(sets) for sets in self._sets.values())
+
+    def get(self, instance, relation_key):
+        """
+        Returns the list of related objects for *relation_key* on
+        *instance* if they were all fetched and are still in the identity
+        map.  Otherwise, ``None`` is returned.
+        """
+        try:
+            related = self._sets[(get_concrete_model(type(instance)), instance.pk)][relation_key]
+        except KeyError:
+            return None
+
+        rel_objs = []
+        for model, pk in related:
+            rel_obj = self._identity_map.get_map_for_model(model).get(pk)
+            if rel_obj is None:
+                return None
+            if type(rel_obj) is not model:
+                rel_obj = self._identity_map.cast(rel_obj, model)
+            rel_objs.append(rel_obj)
+        return rel_objs
+
+    def set(self, instance, relation_key, rel_objs):
+        """
+        Records that *rel_objs* are all of the related objects for
+        *relation_key* on *instance*.
+        """
+        sets = self._sets.setdefault((get_concrete_model(type(instance)), instance.pk), {})
+        sets[relation_key] = tuple((type(obj), obj.pk) for obj in rel_objs)
+
+    def discard(self, model, pk, cache_name=None):
+        """
+        Discards the records for the instance of *model* with primary key
+        *pk* for the relation *cache_name*, or for all of its relations
+        if *cache_name* is ``None``.
+        """
+        key = (get_concrete_model(model), pk)
+        if cache_name is None:
+            self._sets.pop(key, None)
+            return
+
+        sets = self._sets.get(key)
+        if sets:
+            for relation_key in [relation_key for relation_key in sets if relation_key[0] == cache_name]:
+                del sets[relation_key]
+
+    def clear(self):
+        self._sets.clear()
+
+
+class MissingKeys(object):
+    """
+    A record of the values which were looked up for a field of a model
+    and found not to belong to any of its rows.  All of the values for a
+    model are discarded when one of its instances is saved.
+    """
+
+    def __init__(self):
+        self._keys = defaultdict(set)
+        _all_missing_keys.add(self)
+        post_save.connect(discard_missing_keys, weak=False, dispatch_uid=__name__)
+
+    def __len__(self):
+        return sum(len(keys) for keys in self._keys.values())
+
+    def contains(self, model, attname, value):
+        """
+        Returns ``True`` if no instance of *model* has *value* for the
+        field *attname*.
+        """
+        keys = self._keys.get(model._meta.concrete_model)
+        return keys is not None and (attname, value) in keys
+
+    def add(self, model, attname, values):
+        """
+        Records that no instance of *model* has any of *values* for the
+        field *attname*.
+        """
+        keys = self._keys[model._meta.concrete_model]
+        keys.update((attname, value) for value in values if value is not None)
+
+    def discard_model(self, model):
+        self._keys.pop(model._meta.concrete_model, None)
+
+    def clear(self):
+        self._keys.clear()
+
+
+def discard_missing_keys(sender, **kwargs):
+    """
+    A signal receiver which discards the missing values for *sender* and
+    its parent models from every :class:`MissingKeys`.
+    """
+    models = [sender] + sender._meta.get_parent_list()
+    for missing_keys in list(_all_missing_keys):
+        for model in models:
+            missing_keys.discard_model(model)
 
 
 class PrefetchIdentityMap(defaultdict):
@@ -23,127 +218,592 @@ class PrefetchIdentityMap(defaultdict):
     It is implemented as a defaultdictionary whose keys correspond
     the to types of Django models and whose values are a
     :class:`weakref.WeakValueDictionary` mapping primary keys to the
-    associated Django model instance.
+    associated Django model instance.  Proxy models are keyed on their
+    concrete model, so an instance of a proxy model and an instance of
+    its concrete model with the same primary key are mapped to the same
+    row, with :meth:`cast` giving the instance for each class.  When an
+    instance with deferred fields is looked up with an instance which
+    has them loaded, their values are copied to it.
+
+    If *track_relations* is ``True``, then the identity map records
+    which instances have had all of their related objects for a reverse
+    foreign key or many-to-many relation fetched in its
+    :attr:`relation_sets`.  Later prefetches of the same relation with
+    the same queryset only query for the other instances.  Since the
+    records are not invalidated when related objects are added or
+    removed, this should only be enabled when that won't happen while
+    the identity map is in use.
+
+    If *track_missing* is ``True``, then the identity map records the
+    forward foreign key, reverse one-to-one and generic foreign key
+    values which were prefetched without finding a related object in
+    its :attr:`missing_keys`, so later prefetches don't query for them
+    again.  They are discarded when an instance of the related model is
+    saved, but not after ``QuerySet.update()`` or ``bulk_create()``.
     """
 
-    def __init__(self):
+    field_map_class = WeakValueDictionary
+
+    def __init__(self, track_relations=False, track_missing=False):
         super().__init__(WeakValueDictionary)
+        self._field_maps = {}
+        self._views = WeakValueDictionary()
+        self.relation_sets = RelationSets(self) if track_relations else None
+        self.missing_keys = MissingKeys() if track_missing else None
 
     def __getitem__(self, obj):
-        subdict = self.get_map_for_model(type(obj))
+        model = type(obj)
+        subdict = self.get_map_for_model(model)
 
         try:
             pk = obj.pk
         except AttributeError:
             return obj
 
-        return subdict.setdefault(pk, obj)
+        new_obj = subdict.setdefault(pk, obj)
+        if new_obj is obj:
+            if self._field_maps:
+                add_to_field_maps(self._field_maps.get(get_concrete_model(model)), obj)
+            return obj
+        if fill_deferred_fields(new_obj, obj) and self._field_maps:
+            add_to_field_maps(self._field_maps.get(get_concrete_model(model)), new_obj)
+        if type(new_obj) is not model:
+            return cast_instance(self._views, new_obj, model)
+        return new_obj
 
     def get_map_for_model(self, model):
         """
-        Returns the the underlying dictionary
+        Returns the the underlying dictionary for the concrete model of
+        *model*.  The instances in it may be of any proxy of that model.
 
         :rtype: :class:`weakref.WeakValueDictionary`
         """
-        return super().__getitem__(model)
+        return super().__getitem__(get_concrete_model(model))
+
+    def cast(self, obj, model):
+        """
+        Returns the instance in the identity map *obj* as an instance of
+        *model*, which is either its own class or another proxy of its
+        concrete model.  See :func:`cast_instance`.
+        """
+        return cast_instance(self._views, obj, model)
+
+    def discard(self, model, pk):
+        """
+        Removes the instance of *model* with the primary key *pk* from the
+        identity map if it is in it.
+        """
+        obj = self.get_map_for_model(model).pop(pk, None)
+        if obj is not None and self._field_maps:
+            remove_from_field_maps(self._field_maps.get(get_concrete_model(model)), obj)
+
+    def get_map_for_field(self, model, field):
+        """
+        Returns a dictionary mapping the values of the unique *field* to
+        the instances of *model* in the identity map.  It is built the
+        first time it is requested and then kept up to date as instances
+        are added.
 
+        Since the values of a field can be changed after an instance is
+        added, the value of the field on an instance should be checked
+        before it is used.
 
-class RelObjAttrMemoizingIdentityMap(wrapt.ObjectProxy):
+        :rtype: :class:`weakref.WeakValueDictionary`
+        """
+        return get_field_map(
+            self._field_maps, self.field_map_class, self.get_map_for_model(model), get_concrete_model(model), field
+        )
+
+
+def get_field_map(field_maps, field_map_class, sub_identity_map, model, field):
+    """
+    Returns the dictionary in *field_maps* for *field* on *model*,
+    creating it from the instances in *sub_identity_map* if it does not
+    exist yet.
     """
-    A wrapper for an identity map which provides a :meth:`rel_obj_attr`
-    to be returned from a ``get_prefetch_queryset`` method.
+    model_field_maps = field_maps.setdefault(model, {})
+    field_map = model_field_maps.get(field.attname)
+    if field_map is None:
+        field_map = model_field_maps[field.attname] = field_map_class()
+        for obj in list(sub_identity_map.values()):
+            add_to_field_maps({field.attname: field_map}, obj)
+    return field_map
 
-    This is useful for cases when there is identifying information
-    on the related object returned from the prefetcher which is not present
-    on the equivalent object in the identity map.
+
+def add_to_field_maps(model_field_maps, obj):
+    """
+    Adds *obj* to each of the dictionaries in *model_field_maps*, which
+    maps field attribute names to the dictionary for that field.
     """
+    if not model_field_maps:
+        return
+    for attname, field_map in model_field_maps.items():
+        # Deferred fields are skipped so that they aren't fetched.
+        value = obj.__dict__.get(attname)
+        if value is not None:
+            field_map[value] = obj
 
-    __slots__ = ("_self_rel_obj_attr", "_self_memo")
 
-    def __init__(self, rel_obj_attr, wrapped):
-        super().__init__(wrapped)
-        self._self_rel_obj_attr = rel_obj_attr
-        self._self_memo = {}
+def remove_from_field_maps(model_field_maps, obj):
+    """
+    Removes *obj* from each of the dictionaries in *model_field_maps*
+    which it is in.
+    """
+    if not model_field_maps:
+        return
+    for attname, field_map in model_field_maps.items():
+        value = obj.__dict__.get(attname)
+        if field_map.get(value) is obj:
+            del field_map[value]
+
+
+class StrongPrefetchIdentityMap(PrefetchIdentityMap):
+    """
+    A :class:`PrefetchIdentityMap` which uses plain dictionaries rather
+    than :class:`weakref.WeakValueDictionary` objects, which avoids the
+    cost of creating a weak reference for each instance.
+
+    Since it keeps every instance alive, it should only be used for
+    identity maps which are discarded after a single call to
+    ``prefetch_related_objects``.
+    """
+
+    field_map_class = dict
+
+    def __init__(self):
+        defaultdict.__init__(self, dict)
+        self._field_maps = {}
+        self._views = {}
+        self.relation_sets = None
+        self.missing_keys = None
+
+
+IdentityMapStats = namedtuple("IdentityMapStats", ["hits", "misses", "evictions", "size"])
+
+
+class LRUPrefetchIdentityMap(object):
+    """
+    An identity map which keeps strong references to at most *maxsize*
+    model instances in total and at most *max_per_model* instances of
+    each model, evicting the least recently used instances when either
+    limit is reached::
+
+        >>> identity_map = LRUPrefetchIdentityMap(maxsize=2)
+        >>> a, b, c = Author.objects.all()[:3]
+        >>> identity_map[a] is a
+        True
+        >>> identity_map[b] is b
+        True
+        >>> identity_map[c] is c
+        True
+        >>> identity_map.get_stats()
+        IdentityMapStats(hits=0, misses=3, evictions=1, size=2)
+
+    This is useful with
+    :func:`django_prefetch_utils.identity_map.persistent.use_persistent_prefetch_identity_map`
+    in long-running jobs, where :class:`PrefetchIdentityMap` would keep
+    every referenced instance mapped.  Once an instance has been
+    evicted, an equal instance fetched later will not be identical to it.
+
+    If *maxsize* or *max_per_model* are not given, they are taken from
+    the ``PREFETCH_UTILS_IDENTITY_MAP_MAXSIZE`` and
+    ``PREFETCH_UTILS_IDENTITY_MAP_MAX_PER_MODEL`` settings.  A value of
+    ``None`` means there is no limit.  *track_relations* and
+    *track_missing* are the same as for :class:`PrefetchIdentityMap`.
+    """
+
+    def __init__(self, maxsize=DEFAULT, max_per_model=DEFAULT, track_relations=False, track_missing=False):
+        if maxsize is DEFAULT:
+            maxsize = getattr(settings, "PREFETCH_UTILS_IDENTITY_MAP_MAXSIZE", DEFAULT_IDENTITY_MAP_MAXSIZE)
+        if max_per_model is DEFAULT:
+            max_per_model = getattr(settings, "PREFETCH_UTILS_IDENTITY_MAP_MAX_PER_MODEL", None)
+        self.maxsize = maxsize
+        self.max_per_model = max_per_model
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._maps = defaultdict(OrderedDict)
+        self._order = OrderedDict()
+        self._field_maps = {}
+        self._views = WeakValueDictionary()
+        self.relation_sets = RelationSets(self) if track_relations else None
+        self.missing_keys = MissingKeys() if track_missing else None
+
+    def __len__(self):
+        return len(self._order)
 
     def __getitem__(self, obj):
-        new_obj = self.__wrapped__[obj]
+        requested_model = type(obj)
+        model = get_concrete_model(requested_model)
+        subdict = self._maps[model]
 
-        # Compute the rel_obj_attr on the original object and associate
-        # it with the new object
-        self._self_memo[new_obj] = self._self_rel_obj_attr(obj)
+        try:
+            pk = obj.pk
+        except AttributeError:
+            return obj
 
-        return new_obj
+        new_obj = subdict.get(pk)
+        if new_obj is not None:
+            self.hits += 1
+            subdict.move_to_end(pk)
+            self._order.move_to_end((model, pk))
+            if fill_deferred_fields(new_obj, obj):
+                add_to_field_maps(self._field_maps.get(model), new_obj)
+            if type(new_obj) is not requested_model:
+                return cast_instance(self._views, new_obj, requested_model)
+            return new_obj
 
-    def rel_obj_attr(self, rel_obj):
-        return self._self_memo[rel_obj]
+        self.misses += 1
+        subdict[pk] = obj
+        self._order[(model, pk)] = None
+        add_to_field_maps(self._field_maps.get(model), obj)
+        if self.max_per_model is not None and len(subdict) > self.max_per_model:
+            old_pk, old_obj = subdict.popitem(last=False)
+            del self._order[(model, old_pk)]
+            self._evict(model, old_obj)
+        while self.maxsize is not None and len(self._order) > self.maxsize:
+            (old_model, old_pk), _ = self._order.popitem(last=False)
+            self._evict(old_model, self._maps[old_model].pop(old_pk))
+        return obj
+
+    def _evict(self, model, obj):
+        self.evictions += 1
+        remove_from_field_maps(self._field_maps.get(model), obj)
+
+    def discard(self, model, pk):
+        """
+        Removes the instance of *model* with the primary key *pk* from the
+        identity map if it is in it.  This is not counted as an eviction.
+        """
+        model = get_concrete_model(model)
+        obj = self._maps[model].pop(pk, None)
+        if obj is not None:
+            del self._order[(model, pk)]
+            remove_from_field_maps(self._field_maps.get(model), obj)
+
+    def get_map_for_model(self, model):
+        """
+        Returns the underlying dictionary mapping primary keys to the
+        instances of the concrete model of *model*.  Looking up instances
+        in it does not affect the order in which they are evicted.
 
+        :rtype: :class:`collections.OrderedDict`
+        """
+        return self._maps[get_concrete_model(model)]
+
+    def cast(self, obj, model):
+        """
+        Returns the instance in the identity map *obj* as an instance of
+        *model*.  See :meth:`PrefetchIdentityMap.cast`.
+        """
+        return cast_instance(self._views, obj, model)
 
-class AnnotatingIdentityMap(wrapt.ObjectProxy):
-    __slots__ = ("_self_annotation_keys",)
+    def get_map_for_field(self, model, field):
+        """
+        Returns a dictionary mapping the values of the unique *field* to
+        the instances of *model* in the identity map.  See
+        :meth:`PrefetchIdentityMap.get_map_for_field`.
 
-    def __init__(self, annotation_keys, wrapped):
+        :rtype: dict
+        """
+        model = get_concrete_model(model)
+        return get_field_map(self._field_maps, dict, self._maps[model], model, field)
+
+    def clear(self):
+        """
+        Removes all of the instances from the identity map.  The
+        counters are not reset.
+        """
+        self._maps.clear()
+        self._order.clear()
+        self._field_maps.clear()
+        self._views.clear()
+        if self.relation_sets is not None:
+            self.relation_sets.clear()
+        if self.missing_keys is not None:
+            self.missing_keys.clear()
+
+    def get_stats(self):
+        """
+        Returns the number of hits, misses and evictions so far along with
+        the current number of instances in the identity map.
+
+        :rtype: :class:`IdentityMapStats`
+        """
+        return IdentityMapStats(self.hits, self.misses, self.evictions, len(self._order))
+
+
+class LockingIdentityMap(wrapt.ObjectProxy):
+    """
+    A wrapper for an identity map which allows it to be shared between
+    threads which are prefetching at the same time.
+
+    Lookups, the other methods of the identity map and the methods of
+    its :attr:`relation_sets` and :attr:`missing_keys` are all called
+    while holding a lock.  Any model instances returned also have their
+    ``_prefetched_objects_cache`` set up while the lock is held so that
+    threads prefetching different relations on the same instance don't
+    replace each other's caches.
+    """
+
+    __slots__ = ("_self_lock",)
+
+    def __init__(self, wrapped):
         super().__init__(wrapped)
-        self._self_annotation_keys = annotation_keys
+        self._self_lock = threading.RLock()
 
     def __getitem__(self, obj):
-        new_obj = self.__wrapped__[obj]
-        if new_obj is not obj:
-            for key in self._self_annotation_keys:
-                setattr(new_obj, key, getattr(obj, key))
-        return new_obj
+        with self._self_lock:
+            new_obj = self.__wrapped__[obj]
+            if not hasattr(new_obj, "_prefetched_objects_cache"):
+                try:
+                    new_obj._prefetched_objects_cache = {}
+                except (AttributeError, TypeError):
+                    pass
+            return new_obj
+
+    def get_map_for_model(self, model):
+        with self._self_lock:
+            return self.__wrapped__.get_map_for_model(model)
+
+    def get_map_for_field(self, model, field):
+        with self._self_lock:
+            return self.__wrapped__.get_map_for_field(model, field)
+
+    def cast(self, obj, model):
+        with self._self_lock:
+            return self.__wrapped__.cast(obj, model)
+
+    def discard(self, model, pk):
+        with self._self_lock:
+            return self.__wrapped__.discard(model, pk)
+
+    @property
+    def relation_sets(self):
+        relation_sets = getattr(self.__wrapped__, "relation_sets", None)
+        if relation_sets is None:
+            return None
+        return LockingRelationSets(self._self_lock, relation_sets)
+
+    @property
+    def missing_keys(self):
+        missing_keys = getattr(self.__wrapped__, "missing_keys", None)
+        if missing_keys is None:
+            return None
+        return LockingMissingKeys(self._self_lock, missing_keys)
 
 
-class SelectRelatedIdentityMap(wrapt.ObjectProxy):
-    __slots__ = ("_self_select_related",)
-    MISSING = object()
+class LockingRelationSets(wrapt.ObjectProxy):
+    """
+    A wrapper for the :class:`RelationSets` of an identity map wrapped
+    by :class:`LockingIdentityMap` which calls its methods while holding
+    *lock*.
+    """
+
+    __slots__ = ("_self_lock",)
 
-    def __init__(self, select_related, wrapped):
+    def __init__(self, lock, wrapped):
         super().__init__(wrapped)
-        self._self_select_related = select_related
+        self._self_lock = lock
 
-    def get_cached_value(self, field, instance):
-        if not field.is_cached(instance):
-            return self.MISSING
-        return field.get_cached_value(instance)
+    def get(self, instance, relation_key):
+        with self._self_lock:
+            return self.__wrapped__.get(instance, relation_key)
 
-    def set_cached_value(self, field, instance, value):
-        field.set_cached_value(instance, value)
+    def set(self, instance, relation_key, rel_objs):
+        with self._self_lock:
+            return self.__wrapped__.set(instance, relation_key, rel_objs)
 
-    def transfer_select_related(self, select_related, source, target):
-        for key, sub_select_related in select_related.items():
-            field = source._meta.get_field(key)
+    def discard(self, model, pk, cache_name=None):
+        with self._self_lock:
+            return self.__wrapped__.discard(model, pk, cache_name)
 
-            source_obj = self.get_cached_value(field, source)
-            if source_obj is self.MISSING:
-                source_obj = getattr(source, key)
+    def clear(self):
+        with self._self_lock:
+            return self.__wrapped__.clear()
 
-            target_obj = self.__wrapped__[source_obj]
-            self.set_cached_value(field, target, target_obj)
-            self.transfer_select_related(sub_select_related, source=source_obj, target=target_obj)
 
-    def __getitem__(self, obj):
-        new_obj = self.__wrapped__[obj]
-        self.transfer_select_related(self._self_select_related, source=obj, target=new_obj)
-        return new_obj
+class LockingMissingKeys(wrapt.ObjectProxy):
+    """
+    A wrapper for the :class:`MissingKeys` of an identity map wrapped by
+    :class:`LockingIdentityMap` which calls its methods while holding
+    *lock*.
+    """
+
+    __slots__ = ("_self_lock",)
+
+    def __init__(self, lock, wrapped):
+        super().__init__(wrapped)
+        self._self_lock = lock
+
+    def contains(self, model, attname, value):
+        with self._self_lock:
+            return self.__wrapped__.contains(model, attname, value)
 
+    def add(self, model, attname, values):
+        # The values may be a generator, so they are consumed before the
+        # lock is taken.
+        values = list(values)
+        with self._self_lock:
+            return self.__wrapped__.add(model, attname, values)
 
-class ExtraIdentityMap(wrapt.ObjectProxy):
+    def discard_model(self, model):
+        with self._self_lock:
+            return self.__wrapped__.discard_model(model)
+
+    def clear(self):
+        with self._self_lock:
+            return self.__wrapped__.clear()
+
+
+class RetainingIdentityMap(wrapt.ObjectProxy):
     """
-    This identity map wrapper
+    A wrapper for an identity map which keeps strong references to the
+    *maxsize* most recently used model instances so that they stay in
+    the underlying (weak) identity map even when nothing else refers to
+    them.  Instances of the models in *exclude_models* are not retained.
     """
 
-    __slots__ = ("_self_extra",)
+    __slots__ = ("_self_maxsize", "_self_exclude_models", "_self_retained")
 
-    def __init__(self, extra, wrapped):
+    def __init__(self, maxsize, exclude_models, wrapped):
         super().__init__(wrapped)
-        self._self_extra = extra
+        self._self_maxsize = maxsize
+        self._self_exclude_models = frozenset(exclude_models)
+        self._self_retained = OrderedDict()
 
     def __getitem__(self, obj):
         new_obj = self.__wrapped__[obj]
-        if new_obj is obj:
+        model = type(new_obj)
+        if model in self._self_exclude_models:
             return new_obj
 
-        for key in self._self_extra:
-            setattr(new_obj, key, getattr(obj, key))
+        try:
+            key = (model, new_obj.pk)
+        except AttributeError:
+            return new_obj
 
+        retained = self._self_retained
+        retained[key] = new_obj
+        retained.move_to_end(key)
+        if len(retained) > self._self_maxsize:
+            retained.popitem(last=False)
         return new_obj
+
+    def retained_objects(self):
+        """
+        Returns a list of the instances currently being retained.
+
+        :rtype: list
+        """
+        return list(self._self_retained.values())
+
+
+def compile_select_related(model, select_related, max_depth=5):
+    """
+    Returns a tuple of ``(field, name, sub_plan)`` triples for the
+    relations in *select_related* on *model*, where *sub_plan* is the
+    same for the related model.  *select_related* is the
+    ``select_related`` attribute of a query, so it is either a nested
+    dictionary of relation names or ``True`` to follow the non-null
+    foreign keys as Django does, up to *max_depth* levels deep.
+    """
+    if select_related is True:
+        if max_depth <= 0:
+            return ()
+        return tuple(
+            (field, field.name, compile_select_related(field.related_model, True, max_depth - 1))
+            for field in model._meta.fields
+            if field.remote_field and not field.remote_field.parent_link and not field.null
+        )
+
+    plan = []
+    for name, sub_select_related in select_related.items():
+        field = model._meta.get_field(name)
+        plan.append((field, name, compile_select_related(field.related_model, sub_select_related)))
+    return tuple(plan)
+
+
+def transfer_select_related(identity_map, plan, source, target):
+    """
+    Sets the related objects in *plan* which were fetched with *source*
+    on *target*, replacing each of them with its instance in
+    *identity_map*.
+    """
+    for field, name, sub_plan in plan:
+        if field.is_cached(source):
+            source_obj = field.get_cached_value(source)
+        else:
+            source_obj = getattr(source, name)
+
+        if source_obj is None:
+            field.set_cached_value(target, None)
+            continue
+
+        target_obj = identity_map[source_obj]
+        field.set_cached_value(target, target_obj)
+        if sub_plan:
+            transfer_select_related(identity_map, sub_plan, source_obj, target_obj)
+
+
+class QuerySetIdentityMap(object):
+    """
+    A wrapper for an identity map which merges the related objects from
+    ``select_related``, the annotations and the ``extra`` columns
+    fetched by a queryset onto the instances which are already in the
+    identity map.  Everything which depends on the queryset is worked
+    out once by :meth:`for_queryset`, so each row only takes a single
+    call.
+
+    If *rel_obj_attr* is given, it is computed on each object before it
+    is replaced by the instance in the identity map, and is returned for
+    that instance by :meth:`rel_obj_attr`.
+
+    Any other attributes are looked up on the wrapped identity map.
+    """
+
+    __slots__ = ("_identity_map", "_select_related", "_attnames", "_rel_obj_attr", "_memo")
+
+    def __init__(self, identity_map, select_related=(), attnames=(), rel_obj_attr=None):
+        self._identity_map = identity_map
+        self._select_related = select_related
+        self._attnames = attnames
+        self._rel_obj_attr = rel_obj_attr
+        self._memo = {} if rel_obj_attr is not None else None
+
+    @classmethod
+    def for_queryset(cls, identity_map, queryset, rel_obj_attr=None):
+        """
+        Returns a :class:`QuerySetIdentityMap` wrapping *identity_map*
+        for the objects fetched by *queryset*.  If there is nothing to
+        merge from them and no *rel_obj_attr*, then *identity_map* is
+        returned unchanged.
+        """
+        query = getattr(queryset, "query", None)
+        select_related = getattr(query, "select_related", None)
+        if select_related:
+            select_related = compile_select_related(queryset.model, select_related)
+        attnames = tuple(getattr(query, "annotations", None) or ()) + tuple(getattr(query, "extra", None) or ())
+        if not select_related and not attnames and rel_obj_attr is None:
+            return identity_map
+        return cls(identity_map, select_related or (), attnames, rel_obj_attr)
+
+    def __getitem__(self, obj):
+        identity_map = self._identity_map
+        new_obj = identity_map[obj]
+        if self._select_related:
+            transfer_select_related(identity_map, self._select_related, obj, new_obj)
+        if new_obj is not obj:
+            for attname in self._attnames:
+                setattr(new_obj, attname, getattr(obj, attname))
+        if self._memo is not None:
+            self._memo[new_obj] = self._rel_obj_attr(obj)
+        return new_obj
+
+    def __getattr__(self, name):
+        if name in QuerySetIdentityMap.__slots__:
+            raise AttributeError(name)
+        return getattr(self._identity_map, name)
+
+    def rel_obj_attr(self, rel_obj):
+        return self._memo[rel_obj]
@@ -1,22 +1,133 @@
-import threading
+import asyncio
+import copy
 from contextlib import ContextDecorator
+from contextvars import ContextVar
 from functools import partial
+from operator import attrgetter
 
 import wrapt
+from django.db.models.lookups import Exact
+from django.db.models.lookups import In
+from django.db.models.query import ModelIterable
 from django.db.models.query import QuerySet
+from django.db.models.sql.where import WhereNode
 
 from django_prefetch_utils.identity_map import get_default_prefetch_identity_map
 from django_prefetch_utils.identity_map import prefetch_related_objects_impl
 from django_prefetch_utils.selector import override_prefetch_related_objects
 
+from .deferred import enable_batched_deferred_loading
+from .deferred import reset_batched_deferred_loading
+from .iterables import IdentityMapModelIterable
+from .iterables import can_use_identity_map_iterable
+from .lazy import enable_lazy_loading
+from .lazy import is_lazy_loading_enabled
+from .lazy import register_siblings
+from .lazy import reset_lazy_loading
 from .wrappers import wrap_identity_map_for_queryset
+from .write_through import WriteThroughIdentityMap
+from .write_through import enable_write_through
+from .write_through import reset_write_through
 
-_active = threading.local()
+_active = ContextVar("prefetch_identity_map", default=None)
+
+_serve_pk_lookups = ContextVar("serve_pk_lookups", default=False)
 
 
 original_fetch_all = QuerySet._fetch_all
 
 
+def get_pk_lookup_values(queryset):
+    """
+    Returns the list of primary key values that *queryset* filters on
+    if it is a query for model instances which only filters on its
+    model's primary key with ``exact`` or ``in`` and which is ordered by
+    the primary key, if at all.  Otherwise, ``None`` is returned.
+
+    :rtype: list
+    """
+    if queryset._iterable_class is not ModelIterable or queryset._result_cache is not None:
+        return None
+
+    query = queryset.query
+    if (
+        len(query.alias_map) != 1
+        or query.combinator
+        or query.select_for_update
+        or query.select_related
+        or query.annotations
+        or query.extra
+        or query.extra_tables
+        or query.distinct_fields
+        or query.deferred_loading != (frozenset(), True)
+    ):
+        return None
+
+    where = query.where
+    if where.negated or len(where.children) != 1:
+        return None
+    (lookup,) = where.children
+    pk = queryset.model._meta.pk
+    if not isinstance(lookup, (Exact, In)) or getattr(lookup.lhs, "target", None) is not pk:
+        return None
+    if getattr(lookup.lhs, "alias", None) != query.base_table:
+        return None
+
+    values = [lookup.rhs] if isinstance(lookup, Exact) else lookup.rhs
+    if not isinstance(values, (list, tuple, set)) or any(hasattr(value, "resolve_expression") for value in values):
+        return None
+
+    ordering = query.order_by or (queryset.model._meta.ordering if query.default_ordering else ())
+    if tuple(ordering) not in ((), ("pk",), (pk.name,), (pk.attname,)):
+        return None
+
+    return [value for value in values if value is not None]
+
+
+def fetch_pk_lookup(identity_map, queryset):
+    """
+    Returns the list of instances for *queryset* if it is a primary key
+    lookup (see :func:`get_pk_lookup_values`) and at least one of the
+    instances is in *identity_map*.  Only the instances which are not in
+    *identity_map* are fetched from the database.  Otherwise, or if any
+    of the instances in *identity_map* were loaded from a different
+    database than the one *queryset* uses, ``None`` is returned.
+
+    :rtype: list
+    """
+    values = get_pk_lookup_values(queryset)
+    if not values:
+        return None
+
+    model = queryset.model
+    db = queryset.db
+    sub_identity_map = identity_map.get_map_for_model(model)
+    found = {}
+    missing = []
+    for value in values:
+        obj = sub_identity_map.get(value)
+        if obj is not None:
+            if obj._state.db != db:
+                return None
+            found[value] = identity_map.cast(identity_map[obj], model)
+        else:
+            missing.append(value)
+    if not found:
+        return None
+
+    objs = list(found.values())
+    if missing:
+        missing_queryset = queryset._chain()
+        missing_queryset._prefetch_related_lookups = ()
+        missing_queryset.query.where = WhereNode()
+        missing_queryset.query.clear_limits()
+        objs.extend(missing_queryset.filter(pk__in=missing))
+    objs.sort(key=attrgetter("pk"))
+
+    low_mark, high_mark = queryset.query.low_mark, queryset.query.high_mark
+    return objs[low_mark:high_mark]
+
+
 class FetchAllDescriptor(object):
     """
     This descriptor replaces ``QuerySet._fetch_all`` and applies
@@ -29,13 +140,21 @@ class FetchAllDescriptor(object):
         return partial(self._fetch_all, queryset)
 
     def _fetch_all(self, queryset):
-        identity_map = getattr(_active, "value", None)
+        identity_map = _active.get()
         if identity_map is None:
             return original_fetch_all(queryset)
 
         identity_map = wrap_identity_map_for_queryset(identity_map, queryset)
+        if queryset._result_cache is None and _serve_pk_lookups.get():
+            queryset._result_cache = fetch_pk_lookup(identity_map, queryset)
         if queryset._result_cache is None:
-            queryset._result_cache = [identity_map[obj] for obj in queryset._iterable_class(queryset)]
+            if can_use_identity_map_iterable(queryset):
+                objs = IdentityMapModelIterable(identity_map, queryset)
+            else:
+                objs = (identity_map[obj] for obj in queryset._iterable_class(queryset))
+            queryset._result_cache = list(objs)
+            if is_lazy_loading_enabled():
+                register_siblings(queryset._result_cache)
         if queryset._prefetch_related_lookups and not queryset._prefetch_done:
             queryset._prefetch_related_objects()
 
@@ -70,39 +189,107 @@ class use_persistent_prefetch_identity_map(ContextDecorator):
            with self.assertNumQueries(1):
                toys = list(Toy.objects.prefetch_related("dog"))
 
-    """
+    If *lazy_loading* is ``True``, then relations which have not been
+    prefetched are loaded for all of the instances fetched by the same
+    queryset the first time they are accessed on any of them.  See
+    :mod:`django_prefetch_utils.identity_map.lazy`.
 
-    previous_active = None
-    override_context_decorator = None
+    If *serve_pk_lookups* is ``True``, then querysets which only filter
+    on the primary key, such as ``Dog.objects.get(pk=3)`` or
+    ``Dog.objects.in_bulk([1, 2])``, return the instances already in the
+    identity map and only query for the rest.  Since those instances are
+    not refreshed, this should only be used when it is acceptable for
+    them to be out of date.
 
-    def __init__(self, identity_map=None, pass_identity_map=False):
+    If *batch_deferred_fields* is ``True``, then accessing a deferred
+    field on an instance in the identity map loads it for all of the
+    instances in the identity map which have it deferred.  See
+    :mod:`django_prefetch_utils.identity_map.deferred`.
+
+    If *write_through* is ``True``, then instances which are saved,
+    created or deleted through the ORM are added to, updated in or
+    removed from the identity map, and the prefetched relations that
+    they change are discarded.  See
+    :mod:`django_prefetch_utils.identity_map.write_through`.
+    """
+
+    def __init__(
+        self,
+        identity_map=None,
+        pass_identity_map=False,
+        lazy_loading=False,
+        serve_pk_lookups=False,
+        batch_deferred_fields=False,
+        write_through=False,
+    ):
         self._identity_map = identity_map
         self.pass_identity_map = pass_identity_map
+        self.lazy_loading = lazy_loading
+        self.serve_pk_lookups = serve_pk_lookups
+        self.batch_deferred_fields = batch_deferred_fields
+        self.write_through = write_through
+        self._entered = []
 
     def _recreate_cm(self):
-        return self
+        # Each use as a decorator gets its own state so that calls in
+        # different threads or tasks don't reset each other's values.
+        cm = copy.copy(self)
+        cm._entered = []
+        return cm
 
     def __enter__(self):
         if self._identity_map is not None:
             identity_map = self._identity_map
         else:
             identity_map = get_default_prefetch_identity_map()
+        if self.write_through:
+            identity_map = WriteThroughIdentityMap(identity_map)
         enable_fetch_all_descriptor()
-        self.previous_active = getattr(_active, "value", None)
-        _active.value = identity_map
-        self.override_context_decorator = override_prefetch_related_objects(
+        token = _active.set(identity_map)
+        override_context_decorator = override_prefetch_related_objects(
             partial(prefetch_related_objects_impl, identity_map)
         )
-        self.override_context_decorator.__enter__()
+        override_context_decorator.__enter__()
+        lazy_token = enable_lazy_loading() if self.lazy_loading else None
+        pk_lookups_token = _serve_pk_lookups.set(self.serve_pk_lookups)
+        deferred_token = enable_batched_deferred_loading(identity_map) if self.batch_deferred_fields else None
+        write_through_token = enable_write_through(identity_map) if self.write_through else None
+        self._entered.append(
+            (token, override_context_decorator, lazy_token, pk_lookups_token, deferred_token, write_through_token)
+        )
         return identity_map
 
     def __exit__(self, exc_type, exc_value, traceback):
-        _active.value = self.previous_active
-        self.previous_active = None
-        self.override_context_decorator.__exit__(exc_type, exc_value, traceback)
-        self.override_context_decorator = None
+        (
+            token,
+            override_context_decorator,
+            lazy_token,
+            pk_lookups_token,
+            deferred_token,
+            write_through_token,
+        ) = self._entered.pop()
+        if write_through_token is not None:
+            reset_write_through(write_through_token)
+        if deferred_token is not None:
+            reset_batched_deferred_loading(deferred_token)
+        _serve_pk_lookups.reset(pk_lookups_token)
+        if lazy_token is not None:
+            reset_lazy_loading(lazy_token)
+        override_context_decorator.__exit__(exc_type, exc_value, traceback)
+        _active.reset(token)
 
     def __call__(self, func):
+        if asyncio.iscoroutinefunction(func):
+
+            @wrapt.decorator
+            async def async_wrapper(wrapped, instance, args, kwargs):
+                with self._recreate_cm() as identity_map:
+                    if self.pass_identity_map:
+                        args = (identity_map,) + args
+                    return await wrapped(*args, **kwargs)
+
+            return async_wrapper(func)
+
         @wrapt.decorator
         def wrapper(wrapped, instance, args, kwargs):
             with self._recreate_cm() as identity_map:
@@ -0,0 +1,229 @@
+"""
+This module provides caching of the work done to resolve the lookups
+passed to ``prefetch_related_objects`` so that it does not need to be
+repeated when the same lookups are prefetched many times.
+
+There are two caches:
+
+- a cache of the normalized :class:`CompiledPrefetch` objects for a
+  root model and a tuple of string lookups.
+
+- a cache of :class:`LevelPlan` objects containing the class-level
+  information about a single ``through_attr`` on a model, such as its
+  descriptor and the identity map wrapper to use for it.
+
+Both are LRU caches whose size can be set with the
+``PREFETCH_UTILS_PLAN_CACHE_SIZE`` setting; setting it to ``0`` disables
+them.
+"""
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.db.models import Prefetch
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+from django.db.models.fields.related_descriptors import ForwardOneToOneDescriptor
+from django.db.models.fields.related_descriptors import ManyToManyDescriptor
+from django.db.models.fields.related_descriptors import ReverseManyToOneDescriptor
+from django.db.models.fields.related_descriptors import ReverseOneToOneDescriptor
+from django.db.models.query import normalize_prefetch_lookups
+from django.utils.functional import cached_property
+
+from .wrappers import ForwardDescriptorPrefetchWrapper
+from .wrappers import GenericForeignKeyPrefetchWrapper
+from .wrappers import IdentityMapPrefetcher
+from .wrappers import ManyToManyRelatedManagerWrapper
+from .wrappers import ReverseManyToOneDescriptorPrefetchWrapper
+from .wrappers import ReverseOneToOneDescriptorPrefetchWrapper
+
+DEFAULT_PLAN_CACHE_SIZE = 256
+
+PREFETCHER_WRAPPERS = {
+    ForwardManyToOneDescriptor: ForwardDescriptorPrefetchWrapper,
+    ForwardOneToOneDescriptor: ForwardDescriptorPrefetchWrapper,
+    ReverseOneToOneDescriptor: ReverseOneToOneDescriptorPrefetchWrapper,
+    ReverseManyToOneDescriptor: ReverseManyToOneDescriptorPrefetchWrapper,
+    ManyToManyDescriptor: ManyToManyRelatedManagerWrapper,
+    GenericForeignKey: GenericForeignKeyPrefetchWrapper,
+}
+
+
+def get_prefetcher_wrapper_class(descriptor):
+    """
+    Returns the class used to wrap the prefetcher for *descriptor* so
+    that it makes use of an identity map.
+    """
+    return PREFETCHER_WRAPPERS.get(type(descriptor), IdentityMapPrefetcher)
+
+
+class CompiledPrefetch(Prefetch):
+    """
+    A :class:`django.db.models.Prefetch` which computes the values for
+    each level of its lookup up front so that they can be reused each
+    time it is prefetched.
+    """
+
+    def __init__(self, lookup, queryset=None, to_attr=None):
+        super().__init__(lookup, queryset=queryset, to_attr=to_attr)
+        self.through_attrs = tuple(self.prefetch_through.split(LOOKUP_SEP))
+        levels = range(len(self.prefetch_to.split(LOOKUP_SEP)))
+        self._prefetch_to_levels = tuple(super(CompiledPrefetch, self).get_current_prefetch_to(i) for i in levels)
+        self._to_attr_levels = tuple(super(CompiledPrefetch, self).get_current_to_attr(i) for i in levels)
+
+    def get_current_prefetch_to(self, level):
+        return self._prefetch_to_levels[level]
+
+    def get_current_to_attr(self, level):
+        return self._to_attr_levels[level]
+
+
+def get_through_attrs(lookup):
+    """
+    Returns the parts of the ``prefetch_through`` of *lookup*.
+
+    :rtype: tuple
+    """
+    through_attrs = getattr(lookup, "through_attrs", None)
+    if through_attrs is None:
+        through_attrs = tuple(lookup.prefetch_through.split(LOOKUP_SEP))
+    return through_attrs
+
+
+class LRUPlanCache(object):
+    """
+    A thread-safe LRU cache of plans whose size defaults to the
+    ``PREFETCH_UTILS_PLAN_CACHE_SIZE`` setting.
+    """
+
+    def __init__(self, maxsize=None):
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._plans = OrderedDict()
+
+    @property
+    def maxsize(self):
+        if self._maxsize is not None:
+            return self._maxsize
+        return getattr(settings, "PREFETCH_UTILS_PLAN_CACHE_SIZE", DEFAULT_PLAN_CACHE_SIZE)
+
+    def __len__(self):
+        return len(self._plans)
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+    def _get(self, key):
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+            return plan
+
+    def _set(self, key, plan, maxsize):
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > maxsize:
+                self._plans.popitem(last=False)
+
+
+class PrefetchPlanCache(LRUPlanCache):
+    """
+    A thread-safe LRU cache of the normalized lookups used to prefetch
+    a tuple of string lookups for a model.
+    """
+
+    def get_lookups(self, model, related_lookups):
+        """
+        Returns a list of normalized lookups for *related_lookups* in
+        the same order as ``normalize_prefetch_lookups(reversed(related_lookups))``.
+
+        A new list is returned on each call, but the lookups in it are
+        shared between calls, so they must not be modified.
+
+        :rtype: list
+        """
+        maxsize = self.maxsize
+        if not maxsize or not all(isinstance(lookup, str) for lookup in related_lookups):
+            return normalize_prefetch_lookups(reversed(related_lookups))
+
+        key = (model, tuple(related_lookups))
+        plan = self._get(key)
+        if plan is None:
+            plan = tuple(CompiledPrefetch(lookup) for lookup in reversed(related_lookups))
+            self._set(key, plan, maxsize)
+        return list(plan)
+
+
+class LevelPlan(object):
+    """
+    The class-level information needed to prefetch *through_attr* on
+    instances of *model*.
+    """
+
+    def __init__(self, model, through_attr, to_attr):
+        # For singly related objects, we have to avoid getting the attribute
+        # from the object, as this will trigger the query. So we first try
+        # on the class, in order to get the descriptor object.
+        self.descriptor = getattr(model, through_attr, None)
+
+        # singly related object, descriptor object has the
+        # get_prefetch_queryset() method.
+        self.is_prefetcher = self.descriptor is not None and hasattr(self.descriptor, "get_prefetch_queryset")
+
+        # Special case cached_property instances because hasattr
+        # triggers attribute computation and assignment.
+        self.to_attr_is_cached_property = isinstance(getattr(model, to_attr, None), cached_property)
+
+        self.wrapper_class = get_prefetcher_wrapper_class(self.descriptor)
+
+
+class LevelPlanCache(LRUPlanCache):
+    """
+    A thread-safe LRU cache of the :class:`LevelPlan` objects for a
+    model, ``through_attr`` and ``to_attr``.
+    """
+
+    def get_plan(self, model, through_attr, to_attr):
+        """
+        Returns the :class:`LevelPlan` for prefetching *through_attr*
+        into *to_attr* on instances of *model*.
+
+        :rtype: :class:`LevelPlan`
+        """
+        maxsize = self.maxsize
+        if not maxsize:
+            return LevelPlan(model, through_attr, to_attr)
+
+        key = (model, through_attr, to_attr)
+        plan = self._get(key)
+        if plan is None:
+            plan = LevelPlan(model, through_attr, to_attr)
+            self._set(key, plan, maxsize)
+        return plan
+
+
+def get_level_plan(model, through_attr, to_attr):
+    """
+    Returns the (cached) :class:`LevelPlan` for prefetching *through_attr*
+    into *to_attr* on instances of *model*.
+
+    :rtype: :class:`LevelPlan`
+    """
+    return level_plan_cache.get_plan(model, through_attr, to_attr)
+
+
+prefetch_plan_cache = PrefetchPlanCache()
+
+level_plan_cache = LevelPlanCache()
+
+
+def clear_prefetch_plan_caches():
+    """
+    Clears all of the cached prefetch plans.  This may be needed if
+    descriptors are added to models at runtime.
+    """
+    prefetch_plan_cache.clear()
+    level_plan_cache.clear()
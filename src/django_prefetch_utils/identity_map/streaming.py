@@ -0,0 +1,89 @@
+"""
+This module provides :func:`iter_prefetched` which applies
+``prefetch_related`` lookups and an identity map to querysets which are
+streamed with ``QuerySet.iterator()``::
+
+    from django_prefetch_utils.identity_map.streaming import iter_prefetched
+
+    for dog in iter_prefetched(Dog.objects.all(), "owner", "toys", chunk_size=1000):
+        writer.writerow([dog.name, dog.owner.name, len(dog.toys.all())])
+
+The related objects are prefetched for each chunk of rows.  An identity
+map is shared by all of the chunks, with the most recently used related
+objects kept alive between chunks so that objects which many rows share
+(for example, an owner or category) are only fetched once.  The number
+of objects kept alive can be set with the
+``PREFETCH_UTILS_STREAMING_MAX_RETAINED`` setting.
+
+If a persistent identity map is active, then it is used instead.
+"""
+from itertools import islice
+
+from django.conf import settings
+
+from . import get_default_prefetch_identity_map
+from . import persistent
+from . import prefetch_related_objects_impl
+from .maps import RetainingIdentityMap
+from .wrappers import wrap_identity_map_for_queryset
+
+DEFAULT_CHUNK_SIZE = 2000
+
+DEFAULT_MAX_RETAINED = 10000
+
+
+def get_max_retained():
+    """
+    Returns the maximum number of related objects kept alive between
+    chunks by :func:`iter_prefetched`.
+
+    :rtype: int
+    """
+    return getattr(settings, "PREFETCH_UTILS_STREAMING_MAX_RETAINED", DEFAULT_MAX_RETAINED)
+
+
+def release_prefetched_objects(objs):
+    """
+    Removes the prefetched object caches from each of *objs* so that
+    they do not keep the rows of previous chunks alive.
+    """
+    for obj in objs:
+        obj.__dict__.pop("_prefetched_objects_cache", None)
+
+
+def iter_prefetched(queryset, *lookups, chunk_size=DEFAULT_CHUNK_SIZE, max_retained=None):
+    """
+    Yields the results of *queryset* using ``QuerySet.iterator()`` with
+    *lookups* (along with any lookups on *queryset*) prefetched for each
+    chunk of *chunk_size* rows.
+
+    Once a chunk has been yielded, the caches of the related objects
+    which are retained between chunks are released so that memory use
+    stays flat.  The caches on the yielded rows themselves are left
+    alone.
+    """
+    lookups = tuple(queryset._prefetch_related_lookups) + lookups
+    queryset = queryset.prefetch_related(None)
+
+    identity_map = persistent._active.get()
+    retaining_map = None
+    if identity_map is None:
+        if max_retained is None:
+            max_retained = get_max_retained()
+        identity_map = retaining_map = RetainingIdentityMap(
+            max_retained, [queryset.model], get_default_prefetch_identity_map()
+        )
+
+    row_identity_map = wrap_identity_map_for_queryset(identity_map, queryset)
+    rows = queryset.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = [row_identity_map[row] for row in islice(rows, chunk_size)]
+        if not chunk:
+            return
+
+        if lookups:
+            prefetch_related_objects_impl(identity_map, chunk, *lookups)
+        yield from chunk
+
+        if retaining_map is not None:
+            release_prefetched_objects(retaining_map.retained_objects())
@@ -0,0 +1,107 @@
+"""
+This module provides support for prefetching many-to-many and reverse
+foreign key relations in two phases.  The first query only selects the
+values that the related objects are joined on along with their primary
+keys.  The related objects which are already in the identity map are
+then reused, and a second query fetches the full rows of only the ones
+which are missing.  This reduces the amount of data transferred and the
+number of model instances created for wide tables whose rows are mostly
+already in a persistent identity map.
+
+By default, two phases are used automatically when the identity map is
+*warm*, that is, when it already holds at least :data:`WARM_MIN_INSTANCES`
+instances of the related model and at least as many of them as there
+are instances being prefetched for.  This can be changed globally with
+the ``PREFETCH_UTILS_TWO_PHASE_PREFETCH`` setting, which can be
+``"auto"``, ``True`` or ``False``, or for an individual lookup with
+:class:`TwoPhasePrefetch`::
+
+    books = Book.objects.prefetch_related(TwoPhasePrefetch("authors"))
+
+Two phases are never used for lookups with a custom queryset, since its
+filters and annotations would not be applied to the related objects
+which are reused from the identity map.
+
+For relations registered with
+:func:`~django_prefetch_utils.identity_map.cache.cache_prefetched_relation`,
+the cached rows are used first, and two phases are only used for the
+instances whose rows are not in the cache.
+"""
+from django.conf import settings
+from django.db.models import Prefetch
+
+from .wrappers import IdentityMapObjectProxy
+from .wrappers import ManyToManyRelatedManagerWrapper
+from .wrappers import ReverseManyToOneDescriptorPrefetchWrapper
+
+AUTO = "auto"
+
+# The number of instances of the related model which need to be in the
+# identity map before two phases are used automatically.
+WARM_MIN_INSTANCES = 100
+
+
+class TwoPhasePrefetch(Prefetch):
+    """
+    A :class:`django.db.models.Prefetch` which sets whether the related
+    objects are fetched in two phases.  *two_phase* can be ``True``,
+    ``False`` or ``"auto"``.
+    """
+
+    def __init__(self, lookup, queryset=None, to_attr=None, two_phase=True):
+        super().__init__(lookup, queryset=queryset, to_attr=to_attr)
+        self.two_phase = two_phase
+
+
+def get_two_phase_setting(lookup):
+    """
+    Returns the two phase mode configured for *lookup*, falling back to
+    the ``PREFETCH_UTILS_TWO_PHASE_PREFETCH`` setting.
+    """
+    two_phase = getattr(lookup, "two_phase", None)
+    if two_phase is None:
+        two_phase = getattr(settings, "PREFETCH_UTILS_TWO_PHASE_PREFETCH", AUTO)
+    return two_phase
+
+
+def is_warm(identity_map, model, instances):
+    """
+    Returns ``True`` if *identity_map* holds enough instances of *model*
+    for two phases to be used when prefetching for *instances*.
+    """
+    size = len(identity_map.get_map_for_model(model))
+    return size >= WARM_MIN_INSTANCES and size >= len(instances)
+
+
+def get_two_phase_prefetcher(identity_map, prefetcher, lookup, level):
+    """
+    Returns *prefetcher* wrapped in a :class:`TwoPhasePrefetcher` if it
+    supports fetching in two phases and they are enabled for *lookup*.
+    Otherwise, *prefetcher* is returned unchanged.
+    """
+    if not isinstance(prefetcher, (ManyToManyRelatedManagerWrapper, ReverseManyToOneDescriptorPrefetchWrapper)):
+        return prefetcher
+    two_phase = get_two_phase_setting(lookup)
+    if not two_phase or lookup.get_current_queryset(level) is not None:
+        return prefetcher
+    return TwoPhasePrefetcher(identity_map, two_phase, prefetcher)
+
+
+class TwoPhasePrefetcher(IdentityMapObjectProxy):
+    """
+    A wrapper for a many-to-many or reverse foreign key identity map
+    prefetcher which decides whether to fetch the related objects in two
+    phases.
+    """
+
+    __slots__ = ("_self_two_phase",)
+
+    def __init__(self, identity_map, two_phase, wrapped):
+        super().__init__(identity_map, wrapped)
+        self._self_two_phase = two_phase
+
+    def get_prefetch_queryset(self, instances, queryset=None):
+        two_phase = queryset is None
+        if two_phase and self._self_two_phase == AUTO:
+            two_phase = is_warm(self._self_identity_map, self.model, instances)
+        return self.__wrapped__.get_prefetch_queryset(instances, queryset, two_phase=two_phase)
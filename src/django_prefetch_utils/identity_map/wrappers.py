@@ -1,42 +1,171 @@
 import itertools
+from collections import defaultdict
+from collections import deque
+from functools import partial
 
 import wrapt
+from django.conf import settings
+from django.core.exceptions import EmptyResultSet
 
-from .maps import AnnotatingIdentityMap
-from .maps import ExtraIdentityMap
-from .maps import RelObjAttrMemoizingIdentityMap
-from .maps import SelectRelatedIdentityMap
+from django_prefetch_utils.chunked import get_max_chunk_size
+from django_prefetch_utils.concurrent import can_prefetch_concurrently
+from django_prefetch_utils.concurrent import run_concurrently
+from django_prefetch_utils.relation_access import get_related_manager_class
+
+from .generic import GenericQuerySets
+from .iterables import iter_identity_mapped
+from .maps import QuerySetIdentityMap
 
 
 def wrap_identity_map_for_queryset(identity_map, rel_qs):
-    query = getattr(rel_qs, "query", None)
-    if query is None:
-        return identity_map
-
-    # If the queryset has any select_related, then we need go through and
-    # make sure that they get added to any of the instances that already
-    # exist in the identity map.
-    # Since select_related can recursively put things into the identity
-    # map, we put this at the lowest layer of the wrapping.
-    select_related = getattr(query, "select_related", None)
-    if select_related:
-        identity_map = SelectRelatedIdentityMap(dict(select_related), identity_map)
-
-    # If the queryset has annotations, then we'll need to make sure
-    # they get applied to any of the instances that already exist
-    # in the identity map.
-    annotations = getattr(query, "annotations", None)
-    if annotations:
-        identity_map = AnnotatingIdentityMap(set(annotations), identity_map)
-
-    # If the queryset has any "extra" columns, then we need go through and
-    # make sure that they get added to any of the instances that already
-    # exist in the identity map
-    extra = getattr(query, "extra", None)
-    if extra:
-        identity_map = ExtraIdentityMap(dict(extra), identity_map)
-
-    return identity_map
+    # If the queryset has any select_related, annotations or "extra"
+    # columns, then we need to make sure that they get added to any of
+    # the instances that already exist in the identity map.
+    return QuerySetIdentityMap.for_queryset(identity_map, rel_qs)
+
+
+def get_queryset_signature(queryset):
+    """
+    Returns a hashable value which identifies the rows fetched by
+    *queryset*, or ``None`` if one can't be computed.  The default
+    queryset for a relation (``None``) has the signature ``()``.
+    """
+    if queryset is None:
+        return ()
+    try:
+        sql, params = queryset.query.sql_with_params()
+        signature = (queryset.model, sql, params)
+        hash(signature)
+    except (EmptyResultSet, TypeError):
+        return None
+    return signature
+
+
+def get_relation_key(identity_map, cache_name, queryset):
+    """
+    Returns the key used to record that all of the related objects for
+    the relation *cache_name* fetched with *queryset* are in
+    *identity_map*.  ``None`` is returned if *identity_map* does not
+    track relations or if *queryset* doesn't have a signature.
+    """
+    if getattr(identity_map, "relation_sets", None) is None:
+        return None
+    signature = get_queryset_signature(queryset)
+    if signature is None:
+        return None
+    return (cache_name, signature)
+
+
+def split_complete_relations(identity_map, instances, relation_key):
+    """
+    Returns a list of ``(instance, related_objects)`` pairs for the
+    instances in *instances* whose related objects for *relation_key*
+    are all in *identity_map*, along with a list of the rest of the
+    instances.
+    """
+    if relation_key is None:
+        return [], instances
+
+    relation_sets = identity_map.relation_sets
+    prefix = []
+    new_instances = []
+    for instance in instances:
+        rel_objs = relation_sets.get(instance, relation_key)
+        if rel_objs is None:
+            new_instances.append(instance)
+        else:
+            prefix.append((instance, rel_objs))
+    return prefix, new_instances
+
+
+def record_complete_relations(identity_map, relation_key, instances, instance_attr, rel_objs_by_key):
+    """
+    Records that *rel_objs_by_key* contains all of the related objects
+    for *relation_key* for each of *instances*, where the keys of
+    *rel_objs_by_key* are the values of *instance_attr* for them.
+    """
+    if relation_key is None:
+        return
+    relation_sets = identity_map.relation_sets
+    for instance in instances:
+        relation_sets.set(instance, relation_key, rel_objs_by_key.get(instance_attr(instance), ()))
+
+
+def get_missing_keys(identity_map, queryset):
+    """
+    Returns the :class:`~django_prefetch_utils.identity_map.maps.MissingKeys`
+    for *identity_map* if it can be used for a prefetch with *queryset*.
+    Since a custom queryset may filter out related objects which exist,
+    ``None`` is returned for them.
+    """
+    if queryset is not None:
+        return None
+    return getattr(identity_map, "missing_keys", None)
+
+
+def iter_recording_missing_keys(rows, missing_keys, requested):
+    """
+    Yields the related objects in *rows* and then records the values in
+    *requested*, a dictionary mapping ``(model, attname)`` pairs to sets
+    of values, which none of the related objects had in *missing_keys*.
+    """
+    if missing_keys is None:
+        yield from rows
+        return
+
+    for rel_obj in rows:
+        for (model, attname), values in requested.items():
+            if type(rel_obj) is model:
+                values.discard(getattr(rel_obj, attname))
+        yield rel_obj
+
+    for (model, attname), values in requested.items():
+        missing_keys.add(model, attname, values)
+
+
+PREFETCH_RELATED_VAL_PREFIX = "_prefetch_related_val_"
+
+
+def iter_two_phase(identity_map, pairs_queryset, queryset):
+    """
+    Yields a ``(key, related_object)`` pair for each row of
+    *pairs_queryset*, whose rows are the values of the key followed by
+    the primary key of a related object.  The related objects are looked
+    up in *identity_map*, and only the ones missing from it are fetched
+    with *queryset*.
+    """
+    pairs = [(row[:-1], row[-1]) for row in pairs_queryset]
+
+    model = queryset.model
+    sub_identity_map = identity_map.get_map_for_model(model)
+    rel_objs = {}
+    missing = set()
+    for _, pk in pairs:
+        if pk in rel_objs or pk in missing:
+            continue
+        rel_obj = sub_identity_map.get(pk)
+        if rel_obj is None:
+            missing.add(pk)
+        else:
+            if type(rel_obj) is not model:
+                rel_obj = identity_map.cast(rel_obj, model)
+            rel_objs[pk] = rel_obj
+
+    if missing:
+        missing = sorted(missing)
+        chunk_size = get_max_chunk_size(queryset.db)
+        rows_identity_map = wrap_identity_map_for_queryset(identity_map, queryset)
+        for start in range(0, len(missing), chunk_size):
+            end = start + chunk_size
+            chunk = missing[start:end]
+            for rel_obj in iter_identity_mapped(rows_identity_map, queryset.filter(pk__in=chunk)):
+                rel_objs[rel_obj.pk] = rel_obj
+
+    # A related object may have been deleted between the two queries.
+    for key, pk in pairs:
+        rel_obj = rel_objs.get(pk)
+        if rel_obj is not None:
+            yield key, rel_obj
 
 
 class IdentityMapObjectProxy(wrapt.ObjectProxy):
@@ -58,9 +187,24 @@ class IdentityMapIteratorWrapper(IdentityMapObjectProxy):
     map to each of the items returned.
     """
 
+    __slots__ = ("_self_results",)
+
+    def __init__(self, identity_map, wrapped):
+        super().__init__(identity_map, wrapped)
+        self._self_results = None
+
+    def _fetch_all(self):
+        # This is also used for len() so that list() doesn't evaluate the
+        # wrapped queryset separately.
+        if self._self_results is None:
+            self._self_results = list(iter_identity_mapped(self._self_identity_map, self.__wrapped__))
+        return self._self_results
+
     def __iter__(self):
-        for obj in self.__wrapped__:
-            yield self._self_identity_map[obj]
+        return iter(self._fetch_all())
+
+    def __len__(self):
+        return len(self._fetch_all())
 
 
 class IdentityMapPrefetcher(IdentityMapObjectProxy):
@@ -71,8 +215,7 @@ class IdentityMapPrefetcher(IdentityMapObjectProxy):
     def get_prefetch_queryset(self, instances, queryset=None):
         prefetch_data = self.__wrapped__.get_prefetch_queryset(instances, queryset=queryset)
         rel_qs, rel_obj_attr = prefetch_data[:2]
-        identity_map = wrap_identity_map_for_queryset(self._self_identity_map, rel_qs)
-        identity_map = RelObjAttrMemoizingIdentityMap(rel_obj_attr, identity_map)
+        identity_map = QuerySetIdentityMap.for_queryset(self._self_identity_map, rel_qs, rel_obj_attr=rel_obj_attr)
         return (IdentityMapIteratorWrapper(identity_map, rel_qs), identity_map.rel_obj_attr) + prefetch_data[2:]
 
 
@@ -91,16 +234,21 @@ class IdentityMapPrefetchQuerySetWrapper(IdentityMapObjectProxy):
 
 
 class ForwardDescriptorPrefetchQuerySetWrapper(IdentityMapPrefetchQuerySetWrapper):
-    __slots__ = ("_self_field", "_self_instances_dict", "_self_prefix")
+    __slots__ = ("_self_field", "_self_instances_dict", "_self_prefix", "_self_missing_keys", "_self_requested")
 
-    def __init__(self, identity_map, field, instances_dict, prefix, queryset):
+    def __init__(self, identity_map, field, instances_dict, prefix, queryset, missing_keys=None, requested=None):
         super().__init__(identity_map, queryset)
         self._self_field = field
         self._self_instances_dict = instances_dict
         self._self_prefix = prefix
+        self._self_missing_keys = missing_keys
+        self._self_requested = requested
 
     def __iter__(self):
-        all_related_objects = itertools.chain(self._self_prefix, self.__wrapped__)
+        all_related_objects = itertools.chain(
+            self._self_prefix,
+            iter_recording_missing_keys(self.__wrapped__, self._self_missing_keys, self._self_requested),
+        )
 
         # If the associated field is not one-to-one, then we can't set any
         # cached values on the related objects as we may not have fetched
@@ -121,8 +269,30 @@ class ForwardDescriptorPrefetchQuerySetWrapper(IdentityMapPrefetchQuerySetWrappe
             yield rel_obj
 
 
+def get_parent_from_child(field, instance):
+    """
+    Returns an instance of the parent model for the multi-table
+    inheritance parent link *field* built from the values already loaded
+    on *instance*, as Django does when the parent link is accessed.  If
+    any of them are deferred, then ``None`` is returned.
+    """
+    parent_model = field.remote_field.model
+    attnames = [parent_field.attname for parent_field in parent_model._meta.concrete_fields]
+    deferred = instance.get_deferred_fields()
+    if any(attname in deferred for attname in attnames):
+        return None
+    parent = parent_model(**{attname: getattr(instance, attname) for attname in attnames})
+    parent._state.adding = instance._state.adding
+    parent._state.db = instance._state.db
+    return parent
+
+
 class ForwardDescriptorPrefetchWrapper(IdentityMapObjectProxy):
     def get_prefetch_queryset(self, instances, queryset=None):
+        missing_keys = get_missing_keys(self._self_identity_map, queryset)
+        # The parents in multi-table inheritance can be built from their
+        # children, but only when there's no queryset to apply to them.
+        parent_link = queryset is None and self.field.remote_field.parent_link
         if queryset is None:
             queryset = self.get_queryset()
         queryset._add_hints(instance=instances[0])
@@ -131,36 +301,44 @@ class ForwardDescriptorPrefetchWrapper(IdentityMapObjectProxy):
         instance_attr = self.field.get_local_related_value
         instances_dict = {instance_attr(inst): inst for inst in instances}
         related_field = self.field.foreign_related_fields[0]
+        related_model = self.field.related_model
 
         # Go through and find any instance which may already have their
         # related object already in the identity map.  If there are annotations,
         # then we need to perform the query to get the annotation values even
         # if we've already fetched the underlying object.
         if len(self.field.foreign_related_fields) == 1 and not queryset.query.annotations:
-            sub_identity_map = self._self_identity_map.get_map_for_model(self.field.related_model)
-
             # Check to see if the to_field for the relation is to the related
-            # model's primary key.  If is not, then we need to get a dictionary
-            # of instances whose keys are the to_field values.
-            (to_field,) = self.field.to_fields
-            if to_field is not None:
-                related_model_meta = self.field.related_model._meta
-                pk_field_name = related_model_meta.pk and related_model_meta.pk.name
-                if to_field != pk_field_name:
-                    sub_identity_map = {rel_obj_attr(obj)[0]: obj for obj in sub_identity_map.values()}
+            # model's primary key.  If is not, then we use the identity map's
+            # index of instances by the to_field values.
+            if related_field.primary_key:
+                sub_identity_map = self._self_identity_map.get_map_for_model(related_model)
+            else:
+                sub_identity_map = self._self_identity_map.get_map_for_field(related_model, related_field)
 
             new_instances = []
             prefix = []
             for instance in instances:
                 rel_pk = instance_attr(instance)[0]
                 rel_obj = sub_identity_map.get(rel_pk)
-                if rel_obj is not None:
+                # The to_field value may have been changed since the related
+                # object was added to the index.
+                if rel_obj is not None and rel_obj_attr(rel_obj)[0] == rel_pk:
+                    if type(rel_obj) is not related_model:
+                        rel_obj = self._self_identity_map.cast(rel_obj, related_model)
                     prefix.append(rel_obj)
+                elif missing_keys is not None and missing_keys.contains(related_model, related_field.attname, rel_pk):
+                    continue
                 else:
-                    new_instances.append(instance)
+                    parent = get_parent_from_child(self.field, instance) if parent_link else None
+                    if parent is not None:
+                        prefix.append(self._self_identity_map[parent])
+                    else:
+                        new_instances.append(instance)
             instances = new_instances
         else:
             prefix = []
+            missing_keys = None
 
         # FIXME: This will need to be revisited when we introduce support for
         # composite fields. In the meantime we take this practical approach to
@@ -183,41 +361,38 @@ class ForwardDescriptorPrefetchWrapper(IdentityMapObjectProxy):
         else:
             queryset = queryset.none()
 
+        # The values which aren't found are recorded so that they aren't
+        # queried for again.
+        requested = {(related_model, related_field.attname): set(instance_attr(inst)[0] for inst in instances)}
         cache_name = getattr(self, "cache_name", self.field.get_cache_name())
         queryset = ForwardDescriptorPrefetchQuerySetWrapper(
-            self._self_identity_map, self.field, instances_dict, prefix, queryset
+            self._self_identity_map, self.field, instances_dict, prefix, queryset, missing_keys, requested
         )
         return (queryset, rel_obj_attr, instance_attr, True, cache_name, False)
 
 
 class ReverseOneToOnePrefetchQuerySetWrapper(IdentityMapPrefetchQuerySetWrapper):
-    __slots__ = ("_self_related", "_self_instances_dict")
+    __slots__ = ("_self_related", "_self_instances_dict", "_self_missing_keys", "_self_requested")
 
-    def __init__(self, identity_map, related, instances_dict, queryset):
+    def __init__(self, identity_map, related, instances_dict, queryset, missing_keys=None, requested=None):
         super().__init__(identity_map, queryset)
         self._self_related = related
         self._self_instances_dict = instances_dict
+        self._self_missing_keys = missing_keys
+        self._self_requested = requested
 
     def __iter__(self):
-        field = self._self_related.field
-        (to_field,) = field.to_fields
-
-        # Check to see if the to_field for the relation is to the related
-        # model's primary key.  If is not, then we need to get a dictionary
-        # of instances whose keys are the to_field values.
+        # The instances are already keyed by the to_field values, so they
+        # can be looked up directly even if the to_field is not the primary
+        # key.
         instances_dict = self._self_instances_dict
-        if to_field is not None:
-            related_model_meta = field.related_model._meta
-            pk_field_name = related_model_meta.pk and related_model_meta.pk.name
-            if to_field != pk_field_name:
-                instance_attr = self._self_related.field.get_foreign_related_value
-                instances_dict = {instance_attr(obj): obj for obj in self._self_instances_dict.values()}
 
         # Go through all of the related objects, apply the identity map, and
         # set the instance on the related object
         rel_obj_attr = self._self_related.field.get_local_related_value
         rel_obj_cache_name = self._self_related.field.get_cache_name()
-        for rel_obj in self.__wrapped__:
+        rows = iter_recording_missing_keys(self.__wrapped__, self._self_missing_keys, self._self_requested)
+        for rel_obj in rows:
             rel_obj = self._self_identity_map[rel_obj]
             instance = instances_dict[rel_obj_attr(rel_obj)]
             setattr(rel_obj, rel_obj_cache_name, instance)
@@ -226,6 +401,7 @@ class ReverseOneToOnePrefetchQuerySetWrapper(IdentityMapPrefetchQuerySetWrapper)
 
 class ReverseOneToOneDescriptorPrefetchWrapper(IdentityMapObjectProxy):
     def get_prefetch_queryset(self, instances, queryset=None):
+        missing_keys = get_missing_keys(self._self_identity_map, queryset)
         if queryset is None:
             queryset = self.get_queryset()
         queryset._add_hints(instance=instances[0])
@@ -239,40 +415,122 @@ class ReverseOneToOneDescriptorPrefetchWrapper(IdentityMapObjectProxy):
         instance_attr = self.related.field.get_foreign_related_value
 
         instances_dict = {instance_attr(inst): inst for inst in instances}
-        query = {"%s__in" % self.related.field.name: instances}
-        queryset = queryset.filter(**query)
+
+        # Skip the instances which were found not to have a related
+        # object before, and record the ones which don't have one now.
+        # Only single column relations are handled.
+        requested = None
+        if missing_keys is not None and len(self.related.field.local_related_fields) == 1:
+            model = self.related.related_model
+            attname = self.related.field.attname
+            instances = [
+                inst for inst in instances if not missing_keys.contains(model, attname, instance_attr(inst)[0])
+            ]
+            requested = {(model, attname): set(instance_attr(inst)[0] for inst in instances)}
+        else:
+            missing_keys = None
+
+        if instances:
+            query = {"%s__in" % self.related.field.name: instances}
+            queryset = queryset.filter(**query)
+        else:
+            queryset = queryset.none()
 
         # Since we're going to assign directly in the cache,
         # we must manage the reverse relation cache manually.
         queryset = ReverseOneToOnePrefetchQuerySetWrapper(
-            self._self_identity_map, self.related, instances_dict, queryset
+            self._self_identity_map, self.related, instances_dict, queryset, missing_keys, requested
         )
         cache_name = getattr(self, "cache_name", self.related.get_cache_name())
         return (queryset, rel_obj_attr, instance_attr, True, cache_name, False)
 
 
 class ReverseManyToOnePrefetchQuerySetWrapper(IdentityMapPrefetchQuerySetWrapper):
-    __slots__ = ("_self_field", "_self_instances_dict")
-
-    def __init__(self, identity_map, field, instances_dict, queryset):
+    __slots__ = (
+        "_self_field",
+        "_self_instances_dict",
+        "_self_prefix",
+        "_self_relation_key",
+        "_self_new_instances",
+        "_self_keyed_rows",
+        "_self_results",
+    )
+
+    def __init__(
+        self,
+        identity_map,
+        field,
+        instances_dict,
+        queryset,
+        prefix=(),
+        relation_key=None,
+        new_instances=(),
+        keyed_rows=None,
+    ):
         super().__init__(identity_map, queryset)
         self._self_field = field
         self._self_instances_dict = instances_dict
+        self._self_prefix = prefix
+        self._self_relation_key = relation_key
+        self._self_new_instances = new_instances
+        self._self_keyed_rows = keyed_rows
+        self._self_results = None
+
+    def _fetch_all(self):
+        # This is also used for len() so that list() doesn't evaluate the
+        # wrapped queryset when the related objects are fetched in two
+        # phases.
+        if self._self_results is None:
+            self._self_results = list(self._iter_related_objects())
+        return self._self_results
 
     def __iter__(self):
+        return iter(self._fetch_all())
+
+    def __len__(self):
+        return len(self._fetch_all())
+
+    def _iter_keyed_rows(self):
+        if self._self_keyed_rows is not None:
+            yield from self._self_keyed_rows()
+            return
+
         rel_obj_attr = self._self_field.get_local_related_value
         for rel_obj in self.__wrapped__:
             rel_obj = self._self_identity_map[rel_obj]
-            instance = self._self_instances_dict[rel_obj_attr(rel_obj)]
-            setattr(rel_obj, self._self_field.name, instance)
+            yield rel_obj_attr(rel_obj), rel_obj
+
+    def _iter_related_objects(self):
+        field_name = self._self_field.name
+        for instance, rel_objs in self._self_prefix:
+            for rel_obj in rel_objs:
+                setattr(rel_obj, field_name, instance)
+                yield rel_obj
+
+        fetched = defaultdict(list)
+        for key, rel_obj in self._iter_keyed_rows():
+            instance = self._self_instances_dict[key]
+            setattr(rel_obj, field_name, instance)
+            fetched[key].append(rel_obj)
 
             yield rel_obj
 
+        record_complete_relations(
+            self._self_identity_map,
+            self._self_relation_key,
+            self._self_new_instances,
+            self._self_field.get_foreign_related_value,
+            fetched,
+        )
+
 
 class ReverseManyToOneDescriptorPrefetchWrapper(IdentityMapObjectProxy):
-    def get_prefetch_queryset(self, instances, queryset=None):
+    def get_prefetch_queryset(self, instances, queryset=None, two_phase=False):
+        two_phase = two_phase and queryset is None
+        cache_name = self.field.remote_field.get_cache_name()
+        relation_key = get_relation_key(self._self_identity_map, cache_name, queryset)
         if queryset is None:
-            queryset = super(type(self.__wrapped__), self.__wrapped__).get_queryset()
+            queryset = super(get_related_manager_class(self.__wrapped__), self.__wrapped__).get_queryset()
 
         queryset._add_hints(instance=instances[0])
         queryset = queryset.using(queryset._db or self._db)
@@ -280,76 +538,294 @@ class ReverseManyToOneDescriptorPrefetchWrapper(IdentityMapObjectProxy):
         rel_obj_attr = self.field.get_local_related_value
         instance_attr = self.field.get_foreign_related_value
         instances_dict = {instance_attr(inst): inst for inst in instances}
-        query = {"%s__in" % self.field.name: instances}
-        queryset = queryset.filter(**query)
+
+        # Only query for the instances whose related objects haven't all
+        # been fetched before.
+        prefix, new_instances = split_complete_relations(self._self_identity_map, instances, relation_key)
+        base_queryset = queryset
+        if new_instances:
+            query = {"%s__in" % self.field.name: new_instances}
+            queryset = queryset.filter(**query)
+        else:
+            queryset = queryset.none()
+
+        # When fetching in two phases, only the keys and primary keys are
+        # queried for at first.
+        keyed_rows = None
+        if two_phase and new_instances:
+            attnames = [field.attname for field in self.field.local_related_fields]
+            pairs_queryset = queryset.values_list(*attnames, "pk")
+            keyed_rows = partial(iter_two_phase, self._self_identity_map, pairs_queryset, base_queryset)
 
         # Since we just bypassed this class' get_queryset(), we must manage
         # the reverse relation manually.
         queryset = ReverseManyToOnePrefetchQuerySetWrapper(
-            self._self_identity_map, self.field, instances_dict, queryset
+            self._self_identity_map,
+            self.field,
+            instances_dict,
+            queryset,
+            prefix,
+            relation_key,
+            new_instances,
+            keyed_rows,
         )
-        cache_name = self.field.remote_field.get_cache_name()
 
         return (queryset, rel_obj_attr, instance_attr, False, cache_name, False)
 
 
 class ManyToManyPrefetchQuerySetWrapper(IdentityMapPrefetchQuerySetWrapper):
-    __slots__ = ("_self_rel_obj_attr", "_self_memo")
-
-    def __init__(self, identity_map, queryset, rel_obj_attr):
+    __slots__ = (
+        "_self_rel_obj_attr",
+        "_self_memo",
+        "_self_prefix",
+        "_self_relation_key",
+        "_self_new_instances",
+        "_self_instance_attr",
+        "_self_keyed_rows",
+        "_self_results",
+    )
+
+    def __init__(
+        self,
+        identity_map,
+        queryset,
+        rel_obj_attr,
+        prefix=(),
+        relation_key=None,
+        new_instances=(),
+        instance_attr=None,
+        keyed_rows=None,
+    ):
         super().__init__(identity_map, queryset)
         self._self_rel_obj_attr = rel_obj_attr
         self._self_memo = {}
+        self._self_prefix = prefix
+        self._self_relation_key = relation_key
+        self._self_new_instances = new_instances
+        self._self_instance_attr = instance_attr
+        self._self_keyed_rows = keyed_rows
+        self._self_results = None
+
+    def _fetch_all(self):
+        # This is also used for len() so that list() doesn't evaluate the
+        # wrapped queryset before the keys are read from its rows.
+        if self._self_results is None:
+            self._self_results = list(self._iter_related_objects())
+        return self._self_results
 
     def __iter__(self):
-        for rel_obj in self.__wrapped__:
-            self._self_memo.setdefault(rel_obj, []).append(self._self_rel_obj_attr(rel_obj))
-            yield self._self_identity_map[rel_obj]
+        return iter(self._fetch_all())
+
+    def __len__(self):
+        return len(self._fetch_all())
+
+    def _iter_related_objects(self):
+        for key, rel_objs in self._self_prefix:
+            for rel_obj in rel_objs:
+                self._self_memo.setdefault(rel_obj, deque()).append(key)
+                yield rel_obj
+
+        fetched = defaultdict(list)
+        for key, rel_obj in self._iter_keyed_rows():
+            self._self_memo.setdefault(rel_obj, deque()).append(key)
+            fetched[key].append(rel_obj)
+            yield rel_obj
+
+        record_complete_relations(
+            self._self_identity_map,
+            self._self_relation_key,
+            self._self_new_instances,
+            self._self_instance_attr,
+            fetched,
+        )
+
+    def _iter_keyed_rows(self):
+        if self._self_keyed_rows is not None:
+            yield from self._self_keyed_rows()
+            return
+
+        # The rows are iterated over directly so that the key for each one
+        # is read from its own row rather than from an instance which is
+        # shared with a later row through a persistent identity map.
+        queryset = self.__wrapped__
+        rows = queryset._iterable_class(queryset) if queryset._result_cache is None else queryset
+        for rel_obj in rows:
+            key = self._self_rel_obj_attr(rel_obj)
+            yield key, self._self_identity_map[rel_obj]
 
     def rel_obj_attr(self, rel_obj):
-        return self._self_memo[rel_obj].pop()
+        # The keys are used in the order that they were added so that the
+        # related objects keep the queryset's ordering.
+        return self._self_memo[rel_obj].popleft()
 
 
 class ManyToManyRelatedManagerWrapper(IdentityMapObjectProxy):
-    def get_prefetch_queryset(self, instances, queryset=None):
-        prefetch_tuple = self.__wrapped__.get_prefetch_queryset(instances, queryset=queryset)
-        rel_qs, rel_obj_attr = prefetch_tuple[:2]
-        rel_qs_wrapper = ManyToManyPrefetchQuerySetWrapper(self._self_identity_map, rel_qs, rel_obj_attr)
+    def get_prefetch_queryset(self, instances, queryset=None, two_phase=False):
+        two_phase = two_phase and queryset is None
+        relation_key = get_relation_key(self._self_identity_map, self.prefetch_cache_name, queryset)
+
+        # Only query for the instances whose related objects haven't all
+        # been fetched before.
+        prefix, new_instances = split_complete_relations(self._self_identity_map, instances, relation_key)
+        prefetch_tuple = self.__wrapped__.get_prefetch_queryset(new_instances or instances, queryset=queryset)
+        rel_qs, rel_obj_attr, instance_attr = prefetch_tuple[:3]
+        if not new_instances:
+            rel_qs = rel_qs.none()
+
+        # When fetching in two phases, only the values of the join columns
+        # and the primary keys of the related objects are queried for at
+        # first.
+        keyed_rows = None
+        key_names = [name for name in rel_qs.query.extra_select if name.startswith(PREFETCH_RELATED_VAL_PREFIX)]
+        if two_phase and new_instances and key_names:
+            pairs_queryset = rel_qs.values_list(*key_names, "pk")
+            base_queryset = super(get_related_manager_class(self.__wrapped__), self.__wrapped__).get_queryset()
+            base_queryset._add_hints(instance=instances[0])
+            base_queryset = base_queryset.using(rel_qs.db)
+            keyed_rows = partial(iter_two_phase, self._self_identity_map, pairs_queryset, base_queryset)
+
+        rel_qs_wrapper = ManyToManyPrefetchQuerySetWrapper(
+            self._self_identity_map,
+            rel_qs,
+            rel_obj_attr,
+            [(instance_attr(instance), rel_objs) for instance, rel_objs in prefix],
+            relation_key,
+            new_instances,
+            instance_attr,
+            keyed_rows,
+        )
         return (rel_qs_wrapper, rel_qs_wrapper.rel_obj_attr) + prefetch_tuple[2:]
 
 
+def fetch_querysets(querysets, concurrent=False):
+    """
+    Returns a list containing the list of objects fetched by each of
+    *querysets*.  If *concurrent* is ``True``, then each of them is
+    fetched in a separate thread.
+
+    The rows are fetched without applying a persistent identity map so
+    that it is only used from the calling thread.
+    """
+    funcs = [partial(fetch_rows, queryset) for queryset in querysets]
+    if concurrent:
+        return run_concurrently(funcs)
+    return [func() for func in funcs]
+
+
+def fetch_rows(queryset):
+    return list(queryset._iterable_class(queryset))
+
+
 class GenericForeignKeyPrefetchWrapper(IdentityMapObjectProxy):
+    """
+    A wrapper for a ``GenericForeignKey`` which groups the instances by
+    content type, reuses the related objects in the identity map, and
+    does one query for each content type for the rest of them.
+
+    If the ``PREFETCH_UTILS_GENERIC_PREFETCH_CONCURRENT`` setting is
+    ``True``, then the queries for different content types are run at
+    the same time in separate threads when not inside a transaction.
+    """
+
     def get_prefetch_queryset(self, instances, queryset=None):
+        # A GenericPrefetch passes a queryset for each model.
+        if isinstance(queryset, GenericQuerySets):
+            custom_querysets, queryset = queryset, None
+        elif queryset is not None:
+            raise ValueError("Custom queryset can't be used for this lookup.")
+        else:
+            custom_querysets = {}
+
         ct_attname = self.model._meta.get_field(self.ct_field).get_attname()
+        missing_keys = get_missing_keys(self._self_identity_map, queryset)
 
-        # Go through and check for instances which may have already their
-        # content_object fetched.
-        prefix = []  # list of already fetched related objects
-        new_instances = []  # list of instances whose related objects need fetching
+        # Group the primary keys of the related objects by database and
+        # content type so that each content type is only resolved once.
+        fk_dict = defaultdict(set)
         for instance in instances:
-            # Determine the content type for the generic foreign key
             ct_id = getattr(instance, ct_attname)
             if ct_id is None:
                 continue
+            fk_val = getattr(instance, self.fk_field)
+            if fk_val is not None:
+                fk_dict[(instance._state.db, ct_id)].add(fk_val)
 
-            ct = self.get_content_type(id=ct_id)  # todo: do we need "using" here?
-            model = ct.model_class()
+        # Go through and check for related objects which are already in the
+        # identity map.
+        models = {}  # the model for each (database, content type id) pair
+        prefix = []  # list of already fetched related objects
+        querysets = []  # the querysets for the related objects which need fetching
+        requested = {}  # the primary keys being fetched for each model
+        for (db, ct_id), fk_vals in fk_dict.items():
+            ct = self.get_content_type(id=ct_id, using=db)
+            model = models[(db, ct_id)] = ct.model_class()
+            if model is None:
+                continue
+
+            # All of the related objects for a custom queryset are fetched
+            # with it so that its filters and related lookups apply to them.
+            pk_field = model._meta.pk
+            custom_queryset = custom_querysets.get(model)
+            if custom_queryset is not None:
+                pks = {pk_field.get_prep_value(fk_val) for fk_val in fk_vals}
+                querysets.append(custom_queryset.filter(pk__in=pks))
+                continue
 
-            # Check to see the corresponding object is in the identity map
-            fk_val = getattr(instance, self.fk_field)
             sub_identity_map = self._self_identity_map.get_map_for_model(model)
-            rel_obj = sub_identity_map.get(fk_val)
+            pks = set()
+            for fk_val in fk_vals:
+                pk = pk_field.get_prep_value(fk_val)
+                rel_obj = sub_identity_map.get(pk)
+                if rel_obj is not None:
+                    if type(rel_obj) is not model:
+                        rel_obj = self._self_identity_map.cast(rel_obj, model)
+                    prefix.append(rel_obj)
+                elif missing_keys is None or not missing_keys.contains(model, pk_field.attname, pk):
+                    pks.add(pk)
 
-            if rel_obj is not None:
-                prefix.append(rel_obj)
-            else:
-                new_instances.append(instance)
+            if pks:
+                querysets.append(ct.get_all_objects_for_this_type(pk__in=pks))
+                requested[(model, pk_field.attname)] = pks
+
+        concurrent = (
+            len(querysets) > 1
+            and getattr(settings, "PREFETCH_UTILS_GENERIC_PREFETCH_CONCURRENT", False)
+            and can_prefetch_concurrently(instances)
+        )
+        rel_objs = []
+        for rel_qs, rows in zip(querysets, fetch_querysets(querysets, concurrent=concurrent)):
+            if rel_qs.model not in custom_querysets:
+                rel_objs.extend(rows)
+                continue
 
-        # We can use the underlying get_prefetch_queryset method since
-        # it doesn't manipulate new_instances or any of the related objects
-        prefetch_data = self.__wrapped__.get_prefetch_queryset(new_instances, queryset)
-        queryset = GenericForeignKeyPrefetchQuerySetWrapper(self._self_identity_map, prefix, prefetch_data[0])
-        return (queryset,) + prefetch_data[1:]
+            rows_identity_map = wrap_identity_map_for_queryset(self._self_identity_map, rel_qs)
+            rows = [rows_identity_map[rel_obj] for rel_obj in rows]
+            if rel_qs._prefetch_related_lookups:
+                # This is imported here to avoid a circular import.
+                from . import prefetch_related_objects_impl
+
+                prefetch_related_objects_impl(self._self_identity_map, rows, *rel_qs._prefetch_related_lookups)
+            prefix.extend(rows)
+
+        queryset = GenericForeignKeyPrefetchQuerySetWrapper(
+            self._self_identity_map, prefix, rel_objs, missing_keys, requested
+        )
+
+        # For doing the join in Python, we have to match both the primary
+        # key and the model, using the models resolved above.
+        def gfk_key(obj):
+            ct_id = getattr(obj, ct_attname)
+            if ct_id is None:
+                return None
+            key = (obj._state.db, ct_id)
+            if key not in models:
+                models[key] = self.get_content_type(id=ct_id, using=obj._state.db).model_class()
+            model = models[key]
+            if model is None:
+                return None
+            return (model._meta.pk.get_prep_value(getattr(obj, self.fk_field)), model)
+
+        return (queryset, lambda obj: (obj.pk, obj.__class__), gfk_key, True, self.name, False)
 
 
 class GenericForeignKeyPrefetchQuerySetWrapper(IdentityMapPrefetchQuerySetWrapper):
@@ -358,13 +834,18 @@ class GenericForeignKeyPrefetchQuerySetWrapper(IdentityMapPrefetchQuerySetWrappe
     the contents of the wrapped object.
     """
 
-    __slots__ = ("_self_prefix",)
+    __slots__ = ("_self_prefix", "_self_missing_keys", "_self_requested")
 
-    def __init__(self, identity_map, prefix, queryset):
+    def __init__(self, identity_map, prefix, queryset, missing_keys=None, requested=None):
         super().__init__(identity_map, queryset)
         self._self_prefix = prefix
+        self._self_missing_keys = missing_keys
+        self._self_requested = requested
 
     def __iter__(self):
-        all_related_objects = itertools.chain(self._self_prefix, self.__wrapped__)
+        all_related_objects = itertools.chain(
+            self._self_prefix,
+            iter_recording_missing_keys(self.__wrapped__, self._self_missing_keys, self._self_requested),
+        )
         for rel_obj in all_related_objects:
             yield self._self_identity_map[rel_obj]
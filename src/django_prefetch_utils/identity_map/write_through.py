@@ -0,0 +1,420 @@
+"""
+This module keeps a persistent identity map up to date with the changes
+made to the database through the ORM while it is in use, which can be
+enabled with the *write_through* argument to
+:class:`django_prefetch_utils.identity_map.persistent.use_persistent_prefetch_identity_map`::
+
+    with use_persistent_prefetch_identity_map(write_through=True):
+        book = Book.objects.prefetch_related("first_time_authors").get()
+        Author.objects.create(name="Anne", first_book=book)
+        book.first_time_authors.all()  # includes Anne
+
+While it is enabled:
+
+- saved instances which are not in the identity map are added to it,
+  and the values of the saved fields are copied to the instances which
+  are,
+- deleted instances are removed from the identity map,
+- instances created with ``bulk_create`` are added to the identity map,
+  and
+- the prefetched related objects and the relation records (see
+  :class:`~django_prefetch_utils.identity_map.maps.RelationSets`) of the
+  instances in the identity map which a saved, created or deleted
+  instance refers to through a foreign key, and of the instances on
+  either side of a changed many-to-many relation, are discarded so that
+  they are fetched again.
+
+The foreign key values of each instance are recorded when it is added
+to the identity map through :class:`WriteThroughIdentityMap`, so that
+the instances it used to refer to can be found without a query when
+its foreign keys are changed and it is saved.  If they weren't
+recorded, as for an instance which was loaded before the identity map
+was in use, the relation is discarded on all of the instances of the
+related model in the identity map.  Changes made with
+``QuerySet.update()`` or raw SQL are not seen, and related objects
+prefetched with a ``to_attr`` are not discarded.
+"""
+import threading
+from contextvars import ContextVar
+
+import wrapt
+from django.db.models.query import QuerySet
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from django.db.models.signals import pre_save
+
+_identity_map = ContextVar("prefetch_write_through_identity_map", default=None)
+
+# The attribute which holds the foreign key values that an instance had
+# before it was saved, from pre_save until post_save.
+OLD_VALUES_ATTR = "_prefetch_write_through_old_values"
+
+# The attribute which holds the foreign key values of an instance as they
+# are stored in the database, as far as the identity map knows.
+LOADED_VALUES_ATTR = "_prefetch_write_through_loaded_values"
+
+# The value recorded for a foreign key whose stored value isn't known.
+UNKNOWN = object()
+
+_foreign_key_attnames = {}
+
+# The signal receivers are only connected while write-through is
+# enabled in at least one context.
+_enabled_lock = threading.Lock()
+_enabled_count = 0
+
+original_bulk_create = QuerySet.bulk_create
+
+
+def enable_write_through(identity_map):
+    """
+    Enables keeping *identity_map* up to date with the changes made in
+    the current context, returning a token which can be passed to
+    :func:`reset_write_through`.
+    """
+    global _enabled_count
+    with _enabled_lock:
+        if not _enabled_count:
+            pre_save.connect(record_old_values, dispatch_uid=__name__)
+            post_save.connect(write_saved_instance, dispatch_uid=__name__)
+            post_delete.connect(evict_deleted_instance, dispatch_uid=__name__)
+            m2m_changed.connect(discard_changed_relations, dispatch_uid=__name__)
+            QuerySet.bulk_create = bulk_create
+        _enabled_count += 1
+    return _identity_map.set(identity_map)
+
+
+def reset_write_through(token):
+    """
+    Restores whether write-through was enabled before the call to
+    :func:`enable_write_through` which returned *token*.
+    """
+    global _enabled_count
+    _identity_map.reset(token)
+    with _enabled_lock:
+        _enabled_count -= 1
+        if not _enabled_count:
+            pre_save.disconnect(dispatch_uid=__name__)
+            post_save.disconnect(dispatch_uid=__name__)
+            post_delete.disconnect(dispatch_uid=__name__)
+            m2m_changed.disconnect(dispatch_uid=__name__)
+            QuerySet.bulk_create = original_bulk_create
+
+
+class WriteThroughIdentityMap(wrapt.ObjectProxy):
+    """
+    A wrapper for an identity map which records the foreign key values
+    of the instances returned by it, which are the values stored in the
+    database for the instances which have just been fetched.
+    """
+
+    def __getitem__(self, obj):
+        new_obj = self.__wrapped__[obj]
+        record_loaded_values(new_obj, obj)
+        return new_obj
+
+
+def get_foreign_keys(model):
+    """
+    Returns a list of the concrete foreign key and one-to-one fields of
+    *model*.
+
+    :rtype: list
+    """
+    return [field for field in model._meta.concrete_fields if field.is_relation and field.remote_field]
+
+
+def get_foreign_key_attnames(model):
+    """
+    Returns a tuple of the attribute names of the concrete foreign key
+    and one-to-one fields of *model*, or an empty tuple if *model* is not
+    a Django model.
+
+    :rtype: tuple
+    """
+    attnames = _foreign_key_attnames.get(model)
+    if attnames is None:
+        meta = getattr(model, "_meta", None)
+        attnames = () if meta is None else tuple(field.attname for field in get_foreign_keys(model))
+        _foreign_key_attnames[model] = attnames
+    return attnames
+
+
+def record_loaded_values(obj, source):
+    """
+    Records the foreign key values of *obj* which haven't been recorded
+    yet, taking them from *source*, which is either *obj* or an instance
+    fetched for the same row.
+    """
+    attnames = get_foreign_key_attnames(type(obj))
+    if not attnames:
+        return
+    obj_dict = obj.__dict__
+    source_dict = source.__dict__
+    loaded = obj_dict.get(LOADED_VALUES_ATTR)
+    if loaded is None:
+        obj_dict[LOADED_VALUES_ATTR] = {attname: source_dict[attname] for attname in attnames if attname in source_dict}
+    elif len(loaded) < len(attnames):
+        for attname in attnames:
+            if attname not in loaded and attname in source_dict:
+                loaded[attname] = source_dict[attname]
+
+
+def update_loaded_values(obj, update_fields=None):
+    """
+    Records the foreign key values of *obj* after it has been saved.  If
+    *update_fields* is given, only those fields are recorded.
+    """
+    obj_dict = obj.__dict__
+    loaded = obj_dict.setdefault(LOADED_VALUES_ATTR, {})
+    for field in get_foreign_keys(type(obj)):
+        if update_fields is not None and field.name not in update_fields and field.attname not in update_fields:
+            continue
+        if field.attname in obj_dict:
+            loaded[field.attname] = obj_dict[field.attname]
+
+
+def discard_relation(identity_map, instance, cache_name):
+    """
+    Discards the related objects prefetched for the relation
+    *cache_name* on *instance* along with the record of them in
+    *identity_map*.
+    """
+    prefetched = instance.__dict__.get("_prefetched_objects_cache")
+    if prefetched:
+        prefetched.pop(cache_name, None)
+    relation_sets = getattr(identity_map, "relation_sets", None)
+    if relation_sets is not None:
+        relation_sets.discard(type(instance), instance.pk, cache_name)
+
+
+def discard_parent_relations(identity_map, field, values):
+    """
+    Discards the reverse relation for the foreign key *field* on the
+    instances in *identity_map* which it refers to with *values*.
+    """
+    remote_field = field.remote_field
+    target_field = field.target_field
+    parent_model = remote_field.model
+    if target_field.primary_key:
+        parents = identity_map.get_map_for_model(parent_model)
+    else:
+        parents = identity_map.get_map_for_field(parent_model, target_field)
+
+    for value in values:
+        parent = parents.get(value) if value is not None else None
+        # The values in the field maps may be out of date.
+        if parent is not None and parent.__dict__.get(target_field.attname) == value:
+            discard_parent_relation(identity_map, field, parent)
+
+
+def discard_parent_relation(identity_map, field, parent):
+    """
+    Discards the reverse relation for the foreign key *field* on the
+    instance *parent* in *identity_map*.
+    """
+    remote_field = field.remote_field
+    if field.one_to_one:
+        if remote_field.is_cached(parent):
+            remote_field.delete_cached_value(parent)
+    else:
+        discard_relation(identity_map, parent, remote_field.get_cache_name())
+
+
+def discard_all_parent_relations(identity_map, field):
+    """
+    Discards the reverse relation for the foreign key *field* on all of
+    the instances of its related model in *identity_map*.
+    """
+    for parent in list(identity_map.get_map_for_model(field.remote_field.model).values()):
+        discard_parent_relation(identity_map, field, parent)
+
+
+def record_old_values(sender, instance, raw=False, using=None, **kwargs):
+    """
+    A ``pre_save`` receiver which records the foreign key values that
+    *instance* had before it was saved.
+    """
+    identity_map = _identity_map.get()
+    if identity_map is None:
+        return
+
+    old_values = None
+    if not raw and instance.pk is not None:
+        old_values = get_old_values(identity_map, sender, instance)
+    # This replaces any values left by an earlier save which failed.
+    instance.__dict__[OLD_VALUES_ATTR] = old_values
+
+
+def get_old_values(identity_map, model, instance):
+    """
+    Returns a dictionary of the foreign key values recorded as stored for
+    *instance* by the identity map, or ``None`` if they don't matter
+    because none of the instances they could refer to are in
+    *identity_map*.  The values which weren't recorded are
+    :data:`UNKNOWN`.
+
+    :rtype: dict
+    """
+    attnames = [
+        field.attname
+        for field in get_foreign_keys(model)
+        if len(identity_map.get_map_for_model(field.remote_field.model))
+    ]
+    if not attnames:
+        return None
+
+    mapped = identity_map.get_map_for_model(model).get(instance.pk)
+    loaded = mapped.__dict__.get(LOADED_VALUES_ATTR) if mapped is not None else None
+    if loaded is None:
+        return dict.fromkeys(attnames, UNKNOWN)
+    return {attname: loaded.get(attname, UNKNOWN) for attname in attnames}
+
+
+def copy_field_values(model, source, target, update_fields=None):
+    """
+    Copies the values of the concrete fields of *model* which are loaded
+    on *source* to *target*.  If *update_fields* is given, only those
+    fields are copied.  The cached related objects for foreign keys whose
+    values change are discarded.
+    """
+    source_dict = source.__dict__
+    target_dict = target.__dict__
+    for field in model._meta.concrete_fields:
+        if update_fields is not None and field.name not in update_fields and field.attname not in update_fields:
+            continue
+        attname = field.attname
+        if attname not in source_dict:
+            continue
+        value = source_dict[attname]
+        if attname in target_dict and target_dict[attname] == value:
+            continue
+        target_dict[attname] = value
+        if field.is_relation and field.is_cached(target):
+            field.delete_cached_value(target)
+
+
+def write_saved_instance(sender, instance, created=False, raw=False, using=None, update_fields=None, **kwargs):
+    """
+    A ``post_save`` receiver which adds *instance* to the identity map or
+    copies its saved field values to the instance already in it.
+    """
+    old_values = instance.__dict__.pop(OLD_VALUES_ATTR, None)
+    identity_map = _identity_map.get()
+    if identity_map is None or raw:
+        return
+
+    mapped = identity_map.get_map_for_model(sender).get(instance.pk)
+    if mapped is None:
+        mapped = identity_map[instance]
+    elif mapped.__dict__ is not instance.__dict__:
+        copy_field_values(sender, instance, mapped, update_fields)
+    update_loaded_values(mapped, update_fields)
+
+    # The parents in multi-table inheritance are saved without signals.
+    for parent_model in sender._meta.get_parent_list():
+        parent = identity_map.get_map_for_model(parent_model).get(getattr(instance, parent_model._meta.pk.attname))
+        if parent is not None:
+            copy_field_values(parent_model, instance, parent, update_fields)
+            update_loaded_values(parent, update_fields)
+
+    for field in get_foreign_keys(sender):
+        values = {instance.__dict__.get(field.attname)}
+        old_value = old_values.get(field.attname) if old_values else None
+        if old_value is UNKNOWN:
+            discard_all_parent_relations(identity_map, field)
+        else:
+            values.add(old_value)
+        discard_parent_relations(identity_map, field, values)
+
+
+def evict_deleted_instance(sender, instance, **kwargs):
+    """
+    A ``post_delete`` receiver which removes *instance* from the identity
+    map.
+    """
+    identity_map = _identity_map.get()
+    if identity_map is None:
+        return
+
+    mapped = identity_map.get_map_for_model(sender).get(instance.pk)
+    loaded = (mapped if mapped is not None else instance).__dict__.get(LOADED_VALUES_ATTR) or {}
+    identity_map.discard(sender, instance.pk)
+    for field in get_foreign_keys(sender):
+        values = {instance.__dict__.get(field.attname), loaded.get(field.attname)}
+        discard_parent_relations(identity_map, field, values)
+
+
+def get_many_to_many_field(through, model):
+    """
+    Returns the many-to-many field on *model* whose intermediate model is
+    *through*.
+    """
+    for field in model._meta.many_to_many:
+        if field.remote_field.through is through:
+            return field
+    return None
+
+
+def discard_changed_relations(sender, instance, action, reverse, model, pk_set, **kwargs):
+    """
+    A ``m2m_changed`` receiver which discards the relations changed on
+    *instance* and the related objects in the identity map.
+    """
+    identity_map = _identity_map.get()
+    if identity_map is None or action not in ("post_add", "post_remove", "post_clear"):
+        return
+
+    field = get_many_to_many_field(sender, model if reverse else type(instance))
+    if field is None:
+        return
+    if field.remote_field.symmetrical:
+        cache_name = related_cache_name = field.name
+    elif reverse:
+        cache_name, related_cache_name = field.related_query_name(), field.name
+    else:
+        cache_name, related_cache_name = field.name, field.related_query_name()
+
+    discard_relation(identity_map, instance, cache_name)
+    mapped = identity_map.get_map_for_model(type(instance)).get(instance.pk)
+    if mapped is not None and mapped is not instance:
+        discard_relation(identity_map, mapped, cache_name)
+
+    related = identity_map.get_map_for_model(model)
+    if pk_set is None:
+        related_objs = list(related.values())
+    else:
+        related_objs = [related.get(pk) for pk in pk_set]
+    for obj in related_objs:
+        if obj is not None:
+            discard_relation(identity_map, obj, related_cache_name)
+
+
+def bulk_create(self, *args, **kwargs):
+    """
+    A replacement for ``QuerySet.bulk_create`` which adds the created
+    instances to the identity map, since no signals are sent for them.
+    """
+    objs = original_bulk_create(self, *args, **kwargs)
+    identity_map = _identity_map.get()
+    if identity_map is None:
+        return objs
+
+    model = self.model
+    missing_keys = getattr(identity_map, "missing_keys", None)
+    if missing_keys is not None:
+        missing_keys.discard_model(model)
+
+    foreign_keys = get_foreign_keys(model)
+    for obj in objs:
+        if obj.pk is not None:
+            mapped = identity_map.get_map_for_model(model).get(obj.pk)
+            if mapped is None:
+                identity_map[obj]
+            elif mapped.__dict__ is not obj.__dict__:
+                copy_field_values(model, obj, mapped)
+                update_loaded_values(mapped)
+        for field in foreign_keys:
+            discard_parent_relations(identity_map, field, [obj.__dict__.get(field.attname)])
+    return objs
@@ -0,0 +1,176 @@
+"""
+This module provides a way of being notified just before a relation on
+a model instance is loaded from the database because it has not
+already been fetched (either through ``select_related`` or
+``prefetch_related``).
+
+A hook is a function which takes the model instance and the name of the
+relation, which is the name that would be passed to
+``prefetch_related``::
+
+    def log_access(instance, attname):
+        print("Loading {} for {!r}".format(attname, instance))
+
+    add_relation_access_hook(log_access)
+
+The hooks are called when:
+
+- a forward many-to-one or one-to-one relation is accessed which is not
+  cached and whose foreign key is not null,
+- a reverse one-to-one relation is accessed which is not cached,
+- ``all()`` is called on a reverse many-to-one or many-to-many related
+  manager whose objects have not been prefetched, or
+- a generic foreign key is accessed which is not cached.
+
+Adding a hook replaces the ``__get__`` methods of Django's related
+descriptors, and removing the last hook restores them.
+"""
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.fields import GenericRel
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+from django.db.models.fields.related_descriptors import ManyToManyDescriptor
+from django.db.models.fields.related_descriptors import ReverseManyToOneDescriptor
+from django.db.models.fields.related_descriptors import ReverseOneToOneDescriptor
+
+_hooks = []
+
+# The attribute of a related descriptor which caches the subclass of its
+# related manager class that calls the hooks.
+HOOKED_MANAGER_CLASS_ATTR = "_prefetch_hooked_related_manager_cls"
+
+original_forward_many_to_one_get = ForwardManyToOneDescriptor.__get__
+original_reverse_one_to_one_get = ReverseOneToOneDescriptor.__get__
+original_reverse_many_to_one_get = ReverseManyToOneDescriptor.__get__
+original_generic_foreign_key_get = GenericForeignKey.__get__
+
+
+def add_relation_access_hook(hook):
+    """
+    Adds *hook* to the functions called before an unfetched relation is
+    loaded.
+    """
+    if hook not in _hooks:
+        _hooks.append(hook)
+    enable_relation_access_hooks()
+
+
+def remove_relation_access_hook(hook):
+    """
+    Removes *hook* from the functions called before an unfetched
+    relation is loaded.
+    """
+    if hook in _hooks:
+        _hooks.remove(hook)
+    if not _hooks:
+        disable_relation_access_hooks()
+
+
+def notify_relation_access(instance, attname):
+    """
+    Calls each of the registered hooks with *instance* and *attname*.
+    """
+    for hook in list(_hooks):
+        hook(instance, attname)
+
+
+def enable_relation_access_hooks():
+    """
+    Replaces the ``__get__`` methods of Django's related descriptors with
+    ones which call the registered hooks.
+    """
+    ForwardManyToOneDescriptor.__get__ = _forward_many_to_one_get
+    ReverseOneToOneDescriptor.__get__ = _reverse_one_to_one_get
+    ReverseManyToOneDescriptor.__get__ = _reverse_many_to_one_get
+    GenericForeignKey.__get__ = _generic_foreign_key_get
+
+
+def disable_relation_access_hooks():
+    """
+    Restores the original ``__get__`` methods of Django's related
+    descriptors.
+    """
+    ForwardManyToOneDescriptor.__get__ = original_forward_many_to_one_get
+    ReverseOneToOneDescriptor.__get__ = original_reverse_one_to_one_get
+    ReverseManyToOneDescriptor.__get__ = original_reverse_many_to_one_get
+    GenericForeignKey.__get__ = original_generic_foreign_key_get
+
+
+def _forward_many_to_one_get(self, instance, cls=None):
+    if instance is not None and _hooks and not self.field.is_cached(instance):
+        if None not in self.field.get_local_related_value(instance):
+            notify_relation_access(instance, self.field.name)
+    return original_forward_many_to_one_get(self, instance, cls)
+
+
+def _reverse_one_to_one_get(self, instance, cls=None):
+    if instance is not None and _hooks and instance.pk is not None and not self.related.is_cached(instance):
+        notify_relation_access(instance, self.related.get_accessor_name())
+    return original_reverse_one_to_one_get(self, instance, cls)
+
+
+def get_relation_name(descriptor):
+    """
+    Returns the name used to prefetch the relation of the reverse
+    many-to-one, many-to-many or generic relation *descriptor*.
+    """
+    if isinstance(descriptor.rel, GenericRel):
+        return descriptor.field.name
+    if isinstance(descriptor, ManyToManyDescriptor) and not descriptor.reverse:
+        return descriptor.field.name
+    return descriptor.rel.get_accessor_name()
+
+
+def get_hooked_manager_class(descriptor):
+    """
+    Returns a subclass of the related manager class of *descriptor* whose
+    ``all()`` calls the hooks if the related objects have not been
+    prefetched.  It is created the first time it is needed and then
+    cached on *descriptor*.
+    """
+    manager_class = descriptor.__dict__.get(HOOKED_MANAGER_CLASS_ATTR)
+    if manager_class is not None:
+        return manager_class
+
+    attname = get_relation_name(descriptor)
+
+    class HookedRelatedManager(descriptor.related_manager_cls):
+        is_hooked_related_manager = True
+
+        def all(self):
+            instance = self.instance
+            cache_name = getattr(self, "prefetch_cache_name", None) or self.field.remote_field.get_cache_name()
+            if (
+                _hooks
+                and instance.pk is not None
+                and cache_name not in getattr(instance, "_prefetched_objects_cache", ())
+            ):
+                notify_relation_access(instance, attname)
+            return super().all()
+
+    descriptor.__dict__[HOOKED_MANAGER_CLASS_ATTR] = HookedRelatedManager
+    return HookedRelatedManager
+
+
+def get_related_manager_class(manager):
+    """
+    Returns the related manager class which *manager* is an instance of,
+    skipping the subclass created by :func:`get_hooked_manager_class`.
+    This is the class to pass to ``super()`` to get the unfiltered
+    queryset of the related model.
+    """
+    manager_class = type(manager)
+    if manager_class.__dict__.get("is_hooked_related_manager"):
+        return manager_class.__bases__[0]
+    return manager_class
+
+
+def _reverse_many_to_one_get(self, instance, cls=None):
+    if instance is None or not _hooks:
+        return original_reverse_many_to_one_get(self, instance, cls)
+    return get_hooked_manager_class(self)(instance)
+
+
+def _generic_foreign_key_get(self, instance, cls=None):
+    if instance is not None and _hooks and not self.is_cached(instance):
+        notify_relation_access(instance, self.name)
+    return original_generic_foreign_key_get(self, instance, cls)
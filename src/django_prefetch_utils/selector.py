@@ -31,20 +31,26 @@ be used::
         with override_prefetch_related_objects(prefetch_related_objects):
             toys = list(Toy.objects.all)  # uses identity map implementation
 
+The overrides are stored in a :class:`contextvars.ContextVar`, so they
+apply to the current thread or asyncio task (and anything run in a copy
+of its context, such as ``sync_to_async``) rather than leaking between
+concurrent requests.
 """
-import threading
+import copy
 from contextlib import ContextDecorator
+from contextvars import ContextVar
 
 import django.db.models.query
 from django.db.models.query import prefetch_related_objects as original_prefetch_related_objects
 
-_active = threading.local()
+_default = None
+_active = ContextVar("prefetch_related_objects", default=None)
 
 
 def enable_prefetch_related_objects_selector():
     """
     Changes ``django.db.models.query.prefetch_related_objects`` to an
-    implemention which allows thread-local overrides.
+    implemention which allows context-local overrides.
     """
     django.db.models.query.prefetch_related_objects = _prefetch_related_objects_selector
 
@@ -75,8 +81,11 @@ def set_default_prefetch_related_objects(func):
         >>> set_default_prefetch_related_objects(some_implementation)
         >>> get_prefetch_related_objects()
         <function some_implementation>
+
+    The default applies to all threads and asyncio tasks.
     """
-    _active.value = func
+    global _default
+    _default = func
 
 
 def remove_default_prefetch_related_objects():
@@ -90,7 +99,8 @@ def remove_default_prefetch_related_objects():
         >>> get_prefetch_related_objects()
         <function django.db.models.query.prefetch_related_objects>
     """
-    _active.value = None
+    global _default
+    _default = None
 
 
 def get_prefetch_related_objects():
@@ -103,8 +113,7 @@ def get_prefetch_related_objects():
 
     :returns: a function
     """
-    active = getattr(_active, "value", None)
-    return active or original_prefetch_related_objects
+    return _active.get() or _default or original_prefetch_related_objects
 
 
 class override_prefetch_related_objects(ContextDecorator):
@@ -128,14 +137,20 @@ class override_prefetch_related_objects(ContextDecorator):
 
     def __init__(self, func):
         self.func = func
-        self.original_value = None
+        self._tokens = []
+
+    def _recreate_cm(self):
+        # Each use as a decorator gets its own tokens so that calls in
+        # different threads or tasks don't reset each other's values.
+        cm = copy.copy(self)
+        cm._tokens = []
+        return cm
 
     def __enter__(self):
-        self.original_value = getattr(_active, "value", None)
-        _active.value = self.func
+        self._tokens.append(_active.set(self.func))
 
     def __exit__(self, exc_type, exc_value, traceback):
-        _active.value = self.original_value
+        _active.reset(self._tokens.pop())
 
 
 class use_original_prefetch_related_objects(override_prefetch_related_objects):
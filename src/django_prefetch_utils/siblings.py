@@ -0,0 +1,32 @@
+"""
+This module provides :class:`SiblingSet`, which records the model
+instances which were fetched together so that data needed by one of
+them can be loaded for all of them at once.  It is used by
+:mod:`django_prefetch_utils.identity_map.lazy` and
+:mod:`django_prefetch_utils.deferred`.
+"""
+import weakref
+
+
+class SiblingSet(object):
+    """
+    A set of weak references to model instances which were fetched
+    together.
+    """
+
+    __slots__ = ("_refs",)
+
+    def __init__(self, instances=()):
+        self._refs = [weakref.ref(obj) for obj in instances]
+
+    def __reduce__(self):
+        # The siblings of a pickled instance are not pickled with it.
+        return (SiblingSet, ())
+
+    def get_instances(self):
+        """
+        Returns a list of the instances in the set which are still alive.
+
+        :rtype: list
+        """
+        return [obj for obj in (ref() for ref in self._refs) if obj is not None]
@@ -0,0 +1,172 @@
+"""
+This module provides :class:`ValuesPrefetch`, a lookup which prefetches
+related rows as dictionaries (or named tuples) containing only the
+requested fields rather than as model instances::
+
+    dogs = Dog.objects.prefetch_related(ValuesPrefetch("toys", fields=["id", "name"]))
+    dogs[0].toys.all()  # [{"id": 1, "name": "Ball"}]
+
+This avoids the cost of creating model instances for read-only uses,
+such as serialization.  Only the last level of the lookup is fetched as
+values; any earlier levels are fetched as model instances as usual.
+Since the rows are not model instances, they are not added to an
+identity map and further lookups cannot be prefetched from them.
+
+Forward and reverse foreign keys, one-to-one relations and
+many-to-many relations are supported.  For relations to a single
+object, a ``to_attr`` must be given.
+"""
+from collections import namedtuple
+
+import wrapt
+from django.db.models import Prefetch
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+from django.db.models.fields.related_descriptors import ReverseOneToOneDescriptor
+from django.db.models.query import ModelIterable
+
+from django_prefetch_utils.relation_access import get_related_manager_class
+
+
+class ValuesPrefetch(Prefetch):
+    """
+    A :class:`django.db.models.Prefetch` which fetches the related rows
+    as dictionaries of *fields*.  If *fields* is not given, then all of
+    the concrete fields of the related model are included.  If *named*
+    is ``True``, then the rows are named tuples instead of dictionaries.
+    """
+
+    def __init__(self, lookup, fields=None, queryset=None, to_attr=None, named=False):
+        super().__init__(lookup, queryset=queryset, to_attr=to_attr)
+        self.fields = list(fields) if fields is not None else None
+        self.named = named
+
+
+def get_join_attnames(prefetcher):
+    """
+    Returns the names of the columns on the related rows returned by
+    *prefetcher* which are used to match them up with the instances
+    they were prefetched for.  These are the attributes used by the
+    ``rel_obj_attr`` function returned from its ``get_prefetch_queryset``.
+
+    :rtype: list
+    """
+    if isinstance(prefetcher, ForwardManyToOneDescriptor):
+        return [field.attname for field in prefetcher.field.foreign_related_fields]
+    if isinstance(prefetcher, ReverseOneToOneDescriptor):
+        return [field.attname for field in prefetcher.related.field.local_related_fields]
+
+    # Many-to-many related managers add the value of the join table's
+    # column to each related object.
+    source_field = getattr(prefetcher, "source_field", None)
+    if source_field is not None:
+        return ["_prefetch_related_val_%s" % field.attname for field in source_field.local_related_fields]
+
+    # Reverse many-to-one related managers
+    field = getattr(prefetcher, "field", None)
+    if field is not None and hasattr(prefetcher, "instance"):
+        return [field.attname for field in field.local_related_fields]
+
+    raise ValueError("ValuesPrefetch does not support prefetching from %r." % type(prefetcher).__name__)
+
+
+def get_default_queryset(prefetcher):
+    """
+    Returns the queryset that *prefetcher* uses if it is not given one.
+
+    :rtype: :class:`django.db.models.QuerySet`
+    """
+    if isinstance(prefetcher, (ForwardManyToOneDescriptor, ReverseOneToOneDescriptor)):
+        return prefetcher.get_queryset()
+
+    # Related managers use their superclass's queryset, since their own
+    # get_queryset() is filtered for a single instance.
+    return super(get_related_manager_class(prefetcher), prefetcher).get_queryset()
+
+
+class UnfetchedIterable(ModelIterable):
+    """
+    An iterable for querysets which should never be fetched as model
+    instances.
+    """
+
+    def __iter__(self):
+        return iter(())
+
+
+def get_values_prefetcher(prefetcher, lookup, level):
+    """
+    Returns *prefetcher* wrapped in a :class:`ValuesPrefetcher` if
+    *lookup* is a :class:`ValuesPrefetch` and *level* is its last level.
+    Otherwise, ``None`` is returned.
+    """
+    if prefetcher is None or not isinstance(lookup, ValuesPrefetch):
+        return None
+    if level != len(lookup.prefetch_through.split(LOOKUP_SEP)) - 1:
+        return None
+    return ValuesPrefetcher(lookup, prefetcher)
+
+
+class ValuesPrefetcher(wrapt.ObjectProxy):
+    """
+    A wrapper for any object which has a ``get_prefetch_queryset`` method
+    which fetches the related rows as values for a :class:`ValuesPrefetch`.
+    """
+
+    __slots__ = ("_self_lookup",)
+
+    def __init__(self, lookup, wrapped):
+        super().__init__(wrapped)
+        self._self_lookup = lookup
+
+    def get_prefetch_queryset(self, instances, queryset=None):
+        if queryset is None:
+            queryset = get_default_queryset(self.__wrapped__)
+
+        # Some of Django's prefetchers iterate over the queryset to set up
+        # the reverse relation cache on each related object.  We don't want
+        # any model instances to be fetched, so we only use the filtered
+        # queryset which they return.
+        queryset = queryset._chain()
+        queryset._iterable_class = UnfetchedIterable
+
+        prefetch_data = self.__wrapped__.get_prefetch_queryset(instances, queryset)
+        rel_qs, _, instance_attr, single = prefetch_data[:4]
+        lookup = self._self_lookup
+        if single and not lookup.to_attr:
+            raise ValueError(
+                "'%s' is a relation to a single object, so a to_attr is required for ValuesPrefetch."
+                % lookup.prefetch_through
+            )
+
+        fields = lookup.fields
+        if fields is None:
+            fields = [field.attname for field in rel_qs.model._meta.concrete_fields]
+        join_attnames = get_join_attnames(self.__wrapped__)
+        names = list(fields) + [name for name in join_attnames if name not in fields]
+        join_indexes = [names.index(name) for name in join_attnames]
+
+        if lookup.named:
+            row_class = namedtuple("Row", fields, rename=True)
+
+            def make_row(values):
+                return row_class._make(values[: len(fields)])
+
+        else:
+
+            def make_row(values):
+                return dict(zip(fields, values))
+
+        # The rows are kept alive by the list, so their ids can be used
+        # to look up the values they were matched on.
+        rows = []
+        memo = {}
+        for values in rel_qs.values_list(*names):
+            row = make_row(values)
+            rows.append(row)
+            memo[id(row)] = tuple(values[i] for i in join_indexes)
+
+        def rel_obj_attr(row):
+            return memo[id(row)]
+
+        return (rows, rel_obj_attr, instance_attr) + prefetch_data[3:]
@@ -0,0 +1,141 @@
+from django.db import connection
+from django.test import SimpleTestCase
+from django.test import TestCase
+from django.test import override_settings
+from prefetch_related.models import Author
+from prefetch_related.models import Book
+from prefetch_related.models import Dog
+from prefetch_related.models import Toy
+
+from django_prefetch_utils import backport
+from django_prefetch_utils import identity_map
+from django_prefetch_utils.chunked import QUERY_PARAMS_HEADROOM
+from django_prefetch_utils.chunked import AdaptiveChunkSizer
+from django_prefetch_utils.chunked import ChunkedPrefetch
+from django_prefetch_utils.chunked import ChunkedPrefetcher
+from django_prefetch_utils.chunked import get_chunked_prefetcher
+from django_prefetch_utils.chunked import get_max_chunk_size
+
+
+class ChunkedPrefetchTestsMixin(object):
+    prefetch_related_objects = None
+    nested_num_queries = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.books = [Book.objects.create(title="Book {}".format(i)) for i in range(5)]
+        cls.authors = [
+            Author.objects.create(name="Author {}".format(i), first_book=book) for i, book in enumerate(cls.books)
+        ]
+        for book, author in zip(cls.books, cls.authors):
+            book.authors.add(author)
+
+    def test_chunked_many_to_many(self):
+        books = list(Book.objects.all())
+        with self.assertNumQueries(3):
+            type(self).prefetch_related_objects(books, ChunkedPrefetch("authors", chunk_size=2))
+        with self.assertNumQueries(0):
+            self.assertEqual([list(book.authors.all()) for book in books], [[author] for author in self.authors])
+
+    def test_chunked_reverse_many_to_one(self):
+        books = list(Book.objects.all())
+        with self.assertNumQueries(2):
+            type(self).prefetch_related_objects(books, ChunkedPrefetch("first_time_authors", chunk_size=3))
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [list(book.first_time_authors.all()) for book in books], [[author] for author in self.authors]
+            )
+
+    def test_chunked_forward_many_to_one(self):
+        authors = list(Author.objects.all())
+        with self.assertNumQueries(5):
+            type(self).prefetch_related_objects(authors, ChunkedPrefetch("first_book", chunk_size=1))
+        with self.assertNumQueries(0):
+            self.assertEqual([author.first_book for author in authors], self.books)
+
+    def test_chunked_with_to_attr(self):
+        books = list(Book.objects.all())
+        with self.assertNumQueries(3):
+            type(self).prefetch_related_objects(books, ChunkedPrefetch("authors", to_attr="author_list", chunk_size=2))
+        self.assertEqual([book.author_list for book in books], [[author] for author in self.authors])
+
+    @override_settings(PREFETCH_UTILS_PREFETCH_CHUNK_SIZE=2)
+    def test_chunk_size_from_settings(self):
+        books = list(Book.objects.all())
+        with self.assertNumQueries(self.nested_num_queries):
+            type(self).prefetch_related_objects(books, "authors__first_book")
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [[a.first_book for a in book.authors.all()] for book in books], [[book] for book in self.books]
+            )
+
+    def test_no_chunking_by_default(self):
+        books = list(Book.objects.all())
+        with self.assertNumQueries(1):
+            type(self).prefetch_related_objects(books, "authors")
+
+
+class IdentityMapChunkedPrefetchTests(ChunkedPrefetchTestsMixin, TestCase):
+    prefetch_related_objects = identity_map.prefetch_related_objects
+
+    # The books for each author are already in the identity map
+    nested_num_queries = 3
+
+
+class BackportChunkedPrefetchTests(ChunkedPrefetchTestsMixin, TestCase):
+    prefetch_related_objects = backport.prefetch_related_objects
+    nested_num_queries = 6
+
+
+class AutoChunkSizeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Dog.objects.bulk_create([Dog(name="Dog {}".format(i)) for i in range(1200)])
+        cls.toy = Toy.objects.create(name="Ball")
+        cls.toy.dogs.add(*Dog.objects.all()[:3])
+
+    def test_auto_chunk_size_uses_max_query_params(self):
+        dogs = list(Dog.objects.all())
+        with self.assertNumQueries(2):
+            identity_map.prefetch_related_objects(dogs, ChunkedPrefetch("toys"))
+        with self.assertNumQueries(0):
+            self.assertEqual(sum(len(dog.toys.all()) for dog in dogs), 3)
+
+
+class ChunkSizerTests(SimpleTestCase):
+    def test_shrinks_when_batches_are_slow(self):
+        sizer = AdaptiveChunkSizer(1000, minimum=10, target_duration=0.1)
+        sizer.record(1000, 1.0)
+        self.assertEqual(sizer.size, 100)
+
+    def test_does_not_shrink_below_minimum(self):
+        sizer = AdaptiveChunkSizer(1000, minimum=10, target_duration=0.1)
+        sizer.record(1000, 100.0)
+        self.assertEqual(sizer.size, 10)
+
+    def test_grows_at_most_double_when_batches_are_fast(self):
+        sizer = AdaptiveChunkSizer(1000, minimum=10, target_duration=0.1)
+        sizer.record(1000, 1.0)
+        sizer.record(100, 0.001)
+        self.assertEqual(sizer.size, 200)
+
+    def test_does_not_grow_above_maximum(self):
+        sizer = AdaptiveChunkSizer(1000, minimum=10, target_duration=0.1)
+        sizer.record(1000, 0.001)
+        self.assertEqual(sizer.size, 1000)
+
+    def test_max_chunk_size_from_backend(self):
+        max_query_params = connection.features.max_query_params
+        if max_query_params is not None:
+            self.assertEqual(get_max_chunk_size("default"), max_query_params - QUERY_PARAMS_HEADROOM)
+
+    def test_prefetcher_is_not_wrapped_for_small_batches(self):
+        prefetcher = object()
+        instances = [Book(id=1)]
+        self.assertIs(
+            get_chunked_prefetcher(prefetcher, ChunkedPrefetch("authors", chunk_size=2), instances), prefetcher
+        )
+        self.assertIsInstance(
+            get_chunked_prefetcher(prefetcher, ChunkedPrefetch("authors", chunk_size=2), instances * 3),
+            ChunkedPrefetcher,
+        )
@@ -0,0 +1,110 @@
+import asyncio
+import threading
+from unittest import mock
+from unittest import skipIf
+
+from django.db.models import Prefetch
+from django.test import SimpleTestCase
+from prefetch_related.models import Person
+
+from django_prefetch_utils.concurrent import aprefetch_concurrently
+from django_prefetch_utils.concurrent import arun_concurrently
+from django_prefetch_utils.concurrent import get_independent_lookup_groups
+from django_prefetch_utils.concurrent import run_concurrently
+from django_prefetch_utils.concurrent import sync_to_async
+
+
+class GetIndependentLookupGroupsTests(SimpleTestCase):
+    def test_lookups_through_different_relations_are_independent(self):
+        groups, remaining = get_independent_lookup_groups(Person, ["houses", "pets", "fleas_hosted"])
+        self.assertEqual(groups, [["houses"], ["pets"], ["fleas_hosted"]])
+        self.assertEqual(remaining, [])
+
+    def test_lookups_through_the_same_relation_are_grouped_in_order(self):
+        prefetch = Prefetch("houses__rooms")
+        groups, remaining = get_independent_lookup_groups(Person, ["houses__occupants", "pets", prefetch])
+        self.assertEqual(groups, [["houses__occupants", prefetch], ["pets"]])
+        self.assertEqual(remaining, [])
+
+    def test_properties_and_to_attr_lookups_are_remaining(self):
+        to_attr_prefetch = Prefetch("houses", to_attr="houses_lst")
+        groups, remaining = get_independent_lookup_groups(
+            Person, ["pets", to_attr_prefetch, "houses_lst__rooms", "primary_house__occupants"]
+        )
+        self.assertEqual(groups, [["pets"]])
+        self.assertEqual(remaining, [to_attr_prefetch, "houses_lst__rooms", "primary_house__occupants"])
+
+
+class RunConcurrentlyTests(SimpleTestCase):
+    def test_functions_are_run_in_other_threads(self):
+        def get_thread():
+            return threading.current_thread()
+
+        threads = run_concurrently([get_thread, get_thread], max_workers=2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+    def test_single_function_is_run_in_current_thread(self):
+        self.assertEqual(run_concurrently([threading.current_thread]), [threading.current_thread()])
+
+    def test_results_are_in_order(self):
+        funcs = [lambda i=i: i for i in range(10)]
+        self.assertEqual(run_concurrently(funcs, max_workers=3), list(range(10)))
+
+    @mock.patch("django_prefetch_utils.concurrent.connections")
+    def test_connections_are_closed_once_per_thread(self, connections):
+        run_concurrently([lambda: None] * 10, max_workers=3)
+        self.assertEqual(connections.close_all.call_count, 3)
+
+    @mock.patch("django_prefetch_utils.concurrent.connections")
+    def test_async_connections_are_closed_once_per_thread(self, connections):
+        asyncio.run(arun_concurrently([lambda: None] * 10, max_workers=3))
+        self.assertEqual(connections.close_all.call_count, 3)
+
+    def test_async_results_are_in_order(self):
+        funcs = [lambda i=i: i for i in range(10)]
+        self.assertEqual(asyncio.run(arun_concurrently(funcs, max_workers=3)), list(range(10)))
+
+    def test_async_exceptions_are_reraised(self):
+        def fail():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            asyncio.run(arun_concurrently([fail, lambda: None]))
+
+    def test_exceptions_are_reraised(self):
+        def fail():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            run_concurrently([fail, lambda: None])
+
+
+class AprefetchConcurrentlyTests(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = []
+
+    def prefetch_related_objects(self, model_instances, *related_lookups):
+        self.calls.append((threading.current_thread(), related_lookups))
+
+    def test_groups_are_run_in_executor(self):
+        asyncio.run(aprefetch_concurrently(self.prefetch_related_objects, [Person()], ["houses", "pets"]))
+        self.assertCountEqual([lookups for _, lookups in self.calls], [("houses",), ("pets",)])
+        self.assertNotIn(threading.current_thread(), [thread for thread, _ in self.calls])
+
+    def test_remaining_lookups_are_run_after_groups(self):
+        asyncio.run(
+            aprefetch_concurrently(self.prefetch_related_objects, [Person()], ["houses", "pets", "primary_house"])
+        )
+        self.assertEqual(self.calls[-1][1], ("primary_house",))
+
+    @skipIf(sync_to_async is None, "asgiref is not installed")
+    @mock.patch("django_prefetch_utils.concurrent.can_prefetch_concurrently", return_value=False)
+    def test_lookups_are_run_in_thread_sensitive_thread_in_transaction(self, can_prefetch_concurrently):
+        async def main():
+            await aprefetch_concurrently(self.prefetch_related_objects, [Person()], ["houses", "pets"])
+            return threading.current_thread(), await sync_to_async(threading.current_thread)()
+
+        loop_thread, sync_thread = asyncio.run(main())
+        self.assertEqual(self.calls, [(sync_thread, ("houses", "pets"))])
+        self.assertIsNot(sync_thread, loop_thread)
@@ -0,0 +1,111 @@
+from django.db.models import Prefetch
+from django.db.models.query_utils import DeferredAttribute
+from django.test import TestCase
+from django.test import override_settings
+from prefetch_related.models import Author
+from prefetch_related.models import Book
+from prefetch_related.models import Bookmark
+from prefetch_related.models import Person
+from prefetch_related.models import TaggedItem
+
+from django_prefetch_utils import backport
+from django_prefetch_utils import identity_map
+from django_prefetch_utils.deferred import SIBLING_SET_ATTR
+from django_prefetch_utils.deferred import _hooks
+from django_prefetch_utils.deferred import load_deferred_siblings
+from django_prefetch_utils.deferred import original_deferred_attribute_get
+from django_prefetch_utils.identity_map.generic import GenericPrefetch
+
+
+class BatchedDeferredFieldsTestsMixin(object):
+    prefetch_related_objects = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book1 = Book.objects.create(title="Poems")
+        cls.book2 = Book.objects.create(title="Stories")
+        for name in ["Jane", "Anne", "Emily"]:
+            Author.objects.create(name=name, first_book=cls.book1)
+        Author.objects.create(name="Tom", first_book=cls.book2)
+
+    def prefetch_authors(self, queryset):
+        books = list(Book.objects.order_by("id"))
+        lookup = Prefetch("first_time_authors", queryset=queryset, to_attr="author_list")
+        type(self).prefetch_related_objects(books, lookup)
+        return [author for book in books for author in book.author_list]
+
+    def test_field_is_loaded_for_siblings(self):
+        authors = self.prefetch_authors(Author.objects.defer("name").order_by("id"))
+        with self.assertNumQueries(1):
+            self.assertEqual([author.name for author in authors], ["Jane", "Anne", "Emily", "Tom"])
+        with self.assertNumQueries(0):
+            self.assertEqual(authors[0].name, "Jane")
+
+    def test_siblings_are_not_recorded_without_deferred_fields(self):
+        authors = self.prefetch_authors(Author.objects.order_by("id"))
+        self.assertNotIn(SIBLING_SET_ATTR, authors[0].__dict__)
+
+    @override_settings(PREFETCH_UTILS_BATCH_DEFERRED_FIELDS=False)
+    def test_disabled(self):
+        authors = self.prefetch_authors(Author.objects.defer("name").order_by("id"))
+        self.assertNotIn(SIBLING_SET_ATTR, authors[0].__dict__)
+        with self.assertNumQueries(4):
+            [author.name for author in authors]
+
+    def test_collected_siblings_are_skipped(self):
+        authors = self.prefetch_authors(Author.objects.defer("name").order_by("id"))
+        del authors[1:]
+        with self.assertNumQueries(1):
+            self.assertEqual(authors[0].name, "Jane")
+
+
+@override_settings(PREFETCH_UTILS_BATCH_DEFERRED_FIELDS=True)
+class IdentityMapBatchedDeferredFieldsTests(BatchedDeferredFieldsTestsMixin, TestCase):
+    prefetch_related_objects = identity_map.prefetch_related_objects
+
+
+@override_settings(PREFETCH_UTILS_BATCH_DEFERRED_FIELDS=True)
+class BackportBatchedDeferredFieldsTests(BatchedDeferredFieldsTestsMixin, TestCase):
+    prefetch_related_objects = backport.prefetch_related_objects
+
+
+@override_settings(PREFETCH_UTILS_BATCH_DEFERRED_FIELDS=True)
+class MixedModelBatchedDeferredFieldsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for url, name in [("http://a.com", "Anne"), ("http://b.com", "Bill")]:
+            bookmark = Bookmark.objects.create(url=url)
+            person = Person.objects.create(name=name)
+            TaggedItem.objects.create(tag="bookmark", content_object=bookmark)
+            TaggedItem.objects.create(tag="person", content_object=person)
+
+    def test_siblings_of_other_models_are_not_loaded(self):
+        items = list(TaggedItem.objects.order_by("id"))
+        lookup = GenericPrefetch("content_object", [Bookmark.objects.only("id"), Person.objects.only("id")])
+        identity_map.prefetch_related_objects(items, lookup)
+        bookmarks = [item.content_object for item in items if item.tag == "bookmark"]
+        people = [item.content_object for item in items if item.tag == "person"]
+
+        with self.assertNumQueries(1):
+            self.assertEqual([bookmark.url for bookmark in bookmarks], ["http://a.com", "http://b.com"])
+        for person in people:
+            self.assertNotIn("url", person.__dict__)
+            self.assertNotIn("name", person.__dict__)
+        with self.assertNumQueries(1):
+            self.assertEqual([person.name for person in people], ["Anne", "Bill"])
+
+
+class DeferredFieldHookTests(TestCase):
+    def test_not_patched_when_disabled(self):
+        self.assertIs(DeferredAttribute.__get__, original_deferred_attribute_get)
+        with override_settings(PREFETCH_UTILS_BATCH_DEFERRED_FIELDS=False):
+            self.assertIs(DeferredAttribute.__get__, original_deferred_attribute_get)
+
+    def test_restored_when_disabled(self):
+        with override_settings(PREFETCH_UTILS_BATCH_DEFERRED_FIELDS=True):
+            self.assertIsNot(DeferredAttribute.__get__, original_deferred_attribute_get)
+            books = list(Book.objects.defer("title"))
+            identity_map.prefetch_related_objects(books, "first_time_authors")
+            self.assertIn(load_deferred_siblings, _hooks)
+        self.assertIs(DeferredAttribute.__get__, original_deferred_attribute_get)
+        self.assertNotIn(load_deferred_siblings, _hooks)
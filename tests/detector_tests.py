@@ -0,0 +1,145 @@
+import threading
+from unittest import mock
+
+from django.db.models.query import ModelIterable
+from django.test import TestCase
+from django.test import override_settings
+from prefetch_related.models import Author
+from prefetch_related.models import Book
+from prefetch_related.models import Bookmark
+from prefetch_related.models import TaggedItem
+
+from django_prefetch_utils.detector import NPlusOneDetector
+from django_prefetch_utils.detector import get_related_model
+from django_prefetch_utils.relation_access import _hooks
+
+
+class NPlusOneDetectorTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(3):
+            book = Book.objects.create(title="Book {}".format(i))
+            author = Author.objects.create(name="Author {}".format(i), first_book=book)
+            book.authors.add(author)
+
+    def test_reports_relation_loaded_in_loop(self):
+        logger = mock.Mock()
+        with NPlusOneDetector(logger=logger) as detector:
+            for author in Author.objects.all():
+                author.first_book
+
+        (report,) = detector.get_reports()
+        self.assertEqual((report.model, report.lookup, report.count), (Author, "first_book", 3))
+        self.assertEqual(report.call_site.filename, __file__)
+        self.assertEqual(report.call_site.function, "test_reports_relation_loaded_in_loop")
+
+        logger.warning.assert_called_once()
+        self.assertIn(
+            "prefetch_related('first_book')", logger.warning.call_args[0][0] % logger.warning.call_args[0][1:]
+        )
+
+    def test_reports_many_to_many(self):
+        with NPlusOneDetector(logger=mock.Mock()) as detector:
+            for book in Book.objects.all():
+                list(book.authors.all())
+        self.assertEqual([(r.model, r.lookup, r.count) for r in detector.get_reports()], [(Book, "authors", 3)])
+
+    def test_reports_generic_relation(self):
+        for i in range(3):
+            bookmark = Bookmark.objects.create(url="http://example.com/{}".format(i))
+            TaggedItem.objects.create(tag="tag", content_object=bookmark)
+        logger = mock.Mock()
+        with NPlusOneDetector(logger=logger) as detector:
+            for bookmark in Bookmark.objects.all():
+                list(bookmark.tags.all())
+        self.assertEqual([(r.model, r.lookup, r.count) for r in detector.get_reports()], [(Bookmark, "tags", 3)])
+        self.assertIn("prefetch_related('tags')", logger.warning.call_args[0][0] % logger.warning.call_args[0][1:])
+
+    def test_reports_nested_relation_against_original_queryset(self):
+        logger = mock.Mock()
+        with NPlusOneDetector(logger=logger) as detector:
+            for author in Author.objects.all():
+                list(author.first_book.authors.all())
+
+        reports = [(r.model, r.lookup, r.count) for r in detector.get_reports()]
+        self.assertEqual(reports, [(Author, "first_book", 3), (Author, "first_book__authors", 3)])
+        messages = [call[0][0] % call[0][1:] for call in logger.warning.call_args_list]
+        self.assertIn("prefetch_related('first_book__authors') to the Author queryset", messages[1])
+
+    def test_instances_from_different_result_sets_are_not_reported(self):
+        authors = [Author.objects.get(pk=author.pk) for author in Author.objects.all()]
+        with NPlusOneDetector(logger=mock.Mock()) as detector:
+            for author in [Author.objects.filter(pk=author.pk)[0] for author in authors]:
+                author.first_book
+        self.assertEqual(detector.get_reports(), [])
+        self.assertEqual(sum(detector.counter.values()), 3)
+
+    def test_get_related_model(self):
+        self.assertEqual(
+            [
+                get_related_model(Author, "first_book"),
+                get_related_model(Book, "first_time_authors"),
+                get_related_model(Book, "authors"),
+                get_related_model(Author, "books"),
+                get_related_model(Bookmark, "tags"),
+                get_related_model(TaggedItem, "content_object"),
+            ],
+            [Book, Author, Author, Book, TaggedItem, None],
+        )
+
+    def test_records_from_threads_are_all_counted(self):
+        detector = NPlusOneDetector(threshold=10**6, logger=mock.Mock())
+
+        @detector
+        def record_accesses():
+            for i in range(1000):
+                detector.record(Author, "first_book", None)
+
+        threads = [threading.Thread(target=record_accesses) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(detector.counter[(Author, "first_book", None)], 4000)
+
+    def test_prefetched_relations_are_not_reported(self):
+        with NPlusOneDetector() as detector:
+            for author in Author.objects.prefetch_related("first_book"):
+                author.first_book
+        self.assertEqual(detector.get_reports(), [])
+
+    def test_different_call_sites_are_counted_separately(self):
+        with NPlusOneDetector(threshold=2, logger=mock.Mock()) as detector:
+            authors = list(Author.objects.all())
+            authors[0].first_book
+            authors[1].first_book
+        self.assertEqual(detector.get_reports(), [])
+        self.assertEqual(sum(detector.counter.values()), 2)
+
+    def test_not_sampled(self):
+        original_iter = ModelIterable.__iter__
+        with mock.patch("random.random", return_value=0.5):
+            with NPlusOneDetector(sample_rate=0.1) as detector:
+                self.assertEqual(_hooks, [])
+                self.assertIs(ModelIterable.__iter__, original_iter)
+                for author in Author.objects.all():
+                    author.first_book
+        self.assertEqual(detector.counter, {})
+
+    @override_settings(PREFETCH_UTILS_NPLUSONE_THRESHOLD=5, PREFETCH_UTILS_NPLUSONE_SAMPLE_RATE=0.25)
+    def test_settings(self):
+        detector = NPlusOneDetector()
+        self.assertEqual((detector.threshold, detector.sample_rate), (5, 0.25))
+
+    def test_as_decorator(self):
+        detector = NPlusOneDetector(logger=mock.Mock())
+
+        @detector
+        def load_books():
+            for author in Author.objects.all():
+                author.first_book
+
+        load_books()
+        load_books()
+        self.assertEqual(detector.get_reports()[0].count, 6)
+        self.assertEqual(_hooks, [])
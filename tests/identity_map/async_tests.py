@@ -0,0 +1,56 @@
+import asyncio
+
+from django.test import TransactionTestCase
+from prefetch_related.models import Author
+from prefetch_related.models import Book
+from prefetch_related.models import House
+from prefetch_related.models import Person
+from prefetch_related.models import Room
+
+from django_prefetch_utils import backport
+from django_prefetch_utils.identity_map import aprefetch_related_objects
+
+
+class AsyncPrefetchTestsMixin(object):
+    def create_objects(self):
+        self.book = Book.objects.create(title="Poems")
+        self.author = Author.objects.create(name="Jane", first_book=self.book)
+        self.book.authors.add(self.author)
+
+        self.person = Person.objects.create(name="Joe")
+        self.house = House.objects.create(name="House", address="123 Main St", owner=self.person)
+        self.room = Room.objects.create(name="Kitchen", house=self.house)
+        self.person.houses.add(self.house)
+
+
+class AsyncPrefetchRelatedObjectsTests(AsyncPrefetchTestsMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_objects()
+
+    def test_queries_are_not_run_in_event_loop_thread(self):
+        book = Book.objects.get()
+        with self.assertNumQueries(0):
+            asyncio.run(aprefetch_related_objects([book], "authors", "first_time_authors"))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(list(book.authors.all()), [self.author])
+            self.assertIs(book.authors.all()[0], book.first_time_authors.all()[0])
+
+    def test_remaining_lookups_are_done_after(self):
+        person = Person.objects.get()
+        asyncio.run(aprefetch_related_objects([person], "pets", "houses__rooms", "primary_house__occupants"))
+        with self.assertNumQueries(0):
+            self.assertEqual(list(person.primary_house.occupants.all()), [person])
+            self.assertEqual(list(person.houses.all()[0].rooms.all()), [self.room])
+
+    def test_backport(self):
+        book = Book.objects.get()
+        with self.assertNumQueries(0):
+            asyncio.run(backport.aprefetch_related_objects([book], "authors", "first_time_authors"))
+        with self.assertNumQueries(0):
+            self.assertEqual(list(book.authors.all()), [self.author])
+            self.assertEqual(list(book.first_time_authors.all()), [self.author])
+
+    def test_does_nothing_with_no_instances(self):
+        asyncio.run(aprefetch_related_objects([], "authors"))
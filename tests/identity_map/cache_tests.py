@@ -0,0 +1,207 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.db.models import Prefetch
+from django.test import TestCase
+from prefetch_related.models import Author
+from prefetch_related.models import Book
+from prefetch_related.models import Bookmark
+from prefetch_related.models import TaggedItem
+
+from django_prefetch_utils.identity_map import prefetch_related_objects
+from django_prefetch_utils.identity_map.cache import cache_prefetched_relation
+from django_prefetch_utils.identity_map.cache import get_cached_relation
+from django_prefetch_utils.identity_map.cache import uncache_prefetched_relation
+from django_prefetch_utils.identity_map.persistent import use_persistent_prefetch_identity_map
+from django_prefetch_utils.identity_map.two_phase import TwoPhasePrefetch
+
+
+class CachedRelationTestMixin(object):
+    model = None
+    attname = None
+    invalidate_on = None
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.relation = cache_prefetched_relation(self.model, self.attname, invalidate_on=self.invalidate_on)
+        self.addCleanup(uncache_prefetched_relation, self.model, self.attname)
+
+    def prefetch(self, *lookups, queryset=None):
+        instances = list((queryset if queryset is not None else self.model.objects).order_by("pk"))
+        prefetch_related_objects(instances, *lookups)
+        return instances
+
+
+class ManyToManyCacheTests(CachedRelationTestMixin, TestCase):
+    model = Book
+    attname = "authors"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book1 = Book.objects.create(title="Poems")
+        cls.book2 = Book.objects.create(title="Jane Eyre")
+        cls.book3 = Book.objects.create(title="Wuthering Heights")
+        cls.author1 = Author.objects.create(name="Charlotte", first_book=cls.book1)
+        cls.author2 = Author.objects.create(name="Anne", first_book=cls.book1)
+        cls.book1.authors.add(cls.author1, cls.author2)
+        cls.book2.authors.add(cls.author1)
+
+    def get_authors(self, books):
+        return [[author.name for author in book.authors.all()] for book in books]
+
+    def test_hits_do_not_query(self):
+        with self.assertNumQueries(2):
+            books = self.prefetch("authors")
+        expected = self.get_authors(books)
+        self.assertEqual(expected, [["Charlotte", "Anne"], ["Charlotte"], []])
+
+        with self.assertNumQueries(1):
+            books = self.prefetch("authors")
+        self.assertEqual(self.get_authors(books), expected)
+
+    def test_hits_use_identity_map(self):
+        self.prefetch("authors")
+        books = self.prefetch("authors")
+        self.assertIs(books[0].authors.all()[0], books[1].authors.all()[0])
+
+    def test_only_missing_instances_are_fetched(self):
+        self.prefetch("authors", queryset=Book.objects.filter(pk=self.book1.pk))
+        with self.assertNumQueries(2) as context:
+            books = self.prefetch("authors")
+        self.assertNotIn(str(self.book1.pk), context.captured_queries[1]["sql"].split("IN")[-1])
+        self.assertEqual(self.get_authors(books), [["Charlotte", "Anne"], ["Charlotte"], []])
+
+    def test_cache_takes_precedence_over_two_phases(self):
+        self.prefetch("authors")
+        with self.assertNumQueries(1):
+            books = self.prefetch(TwoPhasePrefetch("authors"))
+        self.assertEqual(self.get_authors(books), [["Charlotte", "Anne"], ["Charlotte"], []])
+
+    @mock.patch("django_prefetch_utils.identity_map.two_phase.WARM_MIN_INSTANCES", 1)
+    def test_cache_is_used_with_warm_persistent_identity_map(self):
+        self.prefetch("authors")
+        with use_persistent_prefetch_identity_map():
+            list(Author.objects.all())
+            with self.assertNumQueries(1):
+                books = list(Book.objects.prefetch_related("authors").order_by("pk"))
+        self.assertEqual(self.get_authors(books), [["Charlotte", "Anne"], ["Charlotte"], []])
+
+    def test_two_phases_are_used_for_missing_instances(self):
+        self.prefetch("authors", queryset=Book.objects.filter(pk=self.book1.pk))
+        with self.assertNumQueries(2) as context:
+            books = self.prefetch(TwoPhasePrefetch("authors"))
+        # Charlotte is reused from the cached rows for book1, so only the
+        # first phase is needed for the other books.
+        self.assertNotIn("name", context.captured_queries[1]["sql"])
+        self.assertEqual(self.get_authors(books), [["Charlotte", "Anne"], ["Charlotte"], []])
+
+        with self.assertNumQueries(1):
+            books = self.prefetch(TwoPhasePrefetch("authors"))
+        self.assertEqual(self.get_authors(books), [["Charlotte", "Anne"], ["Charlotte"], []])
+
+    def test_m2m_changed_invalidates(self):
+        self.prefetch("authors")
+        self.book3.authors.add(self.author2)
+        with self.assertNumQueries(2):
+            books = self.prefetch("authors")
+        self.assertEqual(self.get_authors(books)[2], ["Anne"])
+
+    def test_saving_related_model_invalidates(self):
+        self.prefetch("authors")
+        self.author2.name = "Emily"
+        self.author2.save()
+        books = self.prefetch("authors")
+        self.assertEqual(self.get_authors(books)[0], ["Charlotte", "Emily"])
+
+    def test_custom_queryset_is_not_cached(self):
+        lookup = Prefetch("authors", queryset=Author.objects.filter(name="Anne"))
+        self.prefetch(lookup)
+        with self.assertNumQueries(2):
+            books = self.prefetch("authors")
+        self.assertEqual(self.get_authors(books), [["Charlotte", "Anne"], ["Charlotte"], []])
+
+    def test_nested_lookups(self):
+        self.prefetch("authors__first_book")
+        # The first books are already in the identity map from the first query
+        with self.assertNumQueries(1):
+            books = self.prefetch("authors__first_book")
+        with self.assertNumQueries(0):
+            self.assertEqual(books[0].authors.all()[1].first_book, self.book1)
+
+    def test_unregistered(self):
+        uncache_prefetched_relation(Book, "authors")
+        self.assertIsNone(get_cached_relation(Book, "authors"))
+        self.prefetch("authors")
+        with self.assertNumQueries(2):
+            self.prefetch("authors")
+
+
+class ReverseManyToOneCacheTests(CachedRelationTestMixin, TestCase):
+    model = Book
+    attname = "first_time_authors"
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book1 = Book.objects.create(title="Poems")
+        cls.book2 = Book.objects.create(title="Jane Eyre")
+        cls.author1 = Author.objects.create(name="Charlotte", first_book=cls.book1)
+        cls.author2 = Author.objects.create(name="Anne", first_book=cls.book1)
+
+    def test_hits_and_invalidation(self):
+        self.prefetch("first_time_authors")
+        with self.assertNumQueries(1):
+            books = self.prefetch("first_time_authors")
+        self.assertEqual([list(book.first_time_authors.all()) for book in books], [[self.author1, self.author2], []])
+
+        Author.objects.create(name="Emily", first_book=self.book2)
+        books = self.prefetch("first_time_authors")
+        self.assertEqual([author.name for author in books[1].first_time_authors.all()], ["Emily"])
+
+    def test_invalidate_manually(self):
+        self.prefetch("first_time_authors")
+        Author.objects.filter(pk=self.author2.pk).update(first_book=self.book2)
+        self.relation.invalidate()
+        books = self.prefetch("first_time_authors")
+        self.assertEqual([list(book.first_time_authors.all()) for book in books], [[self.author1], [self.author2]])
+
+
+class ForwardManyToOneCacheTests(CachedRelationTestMixin, TestCase):
+    model = Author
+    attname = "first_book"
+    invalidate_on = []
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        Author.objects.create(name="Charlotte", first_book=cls.book)
+
+    def test_invalidation_can_be_disabled(self):
+        self.prefetch("first_book")
+        self.book.title = "Stories"
+        self.book.save()
+        with self.assertNumQueries(1):
+            (author,) = self.prefetch("first_book")
+        self.assertEqual(author.first_book.title, "Poems")
+
+
+class InvalidateOnTests(TestCase):
+    def test_defaults(self):
+        for model, attname, expected in [
+            (Author, "first_book", [Book]),
+            (Book, "first_time_authors", [Author]),
+            (Book, "authors", [Author, Book.authors.through]),
+            (Author, "books", [Book, Book.authors.through]),
+        ]:
+            relation = cache_prefetched_relation(model, attname)
+            uncache_prefetched_relation(model, attname)
+            self.assertEqual(relation.invalidate_on, expected)
+
+    def test_generic_foreign_key_requires_invalidate_on(self):
+        with self.assertRaises(ValueError):
+            cache_prefetched_relation(TaggedItem, "content_object")
+
+    def test_explicit_invalidate_on(self):
+        relation = cache_prefetched_relation(TaggedItem, "content_object", invalidate_on=[Bookmark])
+        self.addCleanup(uncache_prefetched_relation, TaggedItem, "content_object")
+        self.assertEqual(relation.invalidate_on, [Bookmark])
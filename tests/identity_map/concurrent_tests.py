@@ -0,0 +1,74 @@
+from django.db import transaction
+from django.test import TestCase
+from django.test import TransactionTestCase
+from prefetch_related.models import Author
+from prefetch_related.models import Book
+from prefetch_related.models import House
+from prefetch_related.models import Person
+from prefetch_related.models import Room
+
+from django_prefetch_utils.identity_map import concurrent_prefetch_related_objects
+from django_prefetch_utils.identity_map import use_concurrent_prefetch_identity_map
+
+
+class ConcurrentPrefetchTestsMixin(object):
+    def create_objects(self):
+        self.book = Book.objects.create(title="Poems")
+        self.author = Author.objects.create(name="Jane", first_book=self.book)
+        self.book.authors.add(self.author)
+
+        self.person = Person.objects.create(name="Joe")
+        self.house = House.objects.create(name="House", address="123 Main St", owner=self.person)
+        self.room = Room.objects.create(name="Kitchen", house=self.house)
+        self.person.houses.add(self.house)
+
+
+class ConcurrentPrefetchRelatedObjectsTests(ConcurrentPrefetchTestsMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_objects()
+
+    def test_independent_lookups_are_fetched_in_other_threads(self):
+        book = Book.objects.get()
+        # No queries are done on this thread's connection
+        with self.assertNumQueries(0):
+            concurrent_prefetch_related_objects([book], "authors", "first_time_authors")
+
+        with self.assertNumQueries(0):
+            self.assertEqual(list(book.authors.all()), [self.author])
+            self.assertEqual(list(book.first_time_authors.all()), [self.author])
+
+    def test_identity_map_is_shared_between_threads(self):
+        book = Book.objects.get()
+        concurrent_prefetch_related_objects([book], "authors", "first_time_authors")
+        self.assertIs(book.authors.all()[0], book.first_time_authors.all()[0])
+
+    def test_remaining_lookups_are_done_after(self):
+        person = Person.objects.get()
+        concurrent_prefetch_related_objects([person], "pets", "houses__rooms", "primary_house__occupants")
+        with self.assertNumQueries(0):
+            self.assertEqual(list(person.primary_house.occupants.all()), [person])
+            self.assertEqual(list(person.houses.all()[0].rooms.all()), [self.room])
+
+    def test_use_concurrent_prefetch_identity_map(self):
+        with use_concurrent_prefetch_identity_map():
+            book = Book.objects.prefetch_related("authors", "first_time_authors").get()
+        with self.assertNumQueries(0):
+            self.assertIs(book.authors.all()[0], book.first_time_authors.all()[0])
+
+
+class ConcurrentPrefetchInTransactionTests(ConcurrentPrefetchTestsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_objects()
+
+    def test_lookups_are_fetched_in_current_thread_in_transaction(self):
+        book = Book.objects.get()
+        with transaction.atomic():
+            with self.assertNumQueries(2):
+                concurrent_prefetch_related_objects([book], "authors", "first_time_authors")
+        self.assertEqual(list(book.authors.all()), [self.author])
+
+    def test_does_nothing_with_no_instances(self):
+        with self.assertNumQueries(0):
+            concurrent_prefetch_related_objects([], "authors")
@@ -0,0 +1,89 @@
+from django.test import TestCase
+from prefetch_related.models import Author
+from prefetch_related.models import Book
+
+from django_prefetch_utils.deferred import _hooks
+from django_prefetch_utils.identity_map.deferred import load_identity_map_siblings
+from django_prefetch_utils.identity_map.maps import LRUPrefetchIdentityMap
+from django_prefetch_utils.identity_map.maps import PrefetchIdentityMap
+from django_prefetch_utils.identity_map.persistent import use_persistent_prefetch_identity_map
+
+
+class FillDeferredFieldsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        for name in ["Jane", "Anne", "Emily"]:
+            Author.objects.create(name=name, first_book=cls.book)
+
+    def check_fill(self, identity_map):
+        author = identity_map[Author.objects.only("id").get(name="Jane")]
+        self.assertIs(identity_map[Author.objects.get(name="Jane")], author)
+        with self.assertNumQueries(0):
+            self.assertEqual((author.name, author.first_book_id), ("Jane", self.book.pk))
+
+    def test_prefetch_identity_map(self):
+        self.check_fill(PrefetchIdentityMap())
+
+    def test_lru_prefetch_identity_map(self):
+        self.check_fill(LRUPrefetchIdentityMap())
+
+    def test_field_map_is_updated(self):
+        identity_map = PrefetchIdentityMap()
+        name_field = Author._meta.get_field("name")
+        field_map = identity_map.get_map_for_field(Author, name_field)
+        author = identity_map[Author.objects.only("id").get(name="Jane")]
+        self.assertNotIn("Jane", field_map)
+        identity_map[Author.objects.get(name="Jane")]
+        self.assertIs(field_map["Jane"], author)
+
+    def test_loaded_values_are_not_overwritten(self):
+        identity_map = PrefetchIdentityMap()
+        author = identity_map[Author.objects.get(name="Jane")]
+        author.name = "Charlotte"
+        identity_map[Author.objects.get(name="Jane")]
+        self.assertEqual(author.name, "Charlotte")
+
+    def test_rows_fill_persistent_instances(self):
+        with use_persistent_prefetch_identity_map():
+            authors = list(Author.objects.only("id"))
+            self.assertEqual(list(Author.objects.all()), authors)
+        with self.assertNumQueries(0):
+            self.assertEqual([author.name for author in authors], ["Jane", "Anne", "Emily"])
+
+
+class BatchedDeferredLoadingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        for name in ["Jane", "Anne", "Emily"]:
+            Author.objects.create(name=name, first_book=cls.book)
+
+    def test_field_is_loaded_for_siblings(self):
+        with use_persistent_prefetch_identity_map(batch_deferred_fields=True):
+            authors = list(Author.objects.only("id"))
+            with self.assertNumQueries(1):
+                self.assertEqual([author.name for author in authors], ["Jane", "Anne", "Emily"])
+            # Only the field which was accessed is loaded.
+            with self.assertNumQueries(1):
+                self.assertEqual({author.first_book_id for author in authors}, {self.book.pk})
+
+    def test_disabled_by_default(self):
+        with use_persistent_prefetch_identity_map():
+            authors = list(Author.objects.only("id"))
+            with self.assertNumQueries(3):
+                [author.name for author in authors]
+
+    def test_unmapped_instance_is_loaded_alone(self):
+        authors = list(Author.objects.only("id"))
+        with use_persistent_prefetch_identity_map(batch_deferred_fields=True):
+            list(Author.objects.only("id"))
+            with self.assertNumQueries(1):
+                self.assertEqual(authors[0].name, "Jane")
+            with self.assertNumQueries(1):
+                self.assertEqual(authors[1].name, "Anne")
+
+    def test_hook_is_removed(self):
+        with use_persistent_prefetch_identity_map(batch_deferred_fields=True):
+            self.assertIn(load_identity_map_siblings, _hooks)
+        self.assertNotIn(load_identity_map_siblings, _hooks)
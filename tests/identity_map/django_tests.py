@@ -2,12 +2,16 @@ from importlib import import_module
 
 from django.db.models import Prefetch
 from django.test import TestCase
+from prefetch_related.models import AuthorWithAge
 from prefetch_related.models import Bookmark
+from prefetch_related.models import BookWithYear
 from prefetch_related.models import Employee
 from prefetch_related.models import House
 from prefetch_related.models import Person
 from prefetch_related.models import TaggedItem
 from prefetch_related.tests import CustomPrefetchTests
+from prefetch_related.tests import MultiDbTests
+from prefetch_related.tests import MultiTableInheritanceTest
 from prefetch_related.tests import NullableTest
 
 from .mixins import EnableIdentityMapMixin
@@ -102,6 +106,38 @@ class IdentityMapNullableTest(EnableIdentityMapMixin, NullableTest):
         self.assertEqual(co_serfs, co_serfs2)
 
 
+class IdentityMapMultiTableInheritanceTest(EnableIdentityMapMixin, MultiTableInheritanceTest):
+    def test_parent_link_prefetch(self):
+        # The parents are built from the fields already loaded on the
+        # children.
+        with self.assertNumQueries(1):
+            authors = [a.author for a in AuthorWithAge.objects.prefetch_related("author")]
+        self.assertEqual([author.name for author in authors], ["Jane", "Tom", "Robert"])
+
+
+class IdentityMapMultiDbTests(EnableIdentityMapMixin, MultiDbTests):
+    def test_using_is_honored_inheritance(self):
+        B = BookWithYear.objects.using("other")
+        A = AuthorWithAge.objects.using("other")
+        book1 = B.create(title="Poems", published_year=2010)
+        B.create(title="More poems", published_year=2011)
+        A.create(name="Jane", first_book=book1, age=50)
+        A.create(name="Tom", first_book=book1, age=49)
+
+        # parent link
+        with self.assertNumQueries(1, using="other"):
+            authors = [a.author for a in A.prefetch_related("author")]
+
+        self.assertEqual(", ".join(a.name for a in authors), "Jane, Tom")
+        self.assertEqual({a._state.db for a in authors}, {"other"})
+
+        # child link
+        with self.assertNumQueries(2, using="other"):
+            ages = ", ".join(str(a.authorwithage.age) for a in A.prefetch_related("authorwithage"))
+
+        self.assertEqual(ages, "50, 49")
+
+
 DJANGO_TEST_MODULES = [
     "prefetch_related.tests",
     "prefetch_related.test_uuid",
@@ -131,4 +167,6 @@ for mod_string in DJANGO_TEST_MODULES:
     del mod
 
 del CustomPrefetchTests
+del MultiDbTests
+del MultiTableInheritanceTest
 del NullableTest
@@ -0,0 +1,128 @@
+from unittest import mock
+
+from django.contrib.contenttypes.models import ContentTypeManager
+from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from prefetch_related.models import Bookmark
+from prefetch_related.models import House
+from prefetch_related.models import Person
+from prefetch_related.models import TaggedItem
+
+from django_prefetch_utils.identity_map import prefetch_related_objects
+from django_prefetch_utils.identity_map.generic import GenericPrefetch
+from django_prefetch_utils.identity_map.maps import PrefetchIdentityMap
+from django_prefetch_utils.identity_map.persistent import use_persistent_prefetch_identity_map
+from django_prefetch_utils.identity_map.wrappers import GenericForeignKeyPrefetchWrapper
+
+from .mixins import EnableIdentityMapMixin
+
+
+class GenericForeignKeyTestsMixin(object):
+    def create_objects(self):
+        self.bookmarks = [Bookmark.objects.create(url="http://www.example.com/%d/" % i) for i in range(2)]
+        self.person = Person.objects.create(name="Joe")
+        for bookmark in self.bookmarks:
+            TaggedItem.objects.create(tag="bookmark", content_object=bookmark)
+            TaggedItem.objects.create(tag="person", content_object=self.person)
+
+
+class GroupedGenericForeignKeyTests(GenericForeignKeyTestsMixin, EnableIdentityMapMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_objects()
+
+    def test_one_query_per_content_type(self):
+        with self.assertNumQueries(3):
+            items = list(TaggedItem.objects.prefetch_related("content_object"))
+        self.assertEqual(
+            [item.content_object for item in items],
+            [self.bookmarks[0], self.person, self.bookmarks[1], self.person],
+        )
+        self.assertIs(items[1].content_object, items[3].content_object)
+
+    def test_content_types_are_resolved_once(self):
+        items = list(TaggedItem.objects.all())
+        with mock.patch.object(
+            ContentTypeManager, "get_for_id", autospec=True, side_effect=ContentTypeManager.get_for_id
+        ) as get_for_id:
+            prefetch_related_objects(items, "content_object")
+        self.assertEqual(get_for_id.call_count, 2)
+
+    def test_objects_in_identity_map_are_not_fetched(self):
+        with use_persistent_prefetch_identity_map():
+            person = Person.objects.get()
+            with self.assertNumQueries(2) as context:
+                items = list(TaggedItem.objects.prefetch_related("content_object"))
+            self.assertIn("bookmark", context.captured_queries[1]["sql"])
+            self.assertIs(items[1].content_object, person)
+
+    def test_custom_queryset_is_not_allowed(self):
+        items = list(TaggedItem.objects.all())
+        prefetcher = GenericForeignKeyPrefetchWrapper(PrefetchIdentityMap(), TaggedItem.content_object)
+        with self.assertRaises(ValueError):
+            prefetcher.get_prefetch_queryset(items, Bookmark.objects.all())
+
+
+@override_settings(PREFETCH_UTILS_GENERIC_PREFETCH_CONCURRENT=True)
+class ConcurrentGenericForeignKeyTests(GenericForeignKeyTestsMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_objects()
+
+    def test_content_types_are_fetched_in_other_threads(self):
+        items = list(TaggedItem.objects.all())
+        with self.assertNumQueries(0):
+            prefetch_related_objects(items, "content_object")
+        self.assertEqual([item.content_object for item in items[:2]], [self.bookmarks[0], self.person])
+
+
+class GenericPrefetchTests(GenericForeignKeyTestsMixin, EnableIdentityMapMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.create_objects()
+        self.house = House.objects.create(name="House", address="123 Main St", owner=self.person)
+        self.person.houses.add(self.house)
+        TaggedItem.objects.create(tag="python", content_object=self.bookmarks[0])
+
+    def test_querysets_for_each_model(self):
+        lookup = GenericPrefetch(
+            "content_object", [Bookmark.objects.prefetch_related("tags"), Person.objects.prefetch_related("houses")]
+        )
+        with self.assertNumQueries(5):
+            items = list(TaggedItem.objects.prefetch_related(lookup))
+        with self.assertNumQueries(0):
+            self.assertEqual([tag.tag for tag in items[0].content_object.tags.all()], ["bookmark", "python"])
+            self.assertEqual(list(items[1].content_object.houses.all()), [self.house])
+        self.assertIs(items[1].content_object, items[3].content_object)
+
+    def test_models_without_querysets(self):
+        lookup = GenericPrefetch("content_object", {Person: Person.objects.filter(name="Jane")})
+        with self.assertNumQueries(3):
+            items = list(TaggedItem.objects.prefetch_related(lookup))
+        self.assertEqual(
+            [item.content_object for item in items],
+            [self.bookmarks[0], None, self.bookmarks[1], None, self.bookmarks[0]],
+        )
+
+    def test_identity_map_instances_are_fetched_with_queryset(self):
+        with use_persistent_prefetch_identity_map():
+            person = Person.objects.get()
+            lookup = GenericPrefetch("content_object", [Person.objects.prefetch_related("houses")])
+            with self.assertNumQueries(4):
+                items = list(TaggedItem.objects.prefetch_related(lookup))
+            self.assertIs(items[1].content_object, person)
+            with self.assertNumQueries(0):
+                self.assertEqual(list(person.houses.all()), [self.house])
+
+    def test_nested_lookup(self):
+        lookup = GenericPrefetch("tags__content_object", [Bookmark.objects.only("id")])
+        with self.assertNumQueries(3):
+            bookmarks = list(Bookmark.objects.prefetch_related(lookup))
+        self.assertIs(bookmarks[0].tags.all()[0].content_object, bookmarks[0])
+
+    def test_invalid_querysets(self):
+        with self.assertRaises(ValueError):
+            GenericPrefetch("content_object", [Person.objects.values("id")])
+        with self.assertRaises(ValueError):
+            GenericPrefetch("content_object", {Bookmark: Person.objects.all()})
@@ -0,0 +1,107 @@
+from django.db.models import Prefetch
+from django.test import TestCase
+from prefetch_related.models import Author
+from prefetch_related.models import AuthorWithAge
+from prefetch_related.models import Book
+from prefetch_related.models import Dog
+from prefetch_related.models import ServiceDog
+from prefetch_related.models import Toy
+
+from django_prefetch_utils.identity_map import prefetch_related_objects_impl
+from django_prefetch_utils.identity_map.maps import LRUPrefetchIdentityMap
+from django_prefetch_utils.identity_map.maps import PrefetchIdentityMap
+from django_prefetch_utils.identity_map.maps import StrongPrefetchIdentityMap
+from django_prefetch_utils.identity_map.persistent import use_persistent_prefetch_identity_map
+
+
+class ProxyModelTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.rex = Dog.objects.create(name="Rex")
+        cls.ball = Toy.objects.create(name="Ball")
+        cls.ball.dogs.add(cls.rex)
+
+    def check_proxy_instances(self, identity_map):
+        dog = identity_map[Dog.objects.get()]
+        service_dog = identity_map[ServiceDog.objects.get()]
+        self.assertIs(type(service_dog), ServiceDog)
+        self.assertIs(service_dog.__dict__, dog.__dict__)
+        self.assertIs(identity_map[ServiceDog.objects.get()], service_dog)
+        self.assertIs(identity_map[Dog.objects.get()], dog)
+        self.assertEqual(len(identity_map.get_map_for_model(ServiceDog)), 1)
+
+    def test_prefetch_identity_map(self):
+        self.check_proxy_instances(PrefetchIdentityMap())
+
+    def test_strong_prefetch_identity_map(self):
+        self.check_proxy_instances(StrongPrefetchIdentityMap())
+
+    def test_lru_prefetch_identity_map(self):
+        self.check_proxy_instances(LRUPrefetchIdentityMap())
+
+    def test_field_values_are_shared(self):
+        identity_map = PrefetchIdentityMap()
+        dog = identity_map[Dog.objects.get()]
+        service_dog = identity_map[ServiceDog.objects.get()]
+        dog.name = "Max"
+        self.assertEqual(service_dog.name, "Max")
+
+    def test_prefetch_with_proxy_queryset(self):
+        identity_map = PrefetchIdentityMap()
+        dog = identity_map[Dog.objects.get()]
+        toys = list(Toy.objects.all())
+        prefetch_related_objects_impl(identity_map, toys, Prefetch("dogs", queryset=ServiceDog.objects.all()))
+        (service_dog,) = toys[0].dogs.all()
+        self.assertIs(type(service_dog), ServiceDog)
+        self.assertIs(service_dog.__dict__, dog.__dict__)
+
+    def test_persistent_identity_map(self):
+        with use_persistent_prefetch_identity_map(serve_pk_lookups=True):
+            dog = Dog.objects.get()
+            with self.assertNumQueries(0):
+                service_dog = ServiceDog.objects.get(pk=self.rex.pk)
+        self.assertIs(type(service_dog), ServiceDog)
+        self.assertIs(service_dog.__dict__, dog.__dict__)
+
+
+class ParentLinkTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        cls.jane = AuthorWithAge.objects.create(name="Jane", first_book=cls.book, age=50)
+
+    def setUp(self):
+        super().setUp()
+        self.identity_map = PrefetchIdentityMap()
+
+    def test_parent_is_built_from_child(self):
+        children = list(AuthorWithAge.objects.all())
+        with self.assertNumQueries(0):
+            prefetch_related_objects_impl(self.identity_map, children, "author")
+        parent = children[0].author
+        self.assertIs(type(parent), Author)
+        self.assertEqual((parent.pk, parent.name, parent.first_book_id), (self.jane.pk, "Jane", self.book.pk))
+        self.assertFalse(parent._state.adding)
+        self.assertIs(self.identity_map[Author.objects.get()], parent)
+
+    def test_existing_parent_is_used(self):
+        author = self.identity_map[Author.objects.get()]
+        children = list(AuthorWithAge.objects.all())
+        with self.assertNumQueries(0):
+            prefetch_related_objects_impl(self.identity_map, children, "author")
+        self.assertIs(children[0].author, author)
+
+    def test_deferred_parent_fields_are_fetched(self):
+        children = list(AuthorWithAge.objects.defer("name"))
+        with self.assertNumQueries(1):
+            prefetch_related_objects_impl(self.identity_map, children, "author")
+        self.assertEqual(children[0].author.name, "Jane")
+
+    def test_custom_queryset_is_used(self):
+        children = list(AuthorWithAge.objects.all())
+        with self.assertNumQueries(1):
+            prefetch_related_objects_impl(
+                self.identity_map, children, Prefetch("author", queryset=Author.objects.filter(name="Anne"))
+            )
+        with self.assertRaises(Author.DoesNotExist):
+            children[0].author
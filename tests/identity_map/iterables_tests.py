@@ -0,0 +1,89 @@
+from unittest import mock
+
+from django.db.models import Count
+from django.test import TestCase
+from prefetch_related.models import Author
+from prefetch_related.models import Book
+
+from django_prefetch_utils.identity_map.iterables import IdentityMapModelIterable
+from django_prefetch_utils.identity_map.iterables import can_use_identity_map_iterable
+from django_prefetch_utils.identity_map.maps import PrefetchIdentityMap
+from django_prefetch_utils.identity_map.persistent import use_persistent_prefetch_identity_map
+from django_prefetch_utils.identity_map.wrappers import IdentityMapIteratorWrapper
+from django_prefetch_utils.identity_map.wrappers import wrap_identity_map_for_queryset
+
+
+class IdentityMapModelIterableTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        cls.authors = [Author.objects.create(name="Author {}".format(i), first_book=cls.book) for i in range(3)]
+        cls.book.authors.add(*cls.authors[:2])
+
+    def setUp(self):
+        super().setUp()
+        self.identity_map = PrefetchIdentityMap()
+        self.authors = [self.identity_map[author] for author in Author.objects.all()]
+
+    def test_existing_rows_are_not_instantiated(self):
+        with mock.patch.object(Author, "from_db", wraps=Author.from_db) as from_db:
+            authors = list(IdentityMapModelIterable(self.identity_map, Author.objects.all()))
+        self.assertEqual(from_db.call_count, 0)
+        self.assertTrue(all(a is b for a, b in zip(authors, self.authors)))
+
+    def test_new_rows_are_added(self):
+        new_author = Author.objects.create(name="New", first_book=self.book)
+        with mock.patch.object(Author, "from_db", wraps=Author.from_db) as from_db:
+            authors = list(IdentityMapModelIterable(self.identity_map, Author.objects.all()))
+        self.assertEqual(from_db.call_count, 1)
+        self.assertEqual(authors[-1], new_author)
+        self.assertIs(self.identity_map[new_author], authors[-1])
+
+    def test_annotations_are_merged(self):
+        queryset = Author.objects.annotate(total_books=Count("books")).order_by("id")
+        authors = list(IdentityMapModelIterable(self.identity_map, queryset))
+        self.assertIs(authors[0], self.authors[0])
+        self.assertEqual([author.total_books for author in self.authors], [1, 1, 0])
+
+    def test_extra_is_merged(self):
+        queryset = Author.objects.extra(select={"double_id": "id * 2"})
+        list(IdentityMapModelIterable(self.identity_map, queryset))
+        self.assertEqual(self.authors[0].double_id, self.authors[0].id * 2)
+
+    def test_select_related_rows_are_instantiated(self):
+        queryset = Author.objects.select_related("first_book")
+        identity_map = wrap_identity_map_for_queryset(self.identity_map, queryset)
+        with mock.patch.object(Author, "from_db", wraps=Author.from_db) as from_db:
+            authors = list(IdentityMapModelIterable(identity_map, queryset))
+        self.assertEqual(from_db.call_count, 3)
+        self.assertIs(authors[0], self.authors[0])
+        with self.assertNumQueries(0):
+            self.assertIs(authors[0].first_book, authors[1].first_book)
+
+    def test_known_related_objects(self):
+        book = self.identity_map[Book.objects.get()]
+        authors = list(IdentityMapModelIterable(self.identity_map, book.first_time_authors.all()))
+        with self.assertNumQueries(0):
+            self.assertIs(authors[0].first_book, book)
+
+    def test_can_use_identity_map_iterable(self):
+        self.assertTrue(can_use_identity_map_iterable(Author.objects.all()))
+        self.assertFalse(can_use_identity_map_iterable(Author.objects.values_list("id")))
+        queryset = Author.objects.all()
+        list(queryset)
+        self.assertFalse(can_use_identity_map_iterable(queryset))
+
+    def test_persistent_identity_map(self):
+        with use_persistent_prefetch_identity_map(self.identity_map):
+            with mock.patch.object(Author, "from_db", wraps=Author.from_db) as from_db:
+                authors = list(Author.objects.all())
+                self.assertEqual(list(Author.objects.values_list("name", flat=True))[0], "Author 0")
+        self.assertEqual(from_db.call_count, 0)
+        self.assertIs(authors[0], self.authors[0])
+
+    def test_iterator_wrapper_fetches_once(self):
+        wrapper = IdentityMapIteratorWrapper(self.identity_map, Author.objects.all())
+        with self.assertNumQueries(1):
+            authors = list(wrapper)
+            self.assertEqual(len(wrapper), 3)
+        self.assertIs(authors[0], self.authors[0])
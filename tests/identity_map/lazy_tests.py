@@ -0,0 +1,129 @@
+import gc
+import pickle
+from unittest import mock
+
+from django.test import TestCase
+from prefetch_related.models import Author
+from prefetch_related.models import Bio
+from prefetch_related.models import Book
+from prefetch_related.models import Bookmark
+from prefetch_related.models import TaggedItem
+
+from django_prefetch_utils.identity_map.lazy import SIBLING_SET_ATTR
+from django_prefetch_utils.identity_map.lazy import is_lazy_loading_enabled
+from django_prefetch_utils.identity_map.lazy import load_siblings
+from django_prefetch_utils.identity_map.persistent import use_persistent_prefetch_identity_map
+from django_prefetch_utils.relation_access import _hooks
+
+
+class LazySiblingLoadingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.books = [Book.objects.create(title="Book {}".format(i)) for i in range(3)]
+        cls.authors = [
+            Author.objects.create(name="Author {}".format(i), first_book=book) for i, book in enumerate(cls.books)
+        ]
+        for book, author in zip(cls.books, cls.authors):
+            book.authors.add(author)
+            Bio.objects.create(author=author)
+            TaggedItem.objects.create(tag="tag", content_object=book)
+
+    def setUp(self):
+        super().setUp()
+        cm = use_persistent_prefetch_identity_map(lazy_loading=True)
+        cm.__enter__()
+        self.addCleanup(cm.__exit__, None, None, None)
+
+    def test_forward_many_to_one(self):
+        with self.assertNumQueries(2):
+            self.assertEqual([author.first_book for author in Author.objects.order_by("id")], self.books)
+
+    def test_reverse_one_to_one(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                [author.bio.author_id for author in Author.objects.order_by("id")], [a.name for a in self.authors]
+            )
+
+    def test_generic_relation(self):
+        for i in range(3):
+            bookmark = Bookmark.objects.create(url="http://example.com/{}".format(i))
+            TaggedItem.objects.create(tag="bookmark", content_object=bookmark)
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                [[tag.tag for tag in bookmark.tags.all()] for bookmark in Bookmark.objects.order_by("id")],
+                [["bookmark"]] * 3,
+            )
+
+    def test_reverse_many_to_one(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                [list(book.first_time_authors.all()) for book in Book.objects.order_by("id")],
+                [[author] for author in self.authors],
+            )
+
+    def test_many_to_many(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(
+                [list(book.authors.all()) for book in Book.objects.order_by("id")],
+                [[author] for author in self.authors],
+            )
+
+    def test_generic_foreign_key(self):
+        with self.assertNumQueries(2):
+            self.assertEqual([tag.content_object for tag in TaggedItem.objects.order_by("id")], self.books)
+
+    def test_related_objects_are_siblings(self):
+        with self.assertNumQueries(3):
+            authors = list(Author.objects.order_by("id"))
+            self.assertEqual([list(author.first_book.authors.all()) for author in authors], [[a] for a in authors])
+
+    def test_only_live_siblings_are_loaded(self):
+        authors = list(Author.objects.order_by("id"))
+        del authors[1:]
+        gc.collect()
+        with self.assertNumQueries(1):
+            authors[0].first_book
+
+    def test_unsupported_relations_are_not_prefetched(self):
+        authors = list(Author.objects.order_by("id"))
+        with self.assertNumQueries(0):
+            load_siblings(authors[0], "name")
+            load_siblings(authors[0], "missing")
+
+    def test_prefetch_errors_are_raised(self):
+        authors = list(Author.objects.order_by("id"))
+        prefetch_related_objects = mock.Mock(side_effect=ValueError("failed"))
+        with mock.patch(
+            "django_prefetch_utils.identity_map.lazy.get_prefetch_related_objects",
+            return_value=prefetch_related_objects,
+        ):
+            with self.assertRaises(ValueError):
+                authors[0].first_book
+
+    def test_values_querysets(self):
+        self.assertEqual(len(list(Author.objects.values("id"))), 3)
+
+    def test_pickled_instances_do_not_keep_siblings(self):
+        author = pickle.loads(pickle.dumps(list(Author.objects.order_by("id"))[0]))
+        self.assertEqual(author.__dict__[SIBLING_SET_ATTR].get_instances(), [])
+
+    def test_hook_is_removed_after_exit(self):
+        with use_persistent_prefetch_identity_map(lazy_loading=True):
+            self.assertTrue(is_lazy_loading_enabled())
+        self.assertTrue(is_lazy_loading_enabled())
+        self.doCleanups()
+        self.assertFalse(is_lazy_loading_enabled())
+        self.assertEqual(_hooks, [])
+
+
+class LazySiblingLoadingDisabledTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(3):
+            book = Book.objects.create(title="Book {}".format(i))
+            Author.objects.create(name="Author {}".format(i), first_book=book)
+
+    @use_persistent_prefetch_identity_map()
+    def test_not_enabled_by_default(self):
+        with self.assertNumQueries(4):
+            [author.first_book for author in Author.objects.all()]
@@ -0,0 +1,305 @@
+import threading
+import time
+from unittest import mock
+
+from django.db.models import Count
+from django.test import TestCase
+from django.test import override_settings
+from prefetch_related.models import Author
+from prefetch_related.models import AuthorAddress
+from prefetch_related.models import Book
+
+from django_prefetch_utils.identity_map import get_default_prefetch_identity_map
+from django_prefetch_utils.identity_map import get_transient_prefetch_identity_map
+from django_prefetch_utils.identity_map import prefetch_related_objects
+from django_prefetch_utils.identity_map.maps import IdentityMapStats
+from django_prefetch_utils.identity_map.maps import LockingIdentityMap
+from django_prefetch_utils.identity_map.maps import LRUPrefetchIdentityMap
+from django_prefetch_utils.identity_map.maps import PrefetchIdentityMap
+from django_prefetch_utils.identity_map.maps import QuerySetIdentityMap
+from django_prefetch_utils.identity_map.maps import StrongPrefetchIdentityMap
+from django_prefetch_utils.identity_map.persistent import use_persistent_prefetch_identity_map
+
+
+class LRUPrefetchIdentityMapTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        for i in range(4):
+            Author.objects.create(name="Author {}".format(i), first_book=cls.book)
+
+    def setUp(self):
+        super().setUp()
+        self.authors = list(Author.objects.all())
+
+    def test_returns_existing_instance(self):
+        identity_map = LRUPrefetchIdentityMap()
+        other = Author.objects.get(pk=self.authors[0].pk)
+        self.assertIs(identity_map[self.authors[0]], self.authors[0])
+        self.assertIs(identity_map[other], self.authors[0])
+        self.assertEqual(identity_map.get_stats(), IdentityMapStats(hits=1, misses=1, evictions=0, size=1))
+
+    def test_global_capacity_evicts_least_recently_used(self):
+        identity_map = LRUPrefetchIdentityMap(maxsize=2)
+        a, b, c, _ = self.authors
+        identity_map[a]
+        identity_map[b]
+        identity_map[a]
+        identity_map[c]
+        self.assertEqual(set(identity_map.get_map_for_model(Author)), {a.pk, c.pk})
+        self.assertEqual(identity_map.get_stats(), IdentityMapStats(hits=1, misses=3, evictions=1, size=2))
+
+    def test_global_capacity_spans_models(self):
+        identity_map = LRUPrefetchIdentityMap(maxsize=2)
+        identity_map[self.book]
+        identity_map[self.authors[0]]
+        identity_map[self.authors[1]]
+        self.assertEqual(dict(identity_map.get_map_for_model(Book)), {})
+        self.assertEqual(len(identity_map), 2)
+
+    def test_per_model_capacity(self):
+        identity_map = LRUPrefetchIdentityMap(maxsize=None, max_per_model=2)
+        identity_map[self.book]
+        for author in self.authors:
+            identity_map[author]
+        self.assertEqual(list(identity_map.get_map_for_model(Author)), [author.pk for author in self.authors[2:]])
+        self.assertEqual(list(identity_map.get_map_for_model(Book)), [self.book.pk])
+        self.assertEqual(identity_map.get_stats(), IdentityMapStats(hits=0, misses=5, evictions=2, size=3))
+
+    def test_clear(self):
+        identity_map = LRUPrefetchIdentityMap()
+        identity_map[self.book]
+        identity_map.clear()
+        self.assertEqual(len(identity_map), 0)
+        self.assertEqual(identity_map.misses, 1)
+
+    @override_settings(PREFETCH_UTILS_IDENTITY_MAP_MAXSIZE=10, PREFETCH_UTILS_IDENTITY_MAP_MAX_PER_MODEL=5)
+    def test_settings(self):
+        identity_map = LRUPrefetchIdentityMap()
+        self.assertEqual((identity_map.maxsize, identity_map.max_per_model), (10, 5))
+
+    def test_persistent_identity_map(self):
+        identity_map = LRUPrefetchIdentityMap(maxsize=10)
+        with use_persistent_prefetch_identity_map(identity_map):
+            authors = list(Author.objects.prefetch_related("first_book"))
+            with self.assertNumQueries(1):
+                other_authors = list(Author.objects.prefetch_related("first_book"))
+        self.assertIs(authors[0].first_book, other_authors[3].first_book)
+        self.assertGreater(identity_map.hits, 0)
+
+
+class StrongPrefetchIdentityMapTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+
+    def test_keeps_instances_alive(self):
+        identity_map = StrongPrefetchIdentityMap()
+        pk = identity_map[Book.objects.get()].pk
+        self.assertIsInstance(identity_map.get_map_for_model(Book), dict)
+        self.assertEqual(identity_map.get_map_for_model(Book)[pk].title, "Poems")
+
+    def test_transient_identity_map(self):
+        self.assertIsInstance(get_transient_prefetch_identity_map(), StrongPrefetchIdentityMap)
+        self.assertNotIsInstance(get_default_prefetch_identity_map(), StrongPrefetchIdentityMap)
+
+    def test_used_by_prefetch_related_objects(self):
+        Author.objects.create(name="Anne", first_book=self.book)
+        authors = list(Author.objects.all())
+        with mock.patch(
+            "django_prefetch_utils.identity_map.prefetch_related_objects_impl"
+        ) as prefetch_related_objects_impl:
+            prefetch_related_objects(authors, "first_book")
+        identity_map = prefetch_related_objects_impl.call_args[0][0]
+        self.assertIsInstance(identity_map, StrongPrefetchIdentityMap)
+
+
+class SlowIdentityMap(object):
+    """
+    An identity map whose methods give up the GIL part way through
+    updating it, so that unlocked calls from several threads interleave.
+    """
+
+    def __init__(self):
+        self.maps = {}
+        self.relation_sets = self
+        self.missing_keys = self
+        self.calls = 0
+
+    def get_map_for_model(self, model):
+        if model not in self.maps:
+            time.sleep(0.001)
+            self.maps[model] = {}
+        return self.maps[model]
+
+    def set(self, instance, relation_key, rel_objs):
+        calls = self.calls
+        time.sleep(0.001)
+        self.calls = calls + 1
+
+    def add(self, model, attname, values):
+        self.set(None, None, values)
+
+
+class LockingIdentityMapTests(TestCase):
+    def run_in_threads(self, func, count=8):
+        barrier = threading.Barrier(count)
+        results = []
+
+        def target():
+            barrier.wait()
+            results.append(func())
+
+        threads = [threading.Thread(target=target) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_get_map_for_model(self):
+        identity_map = LockingIdentityMap(SlowIdentityMap())
+        maps = self.run_in_threads(lambda: identity_map.get_map_for_model(Book))
+        self.assertEqual(len({id(sub_map) for sub_map in maps}), 1)
+
+    def test_relation_sets_and_missing_keys(self):
+        wrapped = SlowIdentityMap()
+        identity_map = LockingIdentityMap(wrapped)
+
+        def record():
+            identity_map.relation_sets.set(None, None, ())
+            identity_map.missing_keys.add(Book, "id", iter([1]))
+
+        self.run_in_threads(record)
+        self.assertEqual(wrapped.calls, 16)
+
+    def test_calls_wait_for_lock(self):
+        wrapped = PrefetchIdentityMap(track_missing=True)
+        identity_map = LockingIdentityMap(wrapped)
+        with identity_map._self_lock:
+            thread = threading.Thread(target=identity_map.missing_keys.add, args=(Book, "id", [1]))
+            thread.start()
+            thread.join(0.05)
+            self.assertTrue(thread.is_alive())
+            self.assertFalse(wrapped.missing_keys.contains(Book, "id", 1))
+        thread.join()
+        self.assertTrue(identity_map.missing_keys.contains(Book, "id", 1))
+
+    def test_untracked_records(self):
+        identity_map = LockingIdentityMap(PrefetchIdentityMap())
+        self.assertIsNone(identity_map.relation_sets)
+        self.assertIsNone(identity_map.missing_keys)
+
+
+class FieldMapTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        cls.jane = Author.objects.create(name="Jane", first_book=cls.book)
+        cls.anne = Author.objects.create(name="Anne", first_book=cls.book)
+        AuthorAddress.objects.create(author=cls.jane, address="Haworth")
+
+    def setUp(self):
+        super().setUp()
+        self.name_field = Author._meta.get_field("name")
+
+    def check_field_map(self, identity_map):
+        jane = identity_map[Author.objects.get(name="Jane")]
+        field_map = identity_map.get_map_for_field(Author, self.name_field)
+        self.assertEqual(dict(field_map), {"Jane": jane})
+
+        anne = identity_map[Author.objects.get(name="Anne")]
+        self.assertIs(identity_map.get_map_for_field(Author, self.name_field), field_map)
+        self.assertEqual(dict(field_map), {"Jane": jane, "Anne": anne})
+        return jane, anne
+
+    def test_prefetch_identity_map(self):
+        identity_map = PrefetchIdentityMap()
+        jane, anne = self.check_field_map(identity_map)
+        del jane
+        self.assertEqual(list(identity_map.get_map_for_field(Author, self.name_field)), ["Anne"])
+
+    def test_strong_prefetch_identity_map(self):
+        self.check_field_map(StrongPrefetchIdentityMap())
+
+    def test_lru_prefetch_identity_map(self):
+        identity_map = LRUPrefetchIdentityMap(maxsize=2)
+        jane, anne = self.check_field_map(identity_map)
+        identity_map[self.book]
+        self.assertEqual(dict(identity_map.get_map_for_field(Author, self.name_field)), {"Anne": anne})
+
+    def test_deferred_fields_are_not_loaded(self):
+        identity_map = PrefetchIdentityMap()
+        identity_map[Author.objects.only("id").get(name="Jane")]
+        with self.assertNumQueries(0):
+            self.assertEqual(dict(identity_map.get_map_for_field(Author, self.name_field)), {})
+
+    def test_to_field_relation_uses_field_map(self):
+        with use_persistent_prefetch_identity_map() as identity_map:
+            jane = Author.objects.get(name="Jane")
+            with self.assertNumQueries(1):
+                (address,) = AuthorAddress.objects.prefetch_related("author")
+            self.assertIs(address.author, jane)
+            self.assertIn("Jane", identity_map.get_map_for_field(Author, self.name_field))
+
+    def test_changed_to_field_value_is_not_used(self):
+        with use_persistent_prefetch_identity_map():
+            jane = Author.objects.get(name="Jane")
+            jane.name = "Charlotte"
+            with self.assertNumQueries(2):
+                list(AuthorAddress.objects.prefetch_related("author"))
+
+
+class QuerySetIdentityMapTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        cls.jane = Author.objects.create(name="Jane", first_book=cls.book)
+        cls.book.authors.add(cls.jane)
+        AuthorAddress.objects.create(author=cls.jane, address="Haworth")
+
+    def setUp(self):
+        super().setUp()
+        self.identity_map = PrefetchIdentityMap()
+        self.author = self.identity_map[Author.objects.get()]
+        self.book = self.identity_map[Book.objects.get()]
+
+    def test_plain_queryset_is_not_wrapped(self):
+        self.assertIs(QuerySetIdentityMap.for_queryset(self.identity_map, Author.objects.all()), self.identity_map)
+
+    def test_annotations_and_extra_are_merged(self):
+        queryset = Author.objects.annotate(total_books=Count("books")).extra(
+            select={"double_id": "prefetch_related_author.id * 2"}
+        )
+        identity_map = QuerySetIdentityMap.for_queryset(self.identity_map, queryset)
+        self.assertIs(identity_map[queryset.get()], self.author)
+        self.assertEqual(self.author.total_books, 1)
+        self.assertEqual(self.author.double_id, self.author.id * 2)
+
+    def test_nested_select_related_is_merged(self):
+        queryset = AuthorAddress.objects.select_related("author__first_book")
+        identity_map = QuerySetIdentityMap.for_queryset(self.identity_map, queryset)
+        address = identity_map[queryset.get()]
+        with self.assertNumQueries(0):
+            self.assertIs(address.author, self.author)
+            self.assertIs(self.author.first_book, self.book)
+
+    def test_default_select_related_is_merged(self):
+        queryset = Author.objects.select_related()
+        identity_map = QuerySetIdentityMap.for_queryset(self.identity_map, queryset)
+        self.assertIs(identity_map[queryset.get()], self.author)
+        with self.assertNumQueries(0):
+            self.assertIs(self.author.first_book, self.book)
+
+    def test_rel_obj_attr(self):
+        queryset = Author.objects.all()
+        identity_map = QuerySetIdentityMap.for_queryset(
+            self.identity_map, queryset, rel_obj_attr=lambda author: (author.name.upper(),)
+        )
+        self.assertIs(identity_map[queryset.get()], self.author)
+        self.assertEqual(identity_map.rel_obj_attr(self.author), ("JANE",))
+
+    def test_other_attributes_use_wrapped_identity_map(self):
+        queryset = Author.objects.annotate(total_books=Count("books"))
+        identity_map = QuerySetIdentityMap.for_queryset(self.identity_map, queryset)
+        self.assertIs(identity_map.get_map_for_model(Author), self.identity_map.get_map_for_model(Author))
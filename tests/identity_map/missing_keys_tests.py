@@ -0,0 +1,83 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Prefetch
+from django.test import TestCase
+from prefetch_related.models import Author
+from prefetch_related.models import AuthorWithAge
+from prefetch_related.models import Book
+from prefetch_related.models import DirectBio
+from prefetch_related.models import TaggedItem
+
+from django_prefetch_utils.identity_map import prefetch_related_objects_impl
+from django_prefetch_utils.identity_map.maps import LRUPrefetchIdentityMap
+from django_prefetch_utils.identity_map.maps import MissingKeys
+from django_prefetch_utils.identity_map.maps import PrefetchIdentityMap
+from django_prefetch_utils.identity_map.maps import StrongPrefetchIdentityMap
+
+
+class MissingKeysTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        cls.jane = Author.objects.create(name="Jane", first_book=cls.book)
+        cls.anne = Author.objects.create(name="Anne", first_book=cls.book)
+        book_ct = ContentType.objects.get_for_model(Book)
+        TaggedItem.objects.create(tag="found", content_object=cls.book)
+        TaggedItem.objects.create(tag="missing", content_type=book_ct, object_id=cls.book.pk + 100)
+
+    def setUp(self):
+        super().setUp()
+        self.identity_map = PrefetchIdentityMap(track_missing=True)
+
+    def prefetch(self, model, *lookups):
+        # New instances are fetched each time so that their caches are
+        # empty and only the identity map is shared.
+        instances = list(model.objects.all())
+        prefetch_related_objects_impl(self.identity_map, instances, *lookups)
+        return instances
+
+    def test_reverse_one_to_one(self):
+        with self.assertNumQueries(2):
+            self.prefetch(Author, "direct_bio")
+        with self.assertNumQueries(1):
+            authors = self.prefetch(Author, "direct_bio")
+        with self.assertNumQueries(0):
+            self.assertFalse(any(hasattr(author, "direct_bio") for author in authors))
+        del authors
+
+        bio = DirectBio.objects.create(author=self.anne)
+        with self.assertNumQueries(2):
+            authors = self.prefetch(Author, "direct_bio")
+        self.assertEqual(authors[1].direct_bio, bio)
+
+    def test_generic_foreign_key(self):
+        with self.assertNumQueries(2):
+            items = self.prefetch(TaggedItem, "content_object")
+        with self.assertNumQueries(1):
+            items = self.prefetch(TaggedItem, "content_object")
+        self.assertEqual([item.content_object for item in items], [self.book, None])
+
+        book = Book.objects.create(pk=items[1].object_id, title="Jane Eyre")
+        with self.assertNumQueries(2):
+            items = self.prefetch(TaggedItem, "content_object")
+        self.assertEqual(items[1].content_object, book)
+
+    def test_custom_queryset_is_not_recorded(self):
+        self.prefetch(Author, Prefetch("direct_bio", DirectBio.objects.all()))
+        self.assertEqual(len(self.identity_map.missing_keys), 0)
+
+    def test_child_model_save_discards_parent_keys(self):
+        missing_keys = MissingKeys()
+        missing_keys.add(Author, "name", ["Charlotte"])
+        self.assertTrue(missing_keys.contains(Author, "name", "Charlotte"))
+        AuthorWithAge.objects.create(name="Charlotte", first_book=self.book, age=30)
+        self.assertFalse(missing_keys.contains(Author, "name", "Charlotte"))
+
+    def test_lru_prefetch_identity_map(self):
+        identity_map = LRUPrefetchIdentityMap(track_missing=True)
+        identity_map.missing_keys.add(Author, "name", ["Charlotte"])
+        identity_map.clear()
+        self.assertEqual(len(identity_map.missing_keys), 0)
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(PrefetchIdentityMap().missing_keys)
+        self.assertIsNone(StrongPrefetchIdentityMap().missing_keys)
@@ -1,10 +1,15 @@
+import asyncio
+import contextvars
+
 from django.db.models.query import QuerySet
+from django.test import SimpleTestCase
 from django.test import TestCase
 from prefetch_related.models import Author
 from prefetch_related.models import Book
 
 from django_prefetch_utils.identity_map import get_default_prefetch_identity_map
 from django_prefetch_utils.identity_map.persistent import FetchAllDescriptor
+from django_prefetch_utils.identity_map.persistent import _active
 from django_prefetch_utils.identity_map.persistent import disable_fetch_all_descriptor
 from django_prefetch_utils.identity_map.persistent import enable_fetch_all_descriptor
 from django_prefetch_utils.identity_map.persistent import original_fetch_all
@@ -65,6 +70,74 @@ class PersistentPrefetchIdentityMapIntegrationTests(TestCase):
         test_function()
 
 
+class ServePkLookupsTests(TestCase):
+    databases = {"default", "other"}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        cls.authors = [Author.objects.create(name="Author {}".format(i), first_book=cls.book) for i in range(3)]
+
+    def setUp(self):
+        super().setUp()
+        cm = use_persistent_prefetch_identity_map(serve_pk_lookups=True)
+        self.identity_map = cm.__enter__()
+        self.addCleanup(lambda: cm.__exit__(None, None, None))
+        self.mapped = [self.identity_map[author] for author in self.authors[:2]]
+
+    def test_get(self):
+        with self.assertNumQueries(0):
+            self.assertIs(Author.objects.get(pk=self.authors[0].pk), self.mapped[0])
+            self.assertIs(Author.objects.get(id=str(self.authors[1].pk)), self.mapped[1])
+
+    def test_get_missing(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(Author.objects.get(pk=self.authors[2].pk), self.authors[2])
+        with self.assertNumQueries(1), self.assertRaises(Author.DoesNotExist):
+            Author.objects.get(pk=0)
+
+    def test_in_bulk(self):
+        with self.assertNumQueries(0):
+            objs = Author.objects.in_bulk([author.pk for author in self.authors[:2]])
+        self.assertEqual(objs, {obj.pk: obj for obj in self.mapped})
+        self.assertIs(objs[self.authors[0].pk], self.mapped[0])
+
+    def test_only_missing_keys_are_queried(self):
+        with self.assertNumQueries(1) as context:
+            objs = list(Author.objects.filter(pk__in=[author.pk for author in reversed(self.authors)]))
+        self.assertEqual(objs, self.authors)
+        self.assertIs(objs[0], self.mapped[0])
+        self.assertIn("IN (%d)" % self.authors[2].pk, context.captured_queries[0]["sql"])
+
+    def test_other_queries_are_not_served(self):
+        for queryset in [
+            Author.objects.filter(pk=self.authors[0].pk, name="Author 0"),
+            Author.objects.filter(pk=self.authors[0].pk).order_by("name"),
+            Author.objects.filter(pk=self.authors[0].pk).select_related("first_book"),
+            Author.objects.filter(pk=self.authors[0].pk).only("name"),
+            Author.objects.exclude(pk=self.authors[0].pk),
+            Author.objects.filter(first_book__pk=self.book.pk),
+        ]:
+            with self.assertNumQueries(1):
+                list(queryset)
+
+    def test_other_database_is_queried(self):
+        with self.assertNumQueries(0), self.assertNumQueries(1, using="other"):
+            with self.assertRaises(Author.DoesNotExist):
+                Author.objects.using("other").get(pk=self.authors[0].pk)
+
+    def test_prefetch_related(self):
+        list(Author.objects.prefetch_related("first_book"))
+        with self.assertNumQueries(0):
+            author = Author.objects.prefetch_related("first_book").get(pk=self.authors[0].pk)
+            self.assertEqual(author.first_book, self.book)
+
+    def test_disabled_by_default(self):
+        with use_persistent_prefetch_identity_map(self.identity_map):
+            with self.assertNumQueries(1):
+                self.assertIs(Author.objects.get(pk=self.authors[0].pk), self.mapped[0])
+
+
 class FetchAllDescriptorTests(TestCase):
     def setUp(self):
         super().setUp()
@@ -77,3 +150,34 @@ class FetchAllDescriptorTests(TestCase):
     def test_disable_descriptor(self):
         disable_fetch_all_descriptor()
         self.assertIs(QuerySet._fetch_all, original_fetch_all)
+
+
+class PersistentPrefetchIdentityMapContextTests(SimpleTestCase):
+    def test_identity_map_is_local_to_task(self):
+        seen = []
+
+        @use_persistent_prefetch_identity_map(pass_identity_map=True)
+        async def task(identity_map):
+            await asyncio.sleep(0)
+            seen.append(_active.get() is identity_map)
+
+        async def main():
+            await asyncio.gather(task(), task())
+
+        asyncio.run(main())
+        self.assertEqual(seen, [True, True])
+        self.assertIsNone(_active.get())
+
+    def test_identity_map_is_visible_in_copied_context(self):
+        with use_persistent_prefetch_identity_map() as identity_map:
+            context = contextvars.copy_context()
+        self.assertIsNone(_active.get())
+        self.assertIs(context.run(_active.get), identity_map)
+
+    def test_nested_use_of_same_instance(self):
+        cm = use_persistent_prefetch_identity_map()
+        with cm as outer:
+            with cm as inner:
+                self.assertIs(_active.get(), inner)
+            self.assertIs(_active.get(), outer)
+        self.assertIsNone(_active.get())
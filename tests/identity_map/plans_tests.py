@@ -0,0 +1,123 @@
+from unittest import mock
+
+from django.db.models import Prefetch
+from django.db.models.fields.related_descriptors import ManyToManyDescriptor
+from django.test import SimpleTestCase
+from django.test import TestCase
+from django.test import override_settings
+from prefetch_related.models import Author
+from prefetch_related.models import Book
+
+from django_prefetch_utils.identity_map import prefetch_related_objects
+from django_prefetch_utils.identity_map.plans import CompiledPrefetch
+from django_prefetch_utils.identity_map.plans import LevelPlanCache
+from django_prefetch_utils.identity_map.plans import PrefetchPlanCache
+from django_prefetch_utils.identity_map.plans import clear_prefetch_plan_caches
+from django_prefetch_utils.identity_map.plans import get_level_plan
+from django_prefetch_utils.identity_map.plans import prefetch_plan_cache
+from django_prefetch_utils.identity_map.wrappers import IdentityMapPrefetcher
+from django_prefetch_utils.identity_map.wrappers import ManyToManyRelatedManagerWrapper
+
+
+class CompiledPrefetchTests(SimpleTestCase):
+    def test_levels_match_prefetch(self):
+        for lookup in ["authors", "authors__first_book__authors"]:
+            compiled, prefetch = CompiledPrefetch(lookup), Prefetch(lookup)
+            self.assertEqual(compiled, prefetch)
+            self.assertEqual(compiled.through_attrs, tuple(lookup.split("__")))
+            for level in range(len(compiled.through_attrs)):
+                self.assertEqual(compiled.get_current_prefetch_to(level), prefetch.get_current_prefetch_to(level))
+                self.assertEqual(compiled.get_current_to_attr(level), prefetch.get_current_to_attr(level))
+
+
+class PrefetchPlanCacheTests(SimpleTestCase):
+    def test_lookups_are_reused(self):
+        cache = PrefetchPlanCache(maxsize=2)
+        first = cache.get_lookups(Book, ("authors", "first_time_authors"))
+        second = cache.get_lookups(Book, ("authors", "first_time_authors"))
+        self.assertIsNot(first, second)
+        self.assertEqual([lookup.prefetch_to for lookup in first], ["first_time_authors", "authors"])
+        self.assertTrue(all(a is b for a, b in zip(first, second)))
+
+    def test_least_recently_used_plan_is_evicted(self):
+        cache = PrefetchPlanCache(maxsize=2)
+        authors = cache.get_lookups(Book, ("authors",))
+        cache.get_lookups(Book, ("first_time_authors",))
+        cache.get_lookups(Book, ("authors",))
+        cache.get_lookups(Author, ("books",))
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get_lookups(Book, ("authors",))[0], authors[0])
+
+    def test_prefetch_objects_are_not_cached(self):
+        cache = PrefetchPlanCache(maxsize=2)
+        prefetch = Prefetch("authors")
+        self.assertEqual(cache.get_lookups(Book, (prefetch,)), [prefetch])
+        self.assertEqual(len(cache), 0)
+
+    @override_settings(PREFETCH_UTILS_PLAN_CACHE_SIZE=0)
+    def test_disabled_by_setting(self):
+        cache = PrefetchPlanCache()
+        cache.get_lookups(Book, ("authors",))
+        self.assertEqual(len(cache), 0)
+
+
+class LevelPlanTests(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(clear_prefetch_plan_caches)
+
+    def test_plan_is_cached(self):
+        self.assertIs(get_level_plan(Book, "authors", "authors"), get_level_plan(Book, "authors", "authors"))
+
+    def test_descriptor_plan(self):
+        plan = get_level_plan(Book, "authors", "authors")
+        self.assertIsInstance(plan.descriptor, ManyToManyDescriptor)
+        self.assertFalse(plan.is_prefetcher)
+        self.assertIs(plan.wrapper_class, ManyToManyRelatedManagerWrapper)
+
+    def test_missing_attribute_plan(self):
+        plan = get_level_plan(Book, "missing", "missing")
+        self.assertIsNone(plan.descriptor)
+        self.assertIs(plan.wrapper_class, IdentityMapPrefetcher)
+
+    def test_least_recently_used_plan_is_evicted(self):
+        cache = LevelPlanCache(maxsize=2)
+        authors = cache.get_plan(Book, "authors", "authors")
+        cache.get_plan(Book, "first_time_authors", "first_time_authors")
+        cache.get_plan(Book, "authors", "authors")
+        cache.get_plan(Author, "books", "books")
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get_plan(Book, "authors", "authors"), authors)
+
+    @override_settings(PREFETCH_UTILS_PLAN_CACHE_SIZE=0)
+    def test_disabled_by_setting(self):
+        cache = LevelPlanCache()
+        cache.get_plan(Book, "authors", "authors")
+        self.assertEqual(len(cache), 0)
+
+
+class PlanCacheIntegrationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        cls.author = Author.objects.create(name="Jane", first_book=cls.book)
+        cls.book.authors.add(cls.author)
+
+    def test_repeated_prefetches(self):
+        prefetch_plan_cache.clear()
+        for _ in range(2):
+            book = Book.objects.get()
+            with self.assertNumQueries(2):
+                prefetch_related_objects([book], "authors__first_book", "first_time_authors")
+            with self.assertNumQueries(0):
+                self.assertEqual([a.first_book for a in book.authors.all()], [book])
+                self.assertIs(book.first_time_authors.all()[0], book.authors.all()[0])
+        self.assertEqual(len(prefetch_plan_cache), 1)
+
+    def test_level_plan_is_looked_up_once_per_level(self):
+        book = Book.objects.get()
+        with mock.patch(
+            "django_prefetch_utils.identity_map.get_level_plan", wraps=get_level_plan
+        ) as mock_get_level_plan:
+            prefetch_related_objects([book], "authors__first_book")
+        self.assertEqual(mock_get_level_plan.call_count, 2)
@@ -0,0 +1,97 @@
+import gc
+
+from django.db.models import Prefetch
+from django.test import TestCase
+from prefetch_related.models import Author
+from prefetch_related.models import Book
+
+from django_prefetch_utils.identity_map.maps import PrefetchIdentityMap
+from django_prefetch_utils.identity_map.persistent import use_persistent_prefetch_identity_map
+from django_prefetch_utils.identity_map.streaming import release_prefetched_objects
+
+
+class RelationSetsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book1 = Book.objects.create(title="Poems")
+        cls.book2 = Book.objects.create(title="Jane Eyre")
+        cls.charlotte = Author.objects.create(name="Charlotte", first_book=cls.book1)
+        cls.anne = Author.objects.create(name="Anne", first_book=cls.book1)
+        cls.book1.authors.add(cls.charlotte, cls.anne)
+        cls.book2.authors.add(cls.charlotte)
+
+    def setUp(self):
+        super().setUp()
+        self.identity_map = PrefetchIdentityMap(track_relations=True)
+        cm = use_persistent_prefetch_identity_map(self.identity_map)
+        cm.__enter__()
+        self.addCleanup(lambda: cm.__exit__(None, None, None))
+        self.authors = list(Author.objects.all())
+
+    def prefetch(self, *lookups):
+        books = list(Book.objects.prefetch_related(*lookups))
+        self.addCleanup(release_prefetched_objects, books)
+        return books
+
+    def refetch(self, books, *lookups):
+        release_prefetched_objects(books)
+        return self.prefetch(*lookups)
+
+    def get_names(self, books, attname):
+        return [[author.name for author in getattr(book, attname).all()] for book in books]
+
+    def test_reverse_many_to_one(self):
+        books = self.prefetch("first_time_authors")
+        charlotte = books[0].first_time_authors.all()[0]
+        with self.assertNumQueries(1):
+            books = self.refetch(books, "first_time_authors")
+        self.assertEqual(self.get_names(books, "first_time_authors"), [["Charlotte", "Anne"], []])
+        self.assertIs(books[0].first_time_authors.all()[0], charlotte)
+        with self.assertNumQueries(0):
+            self.assertIs(charlotte.first_book, books[0])
+
+    def test_many_to_many(self):
+        books = self.prefetch("authors")
+        self.assertEqual(self.get_names(books, "authors"), [["Charlotte", "Anne"], ["Charlotte"]])
+        with self.assertNumQueries(1):
+            books = self.refetch(books, "authors")
+        self.assertEqual(self.get_names(books, "authors"), [["Charlotte", "Anne"], ["Charlotte"]])
+        self.assertIs(books[0].authors.all()[0], books[1].authors.all()[0])
+
+    def test_only_new_instances_are_queried(self):
+        books = self.prefetch("authors")
+        book3 = Book.objects.create(title="Agnes Grey")
+        book3.authors.add(self.anne)
+        with self.assertNumQueries(2) as context:
+            books = self.refetch(books, "authors")
+        self.assertIn("IN (%d)" % book3.pk, context.captured_queries[1]["sql"])
+        self.assertEqual(self.get_names(books, "authors"), [["Charlotte", "Anne"], ["Charlotte"], ["Anne"]])
+
+    def test_same_custom_queryset_is_reused(self):
+        lookup = Prefetch("authors", Author.objects.filter(name="Anne"))
+        books = self.prefetch(lookup)
+        with self.assertNumQueries(1):
+            books = self.refetch(books, lookup)
+        self.assertEqual(self.get_names(books, "authors"), [["Anne"], []])
+
+        with self.assertNumQueries(2):
+            books = self.refetch(books, "authors")
+        self.assertEqual(self.get_names(books, "authors"), [["Charlotte", "Anne"], ["Charlotte"]])
+
+    def test_collected_related_objects_are_fetched(self):
+        books = self.prefetch("first_time_authors")
+        release_prefetched_objects(books)
+        del self.authors
+        gc.collect()
+        self.assertEqual(dict(self.identity_map.get_map_for_model(Author)), {})
+        with self.assertNumQueries(2):
+            books = self.prefetch("first_time_authors")
+        self.assertEqual(self.get_names(books, "first_time_authors"), [["Charlotte", "Anne"], []])
+
+    def test_disabled_by_default(self):
+        self.assertIsNone(PrefetchIdentityMap().relation_sets)
+        with use_persistent_prefetch_identity_map():
+            books = list(Book.objects.prefetch_related("authors"))
+            release_prefetched_objects(books)
+            with self.assertNumQueries(2):
+                list(Book.objects.prefetch_related("authors"))
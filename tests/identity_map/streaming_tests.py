@@ -0,0 +1,85 @@
+import gc
+
+from django.test import TestCase
+from django.test import override_settings
+from prefetch_related.models import Author
+from prefetch_related.models import Book
+
+from django_prefetch_utils.identity_map.maps import PrefetchIdentityMap
+from django_prefetch_utils.identity_map.maps import RetainingIdentityMap
+from django_prefetch_utils.identity_map.persistent import use_persistent_prefetch_identity_map
+from django_prefetch_utils.identity_map.streaming import get_max_retained
+from django_prefetch_utils.identity_map.streaming import iter_prefetched
+
+
+class IterPrefetchedTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        cls.other_book = Book.objects.create(title="Stories")
+        cls.authors = [Author.objects.create(name="Author {}".format(i), first_book=cls.book) for i in range(6)]
+        for author in cls.authors:
+            cls.other_book.authors.add(author)
+
+    def test_shared_related_objects_are_fetched_once(self):
+        with self.assertNumQueries(2):
+            authors = list(iter_prefetched(Author.objects.order_by("id"), "first_book", chunk_size=2))
+        self.assertEqual(authors, self.authors)
+        self.assertTrue(all(author.first_book is authors[0].first_book for author in authors))
+
+    def test_many_related_objects_are_fetched_per_chunk(self):
+        with self.assertNumQueries(4):
+            authors = list(iter_prefetched(Author.objects.order_by("id"), "books", chunk_size=2))
+        with self.assertNumQueries(0):
+            self.assertEqual([list(author.books.all()) for author in authors], [[self.other_book]] * 6)
+
+    def test_lookups_from_queryset_are_used(self):
+        with self.assertNumQueries(2):
+            for author in iter_prefetched(Author.objects.prefetch_related("first_book"), chunk_size=3):
+                self.assertEqual(author.first_book, self.book)
+
+    def test_no_lookups(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(len(list(iter_prefetched(Author.objects.all(), chunk_size=4))), 6)
+
+    def test_related_caches_are_released_after_each_chunk(self):
+        iterator = iter_prefetched(Author.objects.order_by("id"), "first_book__authors", chunk_size=6)
+        author = next(iterator)
+        book = author.first_book
+        self.assertIn("authors", book._prefetched_objects_cache)
+        list(iterator)
+        self.assertFalse(hasattr(book, "_prefetched_objects_cache"))
+
+    def test_shared_related_objects_are_retained_between_chunks(self):
+        with self.assertNumQueries(2):
+            for author in iter_prefetched(Author.objects.order_by("id"), "first_book", chunk_size=2):
+                self.assertEqual(author.first_book, self.book)
+
+    @override_settings(PREFETCH_UTILS_STREAMING_MAX_RETAINED=5)
+    def test_max_retained_setting(self):
+        self.assertEqual(get_max_retained(), 5)
+
+    def test_uses_persistent_identity_map(self):
+        with use_persistent_prefetch_identity_map() as identity_map:
+            book = identity_map[Book.objects.get(id=self.book.id)]
+            with self.assertNumQueries(1):
+                authors = list(iter_prefetched(Author.objects.all(), "first_book", chunk_size=2))
+            self.assertTrue(all(author.first_book is book for author in authors))
+
+
+class RetainingIdentityMapTests(TestCase):
+    def test_most_recent_objects_are_retained(self):
+        identity_map = RetainingIdentityMap(2, [Author], PrefetchIdentityMap())
+        books = [Book(id=i) for i in range(3)]
+        for book in books:
+            identity_map[book]
+        self.assertEqual(identity_map.retained_objects(), books[1:])
+
+        del books
+        gc.collect()
+        self.assertEqual(sorted(identity_map.get_map_for_model(Book)), [1, 2])
+
+    def test_excluded_models_are_not_retained(self):
+        identity_map = RetainingIdentityMap(2, [Author], PrefetchIdentityMap())
+        identity_map[Author(id=1)]
+        self.assertEqual(identity_map.retained_objects(), [])
@@ -0,0 +1,91 @@
+from unittest import mock
+
+from django.db.models import Prefetch
+from django.test import TestCase
+from django.test import override_settings
+from prefetch_related.models import Author
+from prefetch_related.models import Book
+
+from django_prefetch_utils.identity_map import prefetch_related_objects_impl
+from django_prefetch_utils.identity_map import two_phase
+from django_prefetch_utils.identity_map.maps import PrefetchIdentityMap
+from django_prefetch_utils.identity_map.two_phase import TwoPhasePrefetch
+
+
+class TwoPhasePrefetchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book1 = Book.objects.create(title="Poems")
+        cls.book2 = Book.objects.create(title="Jane Eyre")
+        cls.charlotte = Author.objects.create(name="Charlotte", first_book=cls.book1)
+        cls.anne = Author.objects.create(name="Anne", first_book=cls.book1)
+        cls.book1.authors.add(cls.charlotte, cls.anne)
+        cls.book2.authors.add(cls.charlotte)
+
+    def setUp(self):
+        super().setUp()
+        self.identity_map = PrefetchIdentityMap()
+
+    def prefetch(self, *lookups):
+        books = [self.identity_map[book] for book in Book.objects.all()]
+        prefetch_related_objects_impl(self.identity_map, books, *lookups)
+        return books
+
+    def get_names(self, books, attname):
+        return [[author.name for author in getattr(book, attname).all()] for book in books]
+
+    def test_many_to_many(self):
+        authors = [self.identity_map[author] for author in Author.objects.all()]
+        with self.assertNumQueries(2) as context:
+            books = self.prefetch(TwoPhasePrefetch("authors"))
+        self.assertNotIn('"name"', context.captured_queries[1]["sql"])
+        self.assertEqual(self.get_names(books, "authors"), [["Charlotte", "Anne"], ["Charlotte"]])
+        self.assertIs(books[0].authors.all()[0], authors[0])
+        self.assertIs(books[1].authors.all()[0], authors[0])
+
+    def test_missing_objects_are_fetched(self):
+        charlotte = self.identity_map[Author.objects.get(name="Charlotte")]
+        with self.assertNumQueries(3) as context:
+            books = self.prefetch(TwoPhasePrefetch("authors"))
+        self.assertIn("IN (%d)" % self.anne.pk, context.captured_queries[2]["sql"])
+        self.assertEqual(self.get_names(books, "authors"), [["Charlotte", "Anne"], ["Charlotte"]])
+        self.assertIs(books[1].authors.all()[0], charlotte)
+
+    def test_reverse_many_to_one(self):
+        authors = [self.identity_map[author] for author in Author.objects.all()]
+        with self.assertNumQueries(2):
+            books = self.prefetch(TwoPhasePrefetch("first_time_authors"))
+        self.assertEqual(self.get_names(books, "first_time_authors"), [["Charlotte", "Anne"], []])
+        self.assertIs(books[0].first_time_authors.all()[1], authors[1])
+        with self.assertNumQueries(0):
+            self.assertIs(authors[1].first_book, books[0])
+
+    def test_custom_queryset_is_fetched_in_one_phase(self):
+        [self.identity_map[author] for author in Author.objects.all()]
+        lookup = TwoPhasePrefetch("authors", Author.objects.filter(name="Anne"))
+        with self.assertNumQueries(2) as context:
+            books = self.prefetch(lookup)
+        self.assertIn('"name"', context.captured_queries[1]["sql"])
+        self.assertEqual(self.get_names(books, "authors"), [["Anne"], []])
+
+    def test_auto_uses_warm_identity_map(self):
+        with mock.patch.object(two_phase, "WARM_MIN_INSTANCES", 2):
+            with self.assertNumQueries(2) as context:
+                self.prefetch(Prefetch("authors"))
+            self.assertIn('"name"', context.captured_queries[1]["sql"])
+
+            authors = [self.identity_map[author] for author in Author.objects.all()]
+            with self.assertNumQueries(2) as context:
+                books = self.prefetch(Prefetch("authors", to_attr="author_list"))
+            self.assertNotIn('"name"', context.captured_queries[1]["sql"])
+        self.assertEqual(books[0].author_list, authors)
+
+    @override_settings(PREFETCH_UTILS_TWO_PHASE_PREFETCH=False)
+    def test_setting(self):
+        [self.identity_map[author] for author in Author.objects.all()]
+        with self.assertNumQueries(2) as context:
+            self.prefetch("authors")
+        self.assertIn('"name"', context.captured_queries[1]["sql"])
+        with self.assertNumQueries(2) as context:
+            self.prefetch(TwoPhasePrefetch("first_time_authors"))
+        self.assertNotIn('"name"', context.captured_queries[1]["sql"])
@@ -0,0 +1,219 @@
+import contextvars
+
+from django.db.models.query import QuerySet
+from django.db.models.signals import post_save
+from django.test import TestCase
+from prefetch_related.models import Author
+from prefetch_related.models import AuthorAddress
+from prefetch_related.models import AuthorWithAge
+from prefetch_related.models import Book
+
+from django_prefetch_utils.identity_map import write_through
+from django_prefetch_utils.identity_map.maps import LRUPrefetchIdentityMap
+from django_prefetch_utils.identity_map.maps import PrefetchIdentityMap
+from django_prefetch_utils.identity_map.persistent import use_persistent_prefetch_identity_map
+from django_prefetch_utils.identity_map.write_through import LOADED_VALUES_ATTR
+from django_prefetch_utils.identity_map.write_through import OLD_VALUES_ATTR
+from django_prefetch_utils.identity_map.write_through import original_bulk_create
+from django_prefetch_utils.identity_map.write_through import record_old_values
+from django_prefetch_utils.identity_map.write_through import write_saved_instance
+
+
+class WriteThroughTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book1 = Book.objects.create(title="Poems")
+        cls.book2 = Book.objects.create(title="Jane Eyre")
+        cls.charlotte = Author.objects.create(name="Charlotte", first_book=cls.book1)
+        cls.anne = Author.objects.create(name="Anne", first_book=cls.book1)
+        cls.book1.authors.add(cls.charlotte, cls.anne)
+
+    def setUp(self):
+        super().setUp()
+        self.identity_map = self.get_identity_map()
+        cm = use_persistent_prefetch_identity_map(self.identity_map, write_through=True)
+        cm.__enter__()
+        self.addCleanup(lambda: cm.__exit__(None, None, None))
+
+    def get_identity_map(self):
+        return PrefetchIdentityMap(track_relations=True)
+
+    def get_book(self, *lookups):
+        return Book.objects.prefetch_related(*lookups).get(pk=self.book1.pk)
+
+    def get_names(self, related_manager):
+        return sorted(author.name for author in related_manager.all())
+
+    def test_created_instance_is_added(self):
+        emily = Author.objects.create(name="Emily", first_book=self.book2)
+        self.assertIs(Author.objects.get(pk=emily.pk), emily)
+
+    def test_saved_values_are_copied_to_mapped_instance(self):
+        charlotte = Author.objects.get(pk=self.charlotte.pk)
+        copy = Author(pk=charlotte.pk, name="Currer", first_book=self.book1)
+        copy.save()
+        self.assertEqual(charlotte.name, "Currer")
+
+    def test_update_fields_are_respected(self):
+        charlotte = Author.objects.get(pk=self.charlotte.pk)
+        copy = Author(pk=charlotte.pk, name="Currer", first_book=self.book2)
+        copy.save(update_fields=["name"])
+        self.assertEqual((charlotte.name, charlotte.first_book_id), ("Currer", self.book1.pk))
+
+    def test_changed_foreign_key_clears_cached_instance(self):
+        charlotte = Author.objects.select_related("first_book").get(pk=self.charlotte.pk)
+        self.assertEqual(charlotte.first_book, self.book1)
+        copy = Author(pk=charlotte.pk, name="Charlotte", first_book=self.book2)
+        copy.save()
+        self.assertEqual(charlotte.first_book.title, "Jane Eyre")
+
+    def test_created_instance_invalidates_reverse_relation(self):
+        book = self.get_book("first_time_authors")
+        Author.objects.create(name="Emily", first_book=book)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get_names(book.first_time_authors), ["Anne", "Charlotte", "Emily"])
+
+    def test_moved_instance_invalidates_old_and_new_parents(self):
+        books = list(Book.objects.prefetch_related("first_time_authors"))
+        book1, book2 = sorted(books, key=lambda book: book.pk)
+        anne = Author.objects.get(pk=self.anne.pk)
+        anne.first_book = book2
+        with self.assertNumQueries(1):
+            anne.save()
+        self.assertEqual(self.get_names(book1.first_time_authors), ["Charlotte"])
+        self.assertEqual(self.get_names(book2.first_time_authors), ["Anne"])
+
+    def test_saving_mapped_instance_does_not_query(self):
+        list(Book.objects.prefetch_related("first_time_authors"))
+        anne = Author.objects.get(pk=self.anne.pk)
+        anne.name = "Acton"
+        with self.assertNumQueries(1):
+            anne.save()
+
+    def test_unrecorded_old_values_discard_all_parents(self):
+        books = list(Book.objects.prefetch_related("first_time_authors"))
+        book1, book2 = sorted(books, key=lambda book: book.pk)
+        anne = Author.objects.get(pk=self.anne.pk)
+        del anne.__dict__[LOADED_VALUES_ATTR]
+        anne.first_book = book2
+        with self.assertNumQueries(1):
+            anne.save()
+        self.assertEqual(self.get_names(book1.first_time_authors), ["Charlotte"])
+        self.assertEqual(self.get_names(book2.first_time_authors), ["Anne"])
+
+    def test_loaded_values_are_updated_on_save(self):
+        list(Book.objects.prefetch_related("first_time_authors"))
+        anne = Author.objects.get(pk=self.anne.pk)
+        anne.first_book_id = self.book2.pk
+        anne.save()
+        self.assertEqual(anne.__dict__[LOADED_VALUES_ATTR], {"first_book_id": self.book2.pk})
+
+    def test_moved_copy_uses_mapped_old_values(self):
+        books = list(Book.objects.prefetch_related("first_time_authors"))
+        book1, book2 = sorted(books, key=lambda book: book.pk)
+        copy = Author(pk=self.anne.pk, name="Anne", first_book=book2)
+        with self.assertNumQueries(1):
+            copy.save()
+        self.assertEqual(self.get_names(book1.first_time_authors), ["Charlotte"])
+
+    def test_deleted_instance_is_evicted(self):
+        book = self.get_book("first_time_authors")
+        anne = Author.objects.get(pk=self.anne.pk)
+        pk = anne.pk
+        anne.delete()
+        self.assertNotIn(pk, self.identity_map.get_map_for_model(Author))
+        self.assertEqual(self.get_names(book.first_time_authors), ["Charlotte"])
+
+    def test_to_field_foreign_key_invalidates_parent(self):
+        charlotte = Author.objects.prefetch_related("addresses").get(pk=self.charlotte.pk)
+        self.assertEqual(list(charlotte.addresses.all()), [])
+        AuthorAddress.objects.create(author=charlotte, address="Haworth")
+        self.assertEqual([address.address for address in charlotte.addresses.all()], ["Haworth"])
+
+    def test_many_to_many_add_invalidates_both_sides(self):
+        book = self.get_book("authors")
+        emily = Author.objects.create(name="Emily", first_book=self.book2)
+        emily = Author.objects.prefetch_related("books").get(pk=emily.pk)
+        self.assertEqual(list(emily.books.all()), [])
+        self.book1.authors.add(emily)
+        self.assertEqual(self.get_names(book.authors), ["Anne", "Charlotte", "Emily"])
+        self.assertEqual(list(emily.books.all()), [book])
+
+    def test_many_to_many_reverse_remove(self):
+        book = self.get_book("authors")
+        anne = Author.objects.get(pk=self.anne.pk)
+        anne.books.remove(self.book1)
+        self.assertEqual(self.get_names(book.authors), ["Charlotte"])
+
+    def test_many_to_many_reverse_clear(self):
+        book = self.get_book("authors")
+        anne = Author.objects.get(pk=self.anne.pk)
+        anne.books.clear()
+        self.assertEqual(self.get_names(book.authors), ["Charlotte"])
+
+    def test_relation_sets_are_discarded(self):
+        book = self.get_book("first_time_authors")
+        self.assertEqual(len(self.identity_map.relation_sets), 1)
+        Author.objects.create(name="Emily", first_book=book)
+        self.assertEqual(len(self.identity_map.relation_sets), 0)
+
+    def test_multi_table_parent_is_updated(self):
+        author = AuthorWithAge.objects.create(name="Emily", first_book=self.book2, age=30)
+        parent = Author.objects.get(pk=author.pk)
+        author.name = "Ellis"
+        author.save()
+        self.assertEqual(parent.name, "Ellis")
+
+    def test_bulk_create_adds_instances(self):
+        book = self.get_book("first_time_authors")
+        (emily,) = Author.objects.bulk_create([Author(name="Emily", first_book=book)])
+        if emily.pk is None:
+            self.skipTest("Primary keys are not set by bulk_create on this database.")
+        self.assertIs(Author.objects.get(pk=emily.pk), emily)
+        self.assertEqual(self.get_names(book.first_time_authors), ["Anne", "Charlotte", "Emily"])
+
+    def test_old_values_are_kept_on_instance_until_saved(self):
+        Book.objects.prefetch_related("first_time_authors").get(pk=self.book1.pk)
+        anne = Author.objects.get(pk=self.anne.pk)
+        record_old_values(Author, anne)
+        self.assertEqual(anne.__dict__[OLD_VALUES_ATTR], {"first_book_id": self.book1.pk})
+        anne.save()
+        self.assertNotIn(OLD_VALUES_ATTR, anne.__dict__)
+
+    def test_raw_saves_are_ignored(self):
+        charlotte = Author.objects.get(pk=self.charlotte.pk)
+        copy = Author(pk=charlotte.pk, name="Currer", first_book=self.book1)
+        write_saved_instance(Author, copy, raw=True)
+        self.assertEqual(charlotte.name, "Charlotte")
+
+
+class LRUWriteThroughTests(WriteThroughTests):
+    def get_identity_map(self):
+        return LRUPrefetchIdentityMap(track_relations=True)
+
+
+class WriteThroughEnabledTests(TestCase):
+    def test_disabled_by_default(self):
+        with use_persistent_prefetch_identity_map():
+            self.assertIs(QuerySet.bulk_create, original_bulk_create)
+            self.assertNotIn(write_through.__name__, self.get_dispatch_uids())
+
+    def test_receivers_are_removed_on_exit(self):
+        with use_persistent_prefetch_identity_map(write_through=True):
+            with use_persistent_prefetch_identity_map(write_through=True):
+                self.assertIsNot(QuerySet.bulk_create, original_bulk_create)
+            self.assertIn(write_through.__name__, self.get_dispatch_uids())
+        self.assertIs(QuerySet.bulk_create, original_bulk_create)
+        self.assertNotIn(write_through.__name__, self.get_dispatch_uids())
+
+    def test_old_values_are_not_recorded_without_write_through(self):
+        book = Book.objects.create(title="Poems")
+        author = Author.objects.create(name="Jane", first_book=book)
+        with use_persistent_prefetch_identity_map(write_through=True):
+            # The receivers are connected, but write-through isn't enabled
+            # in the empty context, as in another thread.
+            contextvars.Context().run(record_old_values, Author, author)
+        self.assertNotIn(OLD_VALUES_ATTR, author.__dict__)
+
+    def get_dispatch_uids(self):
+        return [lookup_key[0] for lookup_key, *_ in post_save.receivers]
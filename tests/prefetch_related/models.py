@@ -332,3 +332,8 @@ class Dog(models.Model):
 class Toy(models.Model):
     name = models.CharField(max_length=50, unique=True)
     dogs = models.ManyToManyField(Dog, related_name="toys")
+
+
+class ServiceDog(Dog):
+    class Meta:
+        proxy = True
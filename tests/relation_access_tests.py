@@ -0,0 +1,88 @@
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.db.models.fields.related_descriptors import ForwardManyToOneDescriptor
+from django.test import TestCase
+from prefetch_related.models import Author
+from prefetch_related.models import Bio
+from prefetch_related.models import Book
+from prefetch_related.models import Bookmark
+from prefetch_related.models import TaggedItem
+
+from django_prefetch_utils.relation_access import HOOKED_MANAGER_CLASS_ATTR
+from django_prefetch_utils.relation_access import add_relation_access_hook
+from django_prefetch_utils.relation_access import original_forward_many_to_one_get
+from django_prefetch_utils.relation_access import original_generic_foreign_key_get
+from django_prefetch_utils.relation_access import remove_relation_access_hook
+
+
+class RelationAccessHookTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.book = Book.objects.create(title="Poems")
+        cls.author = Author.objects.create(name="Jane", first_book=cls.book)
+        cls.book.authors.add(cls.author)
+        cls.bio = Bio.objects.create(author=cls.author)
+        cls.tag = TaggedItem.objects.create(tag="great", content_object=cls.book)
+
+    def setUp(self):
+        super().setUp()
+        self.accesses = []
+        add_relation_access_hook(self.hook)
+        self.addCleanup(remove_relation_access_hook, self.hook)
+
+    def hook(self, instance, attname):
+        self.accesses.append((type(instance), attname))
+
+    def test_forward_many_to_one(self):
+        author = Author.objects.get()
+        author.first_book
+        author.first_book
+        self.assertEqual(self.accesses, [(Author, "first_book")])
+
+    def test_forward_many_to_one_with_select_related(self):
+        Author.objects.select_related("first_book").get().first_book
+        self.assertEqual(self.accesses, [])
+
+    def test_reverse_one_to_one(self):
+        Author.objects.get().bio
+        self.assertEqual(self.accesses, [(Author, "bio")])
+
+    def test_reverse_many_to_one(self):
+        list(Book.objects.get().first_time_authors.all())
+        self.assertEqual(self.accesses, [(Book, "first_time_authors")])
+
+    def test_many_to_many(self):
+        list(Book.objects.get().authors.all())
+        list(Author.objects.get().books.all())
+        self.assertEqual(self.accesses, [(Book, "authors"), (Author, "books")])
+
+    def test_prefetched_many_to_many(self):
+        list(Book.objects.prefetch_related("authors").get().authors.all())
+        self.assertEqual(self.accesses, [])
+
+    def test_related_manager_filter_is_not_an_access(self):
+        Book.objects.get().authors.filter(name="Jane").exists()
+        self.assertEqual(self.accesses, [])
+
+    def test_generic_foreign_key(self):
+        TaggedItem.objects.get().content_object
+        self.assertEqual(self.accesses, [(TaggedItem, "content_object")])
+
+    def test_generic_relation(self):
+        Bookmark.objects.create(url="http://example.com")
+        list(Bookmark.objects.get().tags.all())
+        self.assertEqual(self.accesses, [(Bookmark, "tags")])
+
+    def test_prefetched_generic_relation(self):
+        Bookmark.objects.create(url="http://example.com")
+        list(Bookmark.objects.prefetch_related("tags").get().tags.all())
+        self.assertEqual(self.accesses, [])
+
+    def test_hooked_manager_class_is_reused(self):
+        book = Book.objects.get()
+        self.assertIs(type(book.authors), type(book.authors))
+        self.assertIs(type(book.authors), Book.authors.__dict__[HOOKED_MANAGER_CLASS_ATTR])
+
+    def test_removing_last_hook_restores_descriptors(self):
+        remove_relation_access_hook(self.hook)
+        self.assertIs(ForwardManyToOneDescriptor.__get__, original_forward_many_to_one_get)
+        self.assertIs(GenericForeignKey.__get__, original_generic_foreign_key_get)
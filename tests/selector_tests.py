@@ -1,3 +1,6 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
 import django.db.models.query
 from django.test import TestCase
 
@@ -55,3 +58,34 @@ class SelectorTests(TestCase):
         with use_original_prefetch_related_objects():
             self.assertIs(get_prefetch_related_objects(), original_prefetch_related_objects)
         self.assertIs(get_prefetch_related_objects(), mock_implementation)
+
+    def test_override_is_local_to_task(self):
+        seen = []
+
+        async def task(func):
+            with override_prefetch_related_objects(func):
+                await asyncio.sleep(0)
+                seen.append(get_prefetch_related_objects() is func)
+
+        async def main():
+            await asyncio.gather(task(mock_implementation), task(original_prefetch_related_objects))
+
+        asyncio.run(main())
+        self.assertEqual(seen, [True, True])
+
+    def test_default_is_shared_between_threads(self):
+        set_default_prefetch_related_objects(mock_implementation)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertIs(executor.submit(get_prefetch_related_objects).result(), mock_implementation)
+
+    def test_override_decorator_is_reentrant(self):
+        decorator = override_prefetch_related_objects(mock_implementation)
+
+        @decorator
+        def func(depth):
+            if depth:
+                func(depth - 1)
+            return get_prefetch_related_objects()
+
+        self.assertIs(func(2), mock_implementation)
+        self.assertIs(get_prefetch_related_objects(), original_prefetch_related_objects)
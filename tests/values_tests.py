@@ -0,0 +1,101 @@
+from django.test import TestCase
+from prefetch_related.models import Author
+from prefetch_related.models import Bio
+from prefetch_related.models import Book
+from prefetch_related.models import Reader
+
+from django_prefetch_utils import backport
+from django_prefetch_utils import identity_map
+from django_prefetch_utils.chunked import ChunkedPrefetch
+from django_prefetch_utils.values import ValuesPrefetch
+
+
+class ChunkedValuesPrefetch(ChunkedPrefetch, ValuesPrefetch):
+    def __init__(self, lookup, fields=None, chunk_size=None):
+        ValuesPrefetch.__init__(self, lookup, fields=fields)
+        self.chunk_size = chunk_size
+
+
+class ValuesPrefetchTestsMixin(object):
+    prefetch_related_objects = None
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.book1 = Book.objects.create(title="Poems")
+        cls.book2 = Book.objects.create(title="Stories")
+        cls.author1 = Author.objects.create(name="Jane", first_book=cls.book1)
+        cls.author2 = Author.objects.create(name="Tom", first_book=cls.book1)
+        cls.book1.authors.add(cls.author1, cls.author2)
+        cls.book2.authors.add(cls.author1)
+        cls.bio = Bio.objects.create(author=cls.author1, best_book=cls.book2)
+        cls.reader = Reader.objects.create(name="Amy")
+        cls.reader.books_read.add(cls.book1, cls.book2)
+
+    def prefetch(self, instances, *lookups):
+        type(self).prefetch_related_objects(instances, *lookups)
+
+    def test_many_to_many(self):
+        books = list(Book.objects.order_by("id"))
+        with self.assertNumQueries(1):
+            self.prefetch(books, ValuesPrefetch("authors", fields=["name"]))
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [sorted(row["name"] for row in book.authors.all()) for book in books], [["Jane", "Tom"], ["Jane"]]
+            )
+            self.assertEqual(list(books[1].authors.all()), [{"name": "Jane"}])
+
+    def test_reverse_many_to_one(self):
+        books = list(Book.objects.order_by("id"))
+        with self.assertNumQueries(1):
+            self.prefetch(books, ValuesPrefetch("first_time_authors", fields=["id"]))
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                [list(book.first_time_authors.all()) for book in books],
+                [[{"id": self.author1.id}, {"id": self.author2.id}], []],
+            )
+
+    def test_forward_many_to_one_requires_to_attr(self):
+        authors = list(Author.objects.all())
+        with self.assertRaises(ValueError):
+            self.prefetch(authors, ValuesPrefetch("first_book", fields=["title"]))
+
+    def test_forward_many_to_one(self):
+        authors = list(Author.objects.order_by("id"))
+        with self.assertNumQueries(1):
+            self.prefetch(authors, ValuesPrefetch("first_book", fields=["title"], to_attr="first_book_values"))
+        self.assertEqual([author.first_book_values for author in authors], [{"title": "Poems"}] * 2)
+
+    def test_reverse_one_to_one(self):
+        authors = list(Author.objects.order_by("id"))
+        with self.assertNumQueries(1):
+            self.prefetch(authors, ValuesPrefetch("bio", fields=["best_book_id"], to_attr="bio_values"))
+        self.assertEqual([author.bio_values for author in authors], [{"best_book_id": self.book2.id}, None])
+
+    def test_named_rows_with_all_fields(self):
+        books = list(Book.objects.order_by("id"))
+        with self.assertNumQueries(1):
+            self.prefetch(books, ValuesPrefetch("read_by", named=True))
+        row = books[0].read_by.all()[0]
+        self.assertEqual((row.id, row.name), (self.reader.id, "Amy"))
+
+    def test_only_last_level_is_values(self):
+        authors = list(Author.objects.order_by("id"))
+        with self.assertNumQueries(2):
+            self.prefetch(authors, ValuesPrefetch("first_book__read_by", fields=["name"]))
+        with self.assertNumQueries(0):
+            self.assertIsInstance(authors[0].first_book, Book)
+            self.assertEqual(list(authors[0].first_book.read_by.all()), [{"name": "Amy"}])
+
+    def test_chunked(self):
+        books = list(Book.objects.order_by("id"))
+        with self.assertNumQueries(2):
+            self.prefetch(books, ChunkedValuesPrefetch("authors", fields=["name"], chunk_size=1))
+        self.assertEqual(list(books[1].authors.all()), [{"name": "Jane"}])
+
+
+class IdentityMapValuesPrefetchTests(ValuesPrefetchTestsMixin, TestCase):
+    prefetch_related_objects = identity_map.prefetch_related_objects
+
+
+class BackportValuesPrefetchTests(ValuesPrefetchTestsMixin, TestCase):
+    prefetch_related_objects = backport.prefetch_related_objects